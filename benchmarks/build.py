@@ -0,0 +1,57 @@
+import argparse
+import random
+import time
+from typing import List
+
+from vptree.vptree import VPTree
+
+HASH_BITS = 64
+
+
+def hamming(x: int, y: int) -> int:
+    return bin(x ^ y).count('1')
+
+
+def synthetic_hashes(n: int, seed: int = 0) -> List[int]:
+    rnd = random.Random(seed)
+    return [rnd.getrandbits(HASH_BITS) for _ in range(n)]
+
+
+def time_bulk(points: List[int], capacity: int) -> float:
+    start = time.perf_counter()
+    tree = VPTree(distance_fn=hamming, capacity=capacity)
+    tree.add_list(points)
+    return time.perf_counter() - start
+
+
+def time_incremental(points: List[int], capacity: int) -> float:
+    start = time.perf_counter()
+    tree = VPTree(distance_fn=hamming, capacity=capacity)
+    tree.build(points[:1])
+    for p in points[1:]:
+        # what VPTree.add used to cost: insert into a leaf and re-partition the whole tree
+        tree.root.add(p)
+        tree.root.partition()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='VP-tree build time benchmark')
+    parser.add_argument('--sizes', default='1000,10000,100000,1000000', help='comma-separated collection sizes')
+    parser.add_argument('--capacity', default=32, type=int, help='leaf capacity')
+    parser.add_argument('--incremental_limit', default=10000, type=int,
+                        help='largest size to also time with per-point insertion')
+    args = parser.parse_args()
+
+    print('{:>10} {:>12} {:>16}'.format('n', 'bulk (s)', 'incremental (s)'))
+    for n in [int(s) for s in args.sizes.split(',')]:
+        points = synthetic_hashes(n)
+        bulk = time_bulk(points, args.capacity)
+        incremental = '-'
+        if n <= args.incremental_limit:
+            incremental = '{:.3f}'.format(time_incremental(points, args.capacity))
+        print('{:>10} {:>12.3f} {:>16}'.format(n, bulk, incremental))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+from typing import List
+
+from db.clusters import find_groups
+from db.db import DB, new_tree
+from image.image import Image
+
+HASH_BITS = 64
+
+
+def clustered_images(n: int, cluster_size: int, max_flips: int, seed: int = 0) -> List[Image]:
+    rnd = random.Random(seed)
+    images = []
+    while len(images) < n:
+        center = rnd.getrandbits(HASH_BITS)
+        for _ in range(min(cluster_size, n - len(images))):
+            h = center
+            for bit in rnd.sample(range(HASH_BITS), rnd.randint(0, max_flips)):
+                h ^= 1 << bit
+            images.append(Image.from_hash('/synthetic/{}.jpg'.format(len(images)), h))
+    return images
+
+
+def main():
+    parser = argparse.ArgumentParser(description='near-duplicate grouping benchmark')
+    parser.add_argument('--size', default=100000, type=int, help='number of synthetic hashes')
+    parser.add_argument('--cluster_size', default=4, type=int, help='images per near-duplicate cluster')
+    parser.add_argument('--max_flips', default=2, type=int, help='bits flipped in cluster members')
+    parser.add_argument('--max_distance', default=2, type=int)
+    parser.add_argument('--workers', default='1,{}'.format(os.cpu_count()), help='comma-separated worker counts')
+    args = parser.parse_args()
+
+    images = clustered_images(args.size, args.cluster_size, args.max_flips)
+    tree = new_tree(8)
+    tree.add_list(images)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        index_path = os.path.join(tmp, 'index')
+        DB(tree, images, 'dhash', 8).encode(index_path)
+
+        print('{:>8} {:>8} {:>10} {:>14}'.format('workers', 'groups', 'time (s)', 'images/s'))
+        for workers in sorted({int(w) for w in args.workers.split(',')}):
+            start = time.perf_counter()
+            groups = find_groups(index_path, args.max_distance, workers)
+            elapsed = time.perf_counter() - start
+            print('{:>8} {:>8} {:>10.2f} {:>14.0f}'.format(workers, len(groups), elapsed, args.size / elapsed))
+
+
+if __name__ == '__main__':
+    main()
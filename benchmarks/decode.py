@@ -0,0 +1,52 @@
+import argparse
+import itertools
+import time
+from typing import Dict, List
+
+from cli import scanner
+from image import image
+
+MODES = ['full', 'reduced', 'reduced+exif']
+
+
+def hash_all(paths: List[str], hash_type: str, hash_size: int, mode: str) -> Dict[str, int]:
+    hashes = {}
+    for path in paths:
+        try:
+            h = image._get_hash(path, hash_type, hash_size, reduced=mode != 'full',
+                                exif_thumbnails=mode == 'reduced+exif')
+        except OSError:
+            continue
+        hashes[path] = image.pack_hash(h)
+    return hashes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='hashing throughput and agreement of reduced-resolution decoding')
+    parser.add_argument('--dir', required=True, help='directory of real images')
+    parser.add_argument('--limit', default=500, type=int, help='maximum number of images')
+    parser.add_argument('--hash_size', default=8, type=int)
+    parser.add_argument('--hash_types', default=','.join(image.HASH_FUNCS), help='comma-separated hash types')
+    args = parser.parse_args()
+
+    paths = list(itertools.islice(scanner.scan(args.dir), args.limit))
+    print('{} images'.format(len(paths)))
+    print('{:>6} {:>13} {:>10} {:>10} {:>10} {:>10}'.format(
+        'hash', 'mode', 'images/s', 'identical', 'mean dist', 'max dist'))
+    for hash_type in args.hash_types.split(','):
+        reference = None
+        for mode in MODES:
+            start = time.perf_counter()
+            hashes = hash_all(paths, hash_type, args.hash_size, mode)
+            elapsed = time.perf_counter() - start
+            if reference is None:
+                reference = hashes
+            distances = [image.popcount(reference[p] ^ h) for p, h in hashes.items() if p in reference]
+            identical = sum(1 for d in distances if d == 0) / max(1, len(distances))
+            mean = sum(distances) / max(1, len(distances))
+            print('{:>6} {:>13} {:>10.1f} {:>9.1f}% {:>10.2f} {:>10}'.format(
+                hash_type, mode, len(hashes) / elapsed, identical * 100, mean, max(distances, default=0)))
+
+
+if __name__ == '__main__':
+    main()
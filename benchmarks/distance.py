@@ -0,0 +1,39 @@
+import argparse
+import random
+import timeit
+
+import numpy
+from imagehash import ImageHash
+
+from image import image
+
+
+def random_hashes(n: int, hash_size: int, seed: int = 0):
+    rnd = numpy.random.RandomState(seed)
+    return [ImageHash(rnd.randint(0, 2, (hash_size, hash_size)).astype(bool)) for _ in range(n)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Hamming distance microbenchmark: ImageHash vs packed integers')
+    parser.add_argument('--pairs', default=10000, type=int, help='number of hash pairs')
+    parser.add_argument('--hash_sizes', default='8,16,32', help='comma-separated hash sizes')
+    parser.add_argument('--repeat', default=5, type=int)
+    args = parser.parse_args()
+
+    print('{:>9} {:>16} {:>16} {:>9}'.format('hash_size', 'ImageHash (ns)', 'packed (ns)', 'speedup'))
+    for hash_size in [int(s) for s in args.hash_sizes.split(',')]:
+        hashes = random_hashes(2 * args.pairs, hash_size)
+        pairs = list(zip(hashes[::2], hashes[1::2]))
+        packed = [(image.pack_hash(a), image.pack_hash(b)) for a, b in pairs]
+        for (a, b), (pa, pb) in random.sample(list(zip(pairs, packed)), min(100, len(pairs))):
+            assert a - b == image.popcount(pa ^ pb)
+
+        popcount = image.popcount
+        slow = min(timeit.repeat(lambda: [a - b for a, b in pairs], number=1, repeat=args.repeat))
+        fast = min(timeit.repeat(lambda: [popcount(a ^ b) for a, b in packed], number=1, repeat=args.repeat))
+        print('{:>9} {:>16.1f} {:>16.1f} {:>8.1f}x'.format(hash_size, slow / args.pairs * 1e9,
+                                                            fast / args.pairs * 1e9, slow / fast))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+import argparse
+import random
+import time
+
+from benchmarks.clusters import clustered_images
+from db.db import new_tree
+
+
+def main():
+    parser = argparse.ArgumentParser(description='VP-tree against multi-index hashing query benchmark')
+    parser.add_argument('--sizes', default='10000,100000', help='comma-separated collection sizes')
+    parser.add_argument('--radii', default='0,1,2,3,5,8,12', help='comma-separated search distances')
+    parser.add_argument('--queries', default=200, type=int, help='queries per size and distance')
+    parser.add_argument('--num_neighbours', default=10, type=int, help='nearest neighbour count')
+    args = parser.parse_args()
+
+    radii = [int(r) for r in args.radii.split(',')]
+    print('{:>9} {:>8} {:>7} {:>10} {:>14} {:>14}'.format(
+        'size', 'engine', 'radius', 'build (s)', 'queries/s', 'matches/query'))
+    for size in [int(s) for s in args.sizes.split(',')]:
+        images = clustered_images(size, 4, 4)
+        queries = random.Random(size).sample(images, min(args.queries, size))
+        for engine in ['vptree', 'mih']:
+            start = time.perf_counter()
+            tree = new_tree(8, engine)
+            tree.add_list(images)
+            build = time.perf_counter() - start
+
+            for radius in radii:
+                start = time.perf_counter()
+                matches = sum(len(tree.get_within_distance(q, radius)) for q in queries)
+                elapsed = time.perf_counter() - start
+                print('{:>9} {:>8} {:>7} {:>10.2f} {:>14.0f} {:>14.1f}'.format(
+                    size, engine, radius, build, len(queries) / elapsed, matches / len(queries)))
+
+            start = time.perf_counter()
+            for q in queries:
+                tree.get_nearest_neighbours(q, args.num_neighbours, args.num_neighbours)
+            elapsed = time.perf_counter() - start
+            print('{:>9} {:>8} {:>7} {:>10.2f} {:>14.0f} {:>14}'.format(
+                size, engine, 'knn', build, len(queries) / elapsed, args.num_neighbours))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+import argparse
+import random
+import time
+
+from benchmarks.clusters import clustered_images
+from db.db import new_tree
+from vptree.stats import SearchStats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='VP-tree nearest neighbour search cost')
+    parser.add_argument('--size', default=100000, type=int, help='number of synthetic hashes')
+    parser.add_argument('--num_neighbours', default='1,3,10,50', help='comma-separated neighbour counts')
+    parser.add_argument('--max_distances', default='none,4,8', help='comma-separated bounds, none for unbounded')
+    parser.add_argument('--queries', default=200, type=int)
+    args = parser.parse_args()
+
+    images = clustered_images(args.size, 4, 4)
+    tree = new_tree(8)
+    tree.add_list(images)
+    queries = random.Random(1).sample(images, min(args.queries, args.size))
+
+    print('{:>6} {:>12} {:>10} {:>14} {:>16} {:>10}'.format(
+        'k', 'max_distance', 'ms/query', 'nodes/query', 'distances/query', 'scanned'))
+    for bound in args.max_distances.split(','):
+        max_distance = None if bound == 'none' else int(bound)
+        for k in [int(k) for k in args.num_neighbours.split(',')]:
+            stats = SearchStats()
+            start = time.perf_counter()
+            for q in queries:
+                tree.get_nearest_neighbours(q, k, k, max_distance, stats)
+            elapsed = time.perf_counter() - start
+            nodes, distances = stats.per_query()
+            print('{:>6} {:>12} {:>10.3f} {:>14.1f} {:>16.1f} {:>9.1%}'.format(
+                k, bound, elapsed / len(queries) * 1000, nodes, distances, distances / args.size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+import argparse
+import multiprocessing
+import resource
+import sys
+import time
+from typing import Tuple
+
+from benchmarks.clusters import clustered_images
+from db.db import new_tree
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def build(size: int, engine: str) -> Tuple[float, float, float]:
+    images = clustered_images(size, 4, 4)
+    before = peak_rss_mb()
+    start = time.perf_counter()
+    tree = new_tree(8, engine)
+    tree.add_list(images)
+    elapsed = time.perf_counter() - start
+    return elapsed, before, peak_rss_mb()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='peak memory of index builds')
+    parser.add_argument('--sizes', default='100000,1000000', help='comma-separated collection sizes')
+    parser.add_argument('--engines', default='vptree,mih', help='comma-separated index engines')
+    args = parser.parse_args()
+
+    # every build runs in a fresh process, so its peak is not hidden by an earlier, larger one
+    context = multiprocessing.get_context('spawn')
+    print('{:>10} {:>8} {:>10} {:>16} {:>14} {:>12}'.format(
+        'n', 'engine', 'build (s)', 'points RSS (MB)', 'peak RSS (MB)', 'bytes/point'))
+    for n in [int(s) for s in args.sizes.split(',')]:
+        for engine in args.engines.split(','):
+            with context.Pool(1) as pool:
+                elapsed, before, peak = pool.apply(build, (n, engine))
+            print('{:>10} {:>8} {:>10.2f} {:>16.0f} {:>14.0f} {:>12.0f}'.format(
+                n, engine, elapsed, before, peak, (peak - before) * 1024 * 1024 / n))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import List, Set, Tuple
+
+import numpy
+from PIL import Image as PILImage
+
+MAIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'main.py')
+# top-level packages worth knowing about when a command loads them
+HEAVY_MODULES = ['numpy', 'PIL', 'imagehash', 'scipy', 'pywt', 'multiprocessing', 'http']
+
+
+def write_images(directory: str, count: int):
+    rnd = numpy.random.default_rng(0)
+    for i in range(count):
+        pixels = rnd.integers(0, 256, (64, 64, 3), dtype=numpy.uint8)
+        PILImage.fromarray(pixels).save(os.path.join(directory, 'img{:02}.png'.format(i)))
+
+
+def run(db_path: str, command: List[str]) -> Tuple[float, float, Set[str]]:
+    # wall time of the whole process, and the import time and heavy packages reported by -X importtime
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-X', 'importtime', MAIN, '--db', db_path] + command,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    elapsed = time.perf_counter() - start
+    import_us = 0
+    loaded = set()
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = [field.strip() for field in line[len('import time:'):].split('|')]
+        import_us += int(self_us)
+        loaded.add(name.split('.')[0])
+    return elapsed, import_us / 1e6, loaded & set(HEAVY_MODULES)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='command line startup and import time per subcommand')
+    parser.add_argument('--runs', default=5, type=int, help='runs per command, the median is reported')
+    parser.add_argument('--images', default=20, type=int, help='number of generated images in the database')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        images = os.path.join(tmp, 'images')
+        os.mkdir(images)
+        write_images(images, args.images)
+        db_path = os.path.join(tmp, 'db')
+        stored = os.path.join(images, 'img00.png')
+        unknown = os.path.join(tmp, 'query.png')
+        write_images(tmp, 1)
+        os.rename(os.path.join(tmp, 'img00.png'), unknown)
+        run(db_path, ['init', '--dir', images, '--workers', '1'])
+
+        commands = [
+            ['--help'],
+            ['search', '--help'],
+            ['search', stored, '--workers', '1'],
+            ['nearest', stored, '--workers', '1'],
+            ['search', unknown, '--workers', '1'],
+            ['remove', stored],
+            ['add', stored],
+            ['update', '--dir', images, '--workers', '1'],
+            ['clusters', '--num_threads', '1'],
+        ]
+        print('{:<40} {:>10} {:>12}  {}'.format('command', 'wall (ms)', 'import (ms)', 'heavy modules'))
+        for command in commands:
+            results = [run(db_path, command) for _ in range(args.runs)]
+            wall = statistics.median(r[0] for r in results) * 1000
+            imports = statistics.median(r[1] for r in results) * 1000
+            label = ' '.join(os.path.basename(c) if os.path.isabs(c) else c for c in command)
+            print('{:<40} {:>10.1f} {:>12.1f}  {}'.format(label, wall, imports, ' '.join(sorted(results[0][2]))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Tuple
+
+import numpy
+
+from benchmarks.clusters import HASH_BITS, clustered_images
+from benchmarks.decode import hash_all
+from cli import scanner
+from db.clusters import find_groups
+from db.db import DB, ENGINES, decode, new_tree, open_index
+from image import image
+from image.image import Image
+from vptree.stats import SearchStats
+
+DISTRIBUTIONS = ['uniform', 'clustered']
+# metrics where larger is better, every other timing is compared as smaller is better
+THROUGHPUT_METRICS = {'per_second'}
+TIME_METRICS = {'seconds', 'ms_per_query', 'us_per_op'}
+
+Result = Dict[str, Any]
+
+
+def corpus(args, n: int, seed: int) -> List[Image]:
+    if args.distribution == 'clustered':
+        hashes = [img.hash for img in clustered_images(n, args.cluster_size, args.max_flips, seed)]
+    else:
+        rnd = random.Random(seed)
+        hashes = [rnd.getrandbits(HASH_BITS) for _ in range(n)]
+    return [Image.from_hash('/synthetic/{}/{}.jpg'.format(seed, i), h) for i, h in enumerate(hashes)]
+
+
+def timed(fn, *fn_args) -> Tuple[float, Any]:
+    start = time.perf_counter()
+    value = fn(*fn_args)
+    return time.perf_counter() - start, value
+
+
+def query_result(name: str, engine: str, elapsed: float, stats: SearchStats, found: int, **params) -> Result:
+    nodes, distances = stats.per_query()
+    return dict(name=name, engine=engine, ms_per_query=elapsed / stats.queries * 1000, nodes_per_query=nodes,
+                distances_per_query=distances, results_per_query=found / stats.queries, **params)
+
+
+def bench_engine(args, engine: str, images: List[Image], queries: List[Image], extra: List[Image]) -> List[Result]:
+    results = []
+    tree = new_tree(8, engine)
+    elapsed, _ = timed(tree.add_list, images)
+    results.append(dict(name='build', engine=engine, seconds=elapsed, per_second=len(images) / elapsed))
+
+    for radius in args.radii:
+        stats = SearchStats()
+        elapsed, found = timed(lambda: sum(len(tree.get_within_distance(q, radius, stats)) for q in queries))
+        results.append(query_result('range', engine, elapsed, stats, found, radius=radius))
+
+    for k in args.max_results:
+        stats = SearchStats()
+        elapsed, found = timed(lambda: sum(len(tree.get_nearest_neighbours(q, k, k, None, stats)) for q in queries))
+        results.append(query_result('knn', engine, elapsed, stats, found, max_results=k))
+
+    elapsed, _ = timed(lambda: [tree.add(img) for img in extra])
+    results.append(dict(name='add', engine=engine, ops=len(extra), us_per_op=elapsed / max(1, len(extra)) * 1e6))
+    elapsed, _ = timed(lambda: [tree.remove(img) for img in extra])
+    results.append(dict(name='remove', engine=engine, ops=len(extra), us_per_op=elapsed / max(1, len(extra)) * 1e6))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'db')
+        db = DB(tree, images, 'dhash', 8, engine=engine)
+        elapsed, _ = timed(db.encode, path)
+        results.append(dict(name='encode', engine=engine, seconds=elapsed, bytes=os.path.getsize(path)))
+        elapsed, _ = timed(decode, path)
+        results.append(dict(name='decode', engine=engine, seconds=elapsed))
+
+        with open_index(path) as index:
+            stats = SearchStats()
+            elapsed, found = timed(lambda: sum(len(index.tree.get_within_distance(q, args.radii[-1], stats))
+                                               for q in queries))
+            results.append(query_result('mapped_range', engine, elapsed, stats, found, radius=args.radii[-1]))
+
+        if engine == 'vptree':
+            for workers in args.cluster_workers:
+                elapsed, groups = timed(find_groups, path, args.cluster_distance, workers)
+                results.append(dict(name='clusters', engine=engine, workers=workers, seconds=elapsed,
+                                    groups=len(groups)))
+    # every timing depends on the corpus, so it is part of what identifies a result
+    return [dict(result, size=len(images), distribution=args.distribution) for result in results]
+
+
+def bench_hashing(args) -> List[Result]:
+    paths = list(itertools.islice(scanner.scan(args.images), args.image_limit))
+    results = []
+    for hash_type in args.hash_types:
+        elapsed, hashes = timed(hash_all, paths, hash_type, 8, 'reduced')
+        results.append(dict(name='hash', hash_type=hash_type, images=len(hashes), seconds=elapsed,
+                            per_second=len(hashes) / elapsed if elapsed > 0 else 0.0))
+    return results
+
+
+def metadata(args) -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'args': vars(args),
+    }
+
+
+def result_key(result: Result) -> Tuple:
+    # a result is identified by its name and every parameter that is not a measurement, including the corpus
+    # size and the number of images hashed, so runs on different data are never compared
+    measured = THROUGHPUT_METRICS | TIME_METRICS | {'nodes_per_query', 'distances_per_query', 'results_per_query',
+                                                   'bytes', 'groups'}
+    return tuple(sorted((k, v) for k, v in result.items() if k not in measured))
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], threshold: float) -> List[str]:
+    # lines describing every timing that got worse by more than threshold
+    old = {result_key(r): r for r in baseline['results']}
+    regressions = []
+    for result in current['results']:
+        before = old.get(result_key(result))
+        if before is None:
+            continue
+        for metric, value in result.items():
+            if metric not in before or not (metric in TIME_METRICS or metric in THROUGHPUT_METRICS):
+                continue
+            ratio = value / before[metric] if before[metric] else 1.0
+            if metric in THROUGHPUT_METRICS:
+                ratio = 1 / ratio if ratio else float('inf')
+            if ratio > 1 + threshold:
+                name = ' '.join('{}={}'.format(k, v) for k, v in result_key(result))
+                regressions.append('{} {}: {:.4g} -> {:.4g} ({:+.0%})'.format(
+                    name, metric, before[metric], value, ratio - 1))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='index and hashing benchmark suite with JSON output')
+    parser.add_argument('--size', default=100000, type=int, help='number of synthetic hashes')
+    parser.add_argument('--distribution', default='clustered', choices=DISTRIBUTIONS)
+    parser.add_argument('--cluster_size', default=4, type=int, help='images per near-duplicate cluster')
+    parser.add_argument('--max_flips', default=4, type=int, help='bits flipped in cluster members')
+    parser.add_argument('--engines', default=','.join(ENGINES), help='comma-separated index engines')
+    parser.add_argument('--radii', default='0,2,4,8', help='comma-separated range search radii')
+    parser.add_argument('--max_results', default='1,3,10,50', help='comma-separated k-NN result counts')
+    parser.add_argument('--queries', default=200, type=int)
+    parser.add_argument('--updates', default=1000, type=int, help='single adds, then removes, timed after the build')
+    parser.add_argument('--cluster_distance', default=2, type=int)
+    parser.add_argument('--cluster_workers', default='1', help='comma-separated worker counts for clusters')
+    parser.add_argument('--images', default='', help='directory of real images to also time hashing on')
+    parser.add_argument('--image_limit', default=200, type=int)
+    parser.add_argument('--hash_types', default=','.join(image.HASH_FUNCS), help='comma-separated hash types')
+    parser.add_argument('--out', default='-', help='JSON output file, - for stdout')
+    parser.add_argument('--compare', default='', help='earlier JSON output to report regressions against')
+    parser.add_argument('--threshold', default=0.1, type=float, help='relative slowdown reported as a regression')
+    args = parser.parse_args()
+    args.radii = [int(r) for r in args.radii.split(',')]
+    args.max_results = [int(k) for k in args.max_results.split(',')]
+    args.cluster_workers = [int(w) for w in args.cluster_workers.split(',')]
+    args.hash_types = args.hash_types.split(',')
+
+    images = corpus(args, args.size, 0)
+    extra = corpus(args, args.updates, 1)
+    queries = random.Random(1).sample(images, min(args.queries, args.size))
+
+    report: Dict[str, Any] = {'meta': metadata(args), 'results': []}
+    for engine in args.engines.split(','):
+        print('benchmarking {}'.format(engine), file=sys.stderr)
+        report['results'] += bench_engine(args, engine, images, queries, extra)
+    if len(args.images) != 0:
+        print('benchmarking hashing', file=sys.stderr)
+        report['results'] += bench_hashing(args)
+
+    data = json.dumps(report, indent=2)
+    if args.out == '-':
+        print(data)
+    else:
+        with open(args.out, 'w') as f:
+            f.write(data + '\n')
+
+    if len(args.compare) != 0:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if not {result_key(r) for r in baseline['results']} & {result_key(r) for r in report['results']}:
+            print('nothing in {} was measured with the same parameters'.format(args.compare), file=sys.stderr)
+        regressions = compare(baseline, report, args.threshold)
+        for line in regressions:
+            print('regression: ' + line, file=sys.stderr)
+        if len(regressions) != 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
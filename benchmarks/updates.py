@@ -0,0 +1,57 @@
+import argparse
+import math
+import random
+import time
+
+from benchmarks.clusters import clustered_images
+from db.db import new_tree
+from vptree import node
+from vptree.stats import SearchStats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='VP-tree shape and query cost under a stream of single updates')
+    parser.add_argument('--initial', default=10000, type=int, help='points in the initial bulk build')
+    parser.add_argument('--updates', default=100000, type=int, help='single-point adds, with one remove per four')
+    parser.add_argument('--rounds', default=5, type=int, help='number of times to report along the way')
+    parser.add_argument('--queries', default=200, type=int)
+    parser.add_argument('--no_rebalance', action='store_true', help='disable partial rebuilds for comparison')
+    args = parser.parse_args()
+
+    if args.no_rebalance:
+        node.REBUILD_CHANGES = math.inf
+
+    images = clustered_images(args.initial + args.updates, 4, 4)
+    tree = new_tree(8)
+    tree.add_list(images[:args.initial])
+    live = list(images[:args.initial])
+    rnd = random.Random(0)
+
+    print('{:>10} {:>10} {:>14} {:>8} {:>10} {:>14} {:>16}'.format(
+        'updates', 'size', 'us/update', 'depth', 'ms/query', 'nodes/query', 'distances/query'))
+    per_round = args.updates // args.rounds
+    for r in range(args.rounds):
+        start = time.perf_counter()
+        batch = images[args.initial + r * per_round:args.initial + (r + 1) * per_round]
+        for i, img in enumerate(batch):
+            tree.add(img)
+            live.append(img)
+            if i % 4 == 3:
+                victim = live.pop(rnd.randrange(len(live)))
+                tree.remove(victim)
+        update_time = time.perf_counter() - start
+
+        stats = SearchStats()
+        queries = rnd.sample(live, min(args.queries, len(live)))
+        start = time.perf_counter()
+        for q in queries:
+            tree.get_within_distance(q, 4, stats)
+        query_time = time.perf_counter() - start
+        nodes, distances = stats.per_query()
+        print('{:>10} {:>10} {:>14.1f} {:>8} {:>10.3f} {:>14.1f} {:>16.1f}'.format(
+            (r + 1) * per_round, tree.root.size(), update_time / len(batch) * 1e6, tree.root.depth(),
+            query_time / len(queries) * 1000, nodes, distances))
+
+
+if __name__ == '__main__':
+    main()
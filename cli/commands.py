@@ -1,177 +1,462 @@
-import functools
+import json
 import os
-from multiprocessing import Pool as ThreadPool
-from typing import Dict, List, Callable
-
-from db.db import DB, decode
-from image import image
-from vptree.vptree import VPTree
+import queue
+import sys
+import tempfile
+import threading
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from cli import scanner
+from db.cache import QueryHasher, ResultCache, open_hash_cache
+from db.checkpoint import Checkpoint
+from db import journal
+from db.db import DB, decode, log_changes, new_tree, open_index
+from db.index import MappedIndex, is_index
+from db.journal import JournaledIndex
+from db.shards import Manifest, ShardedDB, is_manifest, shard_file
+from image import image, pipeline
+from vptree.hooks import NO_HOOKS, Hooks
+from vptree.stats import SearchStats
 
 DEFAULT_HASH_TYPE = 'dhash'
 DEFAULT_HASH_SIZE = 8
 
 
-def walkdir(parent_dir: str, recursive: bool, path_func: Callable[[str], None]):
-    for (dirpath, dirnames, filenames) in os.walk(parent_dir):
-        for f in filenames:
-            path = os.path.abspath(os.path.join(dirpath, f))
-            path_func(path)
-        if recursive:
-            for directory in dirnames:
-                walkdir(directory, recursive, path_func)
+def walkdir(args) -> Iterator[str]:
+    return args.hooks.timed_iter('scan', scanner.scan(args.dir, args.recursive, args.filter, args.follow_symlinks,
+                                                      args.scan_threads))
+
+
+def parse_hash_specs(keys: str) -> List[Tuple[str, int]]:
+    return [image.parse_hash_key(key.strip()) for key in keys.split(',') if len(key.strip()) != 0]
+
+
+def hashed_images(paths: Iterable[str], specs: List[Tuple[str, int]], workers: int, exif_thumbnails: bool = False,
+                  hooks: Hooks = NO_HOOKS) -> Iterator[Tuple[str, Dict[str, int], pipeline.Fingerprint]]:
+    # path, hashes by hash key and fingerprint of every image that could be hashed, failures are reported
+    results = hooks.timed_iter('hash', pipeline.hash_paths(paths, specs, workers, exif_thumbnails))
+    for path, hashes, fingerprint, error in results:
+        if error is not None:
+            hooks.count('files.failed')
+            print('Exception adding file {}. Reason: {}'.format(path, error))
+            continue
+        hooks.count('files.hashed')
+        yield path, hashes, fingerprint
+
+
+def hash_images(paths: Iterable[str], specs: List[Tuple[str, int]], workers: int, exif_thumbnails: bool = False,
+                hooks: Hooks = NO_HOOKS
+                ) -> Tuple[List[image.Image], Dict[str, pipeline.Fingerprint], Dict[str, Dict[str, int]]]:
+    # the first spec is the indexed hash, the others are returned by hash key as extra hashes
+    primary = image.hash_key(*specs[0])
+    imgs = []
+    fingerprints = {}
+    extra_hashes = {image.hash_key(*spec): {} for spec in specs[1:]}
+    for path, hashes, fingerprint in hashed_images(paths, specs, workers, exif_thumbnails, hooks):
+        imgs.append(image.Image.from_hash(path, hashes[primary]))
+        fingerprints[path] = fingerprint
+        for key, extra in extra_hashes.items():
+            extra[path] = hashes[key]
+    return imgs, fingerprints, extra_hashes
 
 
 def init(args):
-    tree = VPTree(distance_fn=image.distance_fn)
-    files = []
-    walkdir(args.dir, args.recursive, lambda path: init_func(path, tree, files, args.hash_type, args.hash_size))
-    db = DB(tree, files, args.hash_type, args.hash_size)
+    # Hashes are streamed to a checkpoint rather than kept until the end, and a run that was interrupted skips
+    # the images its checkpoint already holds. The index is built from the checkpoint in one pass.
+    specs = [(args.hash_type, args.hash_size)] + parse_hash_specs(args.extra_hashes)
+    seen = set()
+    with Checkpoint(args.db, specs, args.exif_thumbnails, args.restart) as checkpoint:
+        if len(checkpoint.hashed) != 0:
+            print('Resuming from {}, {} images already hashed'.format(checkpoint.path, len(checkpoint.hashed)))
+
+        def unhashed_paths() -> Iterator[str]:
+            for path in walkdir(args):
+                seen.add(path)
+                if checkpoint.is_hashed(path):
+                    args.hooks.count('files.resumed')
+                    continue
+                yield path
+
+        for path, hashes, fingerprint in hashed_images(unhashed_paths(), specs, args.workers, args.exif_thumbnails,
+                                                       args.hooks):
+            checkpoint.add(path, hashes, fingerprint)
+        with args.hooks.phase('checkpoint'):
+            files, fingerprints, extra_hashes = checkpoint.load(seen)
+
+    if args.shards > 1:
+        with args.hooks.phase('index'):
+            db = ShardedDB.create(args.db, files, args.hash_type, args.hash_size, fingerprints, extra_hashes,
+                                  args.index, args.shards, args.shard_by)
+    else:
+        tree = new_tree(args.hash_size, args.index, args.hooks)
+        with args.hooks.phase('index'):
+            tree.add_list(files)
+        db = DB(tree, files, args.hash_type, args.hash_size, fingerprints, extra_hashes, args.index)
+    db.set_hooks(args.hooks)
     db.encode(args.db)
+    checkpoint.remove()
+
+
+def load(args, path: Optional[str] = None):
+    with args.hooks.phase('load'):
+        db = decode(path if path is not None else args.db)
+    db.set_hooks(args.hooks)
+    return db
 
 
-def init_func(path, tree: VPTree, files: List[image.Image], hash_type=DEFAULT_HASH_TYPE, hash_size=DEFAULT_HASH_SIZE):
-    try:
-        img = image.Image(path, hash_type, hash_size)
-        tree.add(img)
-        files.append(img)
-    except OSError as e:
-        print('Exception adding file {}. Reason: {}'.format(path, e))
+def stored_specs(db_path: str) -> List[Tuple[str, int]]:
+    if not is_index(db_path):
+        return decode(db_path).hash_specs()
+    with MappedIndex(db_path) as index:
+        return index.hash_specs()
 
 
 def add(args):
-    db = decode(args.db)
-    img = image.Image(args.image, db.hash_type, db.hash_size)
-    db.tree.add(img)
-    db.image_hashes.add(args.image)
-    db.encode(args.db)
+    # logged next to the database file instead of loading and rewriting it
+    path = os.path.abspath(args.image)
+    db_path = shard_file(args.db, path)
+    with args.hooks.phase('load'):
+        specs = stored_specs(db_path)
+    imgs, fingerprints, extra_hashes = hash_images([path], specs, 1, hooks=args.hooks)
+    if len(imgs) == 0:
+        return
+    hashes = {key: extra[path] for key, extra in extra_hashes.items()}
+    hashes[image.hash_key(*specs[0])] = imgs[0].hash
+    with args.hooks.phase('save'):
+        log_changes(db_path, [journal.add_record(imgs[0], hashes, fingerprints[path])])
 
 
 def update(args):
-    db = decode(args.db)
-    walkdir(args.dir, args.recursive,
-            lambda path: update_func(path, db.tree, db.image_hashes, db.hash_type, db.hash_size))
-    db.encode(args.db)
+    db = load(args)
+    seen = set()
+    new = []
+    changed = []
+
+    def stale_paths() -> Iterator[str]:
+        for path in walkdir(args):
+            seen.add(path)
+            try:
+                fingerprint = pipeline.fingerprint(path)
+            except OSError:
+                continue
+            if path not in db.image_hashes:
+                new.append(path)
+                yield path
+            elif not pipeline.same_file(db.fingerprints.get(path), fingerprint, args.check_inode):
+                changed.append(path)
+                yield path
+
+    imgs, fingerprints, extra_hashes = hash_images(stale_paths(), db.hash_specs(), args.workers, args.exif_thumbnails,
+                                                    args.hooks)
+
+    root = os.path.join(os.path.abspath(args.dir), '')
+    removed = [path for path in db.image_hashes
+               if path.startswith(root) and path not in seen and not os.path.exists(path)]
+    with args.hooks.phase('index'):
+        for path in removed:
+            db.remove(path)
+        for img in imgs:
+            db.remove(img.path)
+        db.add(imgs, fingerprints, extra_hashes)
+
+    # files that failed to hash are only counted as failed, a changed one keeps its old entry
+    hashed = {img.path for img in imgs}
+    added = sum(1 for path in new if path in hashed)
+    updated = sum(1 for path in changed if path in hashed)
+    with args.hooks.phase('save'):
+        db.save(args.db)
+    print('added: {} changed: {} removed: {} unchanged: {} failed: {}'.format(
+        added, updated, len(removed), len(seen) - len(new) - len(changed), len(new) + len(changed) - len(imgs)))
+
+
+def query_spec(args, db) -> Tuple[str, int]:
+    hash_type = args.hash_type if len(args.hash_type) != 0 else db.hash_type
+    hash_size = args.hash_size if args.hash_size != 0 else db.hash_size
+    return hash_type, hash_size
 
 
-def update_func(path: str, tree: VPTree, files: Dict[str, int], hash_type=DEFAULT_HASH_TYPE,
-                hash_size=DEFAULT_HASH_SIZE):
-    if path not in files:
-        try:
-            img = image.Image(path, hash_type, hash_size)
-            tree.add(img)
-            files[img.path] = img.hash
-        except OSError as e:
-            print('Exception adding file {}. Reason: {}'.format(path, e))
+def query_image(args, db, spec: Tuple[str, int]) -> image.Image:
+    with args.hooks.phase('hash'):
+        hasher = QueryHasher(db, open_hash_cache(args.db))
+        return image.Image.from_hash(os.path.abspath(args.query), hasher.hash(args.query, spec))
 
 
-def search_by_distance(args):
-    db = decode(args.db)
-    query = image.Image(args.query, db.hash_type, db.hash_size)
-    out = db.tree.get_within_distance(query, args.max_distance)
+def open_tree(args):
+    with args.hooks.phase('load'):
+        db = open_index(args.db, args.workers)
+    spec = query_spec(args, db)
+    return db, spec, db.tree_for(image.hash_key(*spec))
 
-    if len(out) == 0:
-        return
-    for img in out:
-        if os.path.abspath(args.query) == img.path:
+
+def print_matches(query: image.Image, out: List[Tuple[image.Image, int]]):
+    for img, distance in out:
+        if query.path == img.path:
             continue
-        print('path {} distance: {}'.format(img.path, query.distance(img)))
+        print('path {} distance: {}'.format(img.path, distance))
 
 
-def search_nearest(args):
-    db = decode(args.db)
-    query = image.Image(args.query, db.hash_type, db.hash_size)
-    out = db.tree.get_nearest_neighbours(query, args.num_neighbours, args.max_results)
+def run_search(args, db, spec: Tuple[str, int],
+               search_fn: Callable[[image.Image, SearchStats], List[Tuple[image.Image, int]]]):
+    stats = SearchStats()
 
-    if len(out) == 0:
-        return
-    for img in out:
-        if os.path.abspath(args.query) == img.path:
-            continue
-        print('path {} distance: {}'.format(img.path, query.distance(img)))
+    def search(query: image.Image) -> List[Tuple[image.Image, int]]:
+        with args.hooks.phase('search'):
+            return search_fn(query, stats)
 
+    if args.batch:
+        search_batch(args, db, spec, search)
+    else:
+        query = query_image(args, db, spec)
+        print_matches(query, search(query))
+    args.hooks.searched(stats)
 
-def remove(args):
-    db = decode(args.db)
-    path = os.path.abspath(args.image)
-    img = image.Image(path, db.hash_type, db.hash_size)
 
-    if path in db.image_hashes:
-        if db.tree.remove(img):
-            del db.image_hashes[path]
-            db.encode(args.db)
-        else:
-            raise ValueError('path is in dict but not in tree')
+def search_by_distance(args):
+    db, spec, tree = open_tree(args)
+    run_search(args, db, spec, lambda query, stats: tree.get_within_distance_pairs(query, args.max_distance, stats))
 
 
-def rebuild(args):
-    db = decode(args.db)
-    hash_size = args.hash_size if args.hash_size != 0 else db.hash_size
-    hash_type = args.hash_type if len(args.hash_type) != 0 else db.hash_type
-
-    imgs = []
-    files = []
+def search_nearest(args):
+    db, spec, tree = open_tree(args)
+    run_search(args, db, spec, lambda query, stats: tree.get_nearest_neighbour_pairs(
+        query, args.num_neighbours, args.max_results, args.max_distance, stats))
 
-    for path in db.image_hashes:
-        img = image.Image(path, hash_type, hash_size)
-        imgs.append(img)
-        files.append(img)
 
-    tree = VPTree(distance_fn=image.distance_fn)
-    tree.add_list(imgs)
-    db = DB(tree, files, hash_type, hash_size)
-    db.encode(args.db)
+def query_paths(source: str) -> Iterator[str]:
+    if source == '-':
+        lines = sys.stdin
+    elif os.path.isdir(source):
+        yield from scanner.scan(source)
+        return
+    else:
+        lines = open(source)
 
+    with lines:
+        for line in lines:
+            line = line.strip()
+            if len(line) != 0:
+                yield os.path.abspath(line)
 
-def clusters(args):
-    db = decode(args.db)
 
-    imgs = list(db.images)
-    batches = imgs if args.num_threads == 1 else _split(imgs, args.num_threads)
+def search_batch(args, db, spec: Tuple[str, int],
+                 search_fn: Callable[[image.Image], List[Tuple[image.Image, int]]]):
+    key = image.hash_key(*spec)
+    hasher = QueryHasher(db, open_hash_cache(args.db))
+    results = ResultCache()
 
-    pool = ThreadPool(args.num_threads)
-    batch_clusters = pool.map(functools.partial(_get_neighbours, db.tree, args.num_neighbours, args.min_distance),
-                              batches)
-    pool.close()
-    pool.join()
+    def lookup(path: str) -> Optional[pipeline.HashResult]:
+        # the hash stored in the database or the hash cache, or why the file cannot be read, None if it has to be
+        # hashed
+        try:
+            fingerprint = pipeline.fingerprint(path)
+        except OSError as e:
+            return path, None, None, str(e)
+        h = hasher.lookup(path, key, fingerprint)
+        return None if h is None else (path, {key: h}, fingerprint, None)
+
+    def serial_results() -> Iterator[Tuple[pipeline.HashResult, bool]]:
+        # each query is answered before the next one is read
+        for path in query_paths(args.query):
+            result = lookup(path)
+            if result is not None:
+                yield result, False
+                continue
+            with args.hooks.phase('hash'):
+                result = pipeline.hash_file([spec], False, path)
+            yield result, True
+
+    def pooled_results() -> Iterator[Tuple[pipeline.HashResult, bool]]:
+        # lookups run on the pool's task thread as it reads the queries, and hashed results are forwarded by
+        # another thread, so known queries do not wait for the next image the pool finishes
+        ready: queue.Queue = queue.Queue()
+
+        def unknown_paths() -> Iterator[str]:
+            for path in query_paths(args.query):
+                result = lookup(path)
+                if result is None:
+                    yield path
+                else:
+                    ready.put((result, False))
+
+        def forward():
+            try:
+                for result in args.hooks.timed_iter('hash', pipeline.hash_paths(unknown_paths(), [spec],
+                                                                                args.workers)):
+                    ready.put((result, True))
+                # the pool has read every query by now, so every known one is queued before this
+                ready.put(None)
+            except BaseException as e:
+                ready.put(e)
+
+        thread = threading.Thread(target=forward, daemon=True)
+        thread.start()
+        while True:
+            item = ready.get()
+            if item is None:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+        thread.join()
+
+    def print_result(result: pipeline.HashResult):
+        path, hashes, _, error = result
+        if error is not None:
+            print(json.dumps({'path': path, 'error': error}))
+            sys.stdout.flush()
+            return
+        query = image.Image.from_hash(path, hashes[key])
+        out = results.get(query.hash)
+        if out is None:
+            out = search_fn(query)
+            results.put(query.hash, out)
+        for img, distance in out:
+            if img.path == path:
+                continue
+            print(json.dumps({'path': path, 'match': img.path, 'distance': distance}))
+        sys.stdout.flush()
+
+    computed = []
+    for result, hashed in serial_results() if args.workers <= 1 else pooled_results():
+        path, hashes, fingerprint, error = result
+        if hashed and error is None:
+            args.hooks.count('files.hashed')
+            computed.append((fingerprint, key, hashes[key]))
+        elif hashed:
+            args.hooks.count('files.failed')
+        print_result(result)
+    if hasher.cache is not None:
+        hasher.cache.put_many(computed)
 
-    clusters_list = [item for sublist in batch_clusters for item in sublist]
 
-    clusters = {}
-    for i in range(0, len(imgs)):
-        if len(clusters_list[i]) != 0:
-            clusters[imgs[i].path] = clusters_list[i]
+def remove(args):
+    path = os.path.abspath(args.image)
+    db_path = shard_file(args.db, path)
+    with args.hooks.phase('load'):
+        if not is_index(db_path):
+            found = path in decode(db_path).image_hashes
+        else:
+            with JournaledIndex(db_path) as index:
+                found = index.contains(path)
+    if found:
+        with args.hooks.phase('save'):
+            log_changes(db_path, [journal.remove_record(path)])
 
-    for img_path, nearest in clusters.items():
-        print('image: {}'.format(img_path))
-        print('\tpath\tdistance')
-        for n in nearest:
-            print('\t{}\t{}'.format(n[0], n[1]))
-        print()
 
+def rebuild(args):
+    if not is_manifest(args.db):
+        rebuild_file(args, args.db)
+        return
 
-def _get_neighbours(tree: VPTree, num_neighbours: int, min_distance: int, img_batch: List[image.Image]):
-    result = []
-    for img in img_batch:
-        neighbours = tree.get_nearest_neighbours(img, num_neighbours)
-        l = []
-        for n in neighbours:
-            dist = img.distance(n)
-            if n.path == img.path or dist > min_distance:
-                continue
-            l.append((n.path, dist))
+    manifest = Manifest.read(args.db)
+    if args.shard < 0:
+        paths = manifest.shards
+    elif args.shard < len(manifest.shards):
+        # every shard has to index and store the same hashes, queries and updates assume that of all of them
+        if len(args.hash_type) != 0 or args.hash_size != 0 or len(args.index) != 0 or len(args.extra_hashes) != 0:
+            raise ValueError('--hash_type, --hash_size, --index and --extra_hashes apply to every shard, '
+                             'not a single one')
+        paths = [manifest.shards[args.shard]]
+    else:
+        raise ValueError('shard {} out of range, the database has {} shards'.format(args.shard,
+                                                                                   len(manifest.shards)))
+    for path in paths:
+        rebuild_file(args, path)
+    # rewritten so readers watching the database notice the change
+    manifest.write(args.db)
+
+
+def rebuild_file(args, path: str):
+    db = load(args, path)
+    hash_size = args.hash_size if args.hash_size != 0 else db.hash_size
+    hash_type = args.hash_type if len(args.hash_type) != 0 else db.hash_type
 
-        result.append(l)
+    key = image.hash_key(hash_type, hash_size)
+    new_specs = parse_hash_specs(args.extra_hashes)
 
-    return result
+    if len(args.index) != 0 and args.index != db.engine:
+        # switching only the index engine keeps every stored hash
+        if len(new_specs) == 0 and len(args.hash_type) == 0 and args.hash_size == 0:
+            db.set_engine(args.index)
+            db.encode(path)
+            return
+        db.engine = args.index
 
+    # switching to an already stored hash type needs no image I/O
+    if len(new_specs) == 0 and key != image.hash_key(db.hash_type, db.hash_size) and db.reindex(hash_type, hash_size):
+        db.encode(path)
+        return
 
-def _split(seq: List, num_chunks: int):
-    avg = len(seq) / float(num_chunks)
-    out = []
-    last = 0.0
+    stored = dict(db.extra_hashes)
+    stored[image.hash_key(db.hash_type, db.hash_size)] = db.image_hashes
+    if key == image.hash_key(db.hash_type, db.hash_size):
+        # rebuilding with the same hash rehashes everything that is stored
+        new_specs += [image.parse_hash_key(k) for k in stored if k != key]
+    specs = [(hash_type, hash_size)] + [spec for spec in new_specs if spec != (hash_type, hash_size)]
+
+    imgs, fingerprints, extra_hashes = hash_images(db.image_hashes, specs, args.workers, args.exif_thumbnails,
+                                                    args.hooks)
+    # stored hashes that are not recomputed are carried over, except for files that changed since
+    carried = [k for k in stored if k != key and k not in extra_hashes]
+    changed = [p for p, fingerprint in fingerprints.items()
+               if not pipeline.same_file(db.fingerprints.get(p), fingerprint)]
+    refreshed = {}
+    if len(carried) != 0 and len(changed) != 0:
+        carried_specs = [image.parse_hash_key(k) for k in carried]
+        for p, hashes, fingerprint in hashed_images(changed, carried_specs, args.workers, args.exif_thumbnails,
+                                                    args.hooks):
+            if pipeline.same_file(fingerprints[p], fingerprint):
+                refreshed[p] = hashes
+        # a file that cannot be hashed again, or changed once more in between, is left out like a failure
+        dropped = set(changed) - set(refreshed)
+        imgs = [img for img in imgs if img.path not in dropped]
+        for p in dropped:
+            del fingerprints[p]
+            for hashes in extra_hashes.values():
+                hashes.pop(p, None)
+    for k in carried:
+        extra_hashes[k] = {p: refreshed[p][k] if p in refreshed else stored[k][p] for p in fingerprints}
+
+    tree = new_tree(hash_size, db.engine, args.hooks)
+    with args.hooks.phase('index'):
+        tree.add_list(imgs)
+    db = DB(tree, imgs, hash_type, hash_size, fingerprints, extra_hashes, db.engine)
+    db.set_hooks(args.hooks)
+    db.encode(path)
+
+
+def migrate(args):
+    db = load(args)
+    db.encode(args.out if len(args.out) != 0 else args.db)
+
+
+def compact(args):
+    # folds the logged changes into the index files
+    load(args).encode(args.db)
 
-    while last < len(seq):
-        out.append(seq[int(last):int(last + avg)])
-        last += avg
 
-    return out
+def clusters(args):
+    from db.clusters import find_groups
+    if is_index(args.db) and len(journal.read(args.db)) == 0:
+        with args.hooks.phase('clusters'):
+            groups = find_groups(args.db, args.min_distance, args.num_threads)
+    else:
+        # workers map a single index file, so a sharded or pickled database, or one with logged changes, is
+        # converted to a temporary one first
+        with tempfile.TemporaryDirectory() as tmp:
+            index_path = os.path.join(tmp, 'index')
+            db = load(args)
+            if isinstance(db, ShardedDB):
+                db = db.merged()
+                db.set_hooks(args.hooks)
+            db.encode(index_path)
+            with args.hooks.phase('clusters'):
+                groups = find_groups(index_path, args.min_distance, args.num_threads)
+    args.hooks.count('clusters.groups', len(groups))
+
+    groups.sort(key=len, reverse=True)
+    for i, group in enumerate(groups):
+        print('group {} ({} images)'.format(i + 1, len(group)))
+        for path in group:
+            print('\t{}'.format(path))
+        print()
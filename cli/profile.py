@@ -0,0 +1,65 @@
+import sys
+import time
+from typing import Dict, List, Optional, TextIO
+
+from vptree.hooks import Hooks
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak memory is left out of the report there
+    resource = None
+
+# counters that are reported as a rate over the whole run
+RATES = {'files.hashed': 'files/s'}
+
+
+def peak_memory_mb() -> Optional[float]:
+    # largest resident set of this process and of the largest finished worker process; ru_maxrss is in KiB on
+    # Linux and bytes on macOS
+    if resource is None:
+        return None
+    scale = 1 if sys.platform == 'darwin' else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return max(own, children) / (1 << 20)
+
+
+class Profile(Hooks):
+    # Collects what commands, DB and VPTree report, for --stats. Phases may overlap: hashing runs while the
+    # directory walk is still producing files.
+    timings: Dict[str, float]
+    calls: Dict[str, int]
+    counters: Dict[str, int]
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.timings = {}
+        self.calls = {}
+        self.counters = {}
+
+    def timing(self, name: str, seconds: float):
+        self.timings[name] = self.timings.get(name, 0.0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + 1
+
+    def count(self, name: str, value: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def lines(self) -> List[str]:
+        total = time.perf_counter() - self.start
+        lines = ['{:<24} {:>10} {:>8} {:>10}'.format('phase', 'time (s)', 'share', 'calls')]
+        for name, seconds in self.timings.items():
+            lines.append('{:<24} {:>10.3f} {:>7.1%} {:>10}'.format(name, seconds, seconds / total, self.calls[name]))
+        lines.append('{:<24} {:>10.3f}'.format('total', total))
+        for name, value in sorted(self.counters.items()):
+            lines.append('{:<24} {:>10}'.format(name, value))
+            if name in RATES:
+                lines.append('{:<24} {:>10.1f}'.format(RATES[name], value / total))
+        memory = peak_memory_mb()
+        if memory is not None:
+            lines.append('{:<24} {:>10.1f}'.format('peak memory (MiB)', memory))
+        return lines
+
+    def report(self, out: TextIO = sys.stderr):
+        for line in self.lines():
+            print(line, file=out)
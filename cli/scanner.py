@@ -0,0 +1,97 @@
+import os
+from typing import TYPE_CHECKING, Iterator, List, Set, Tuple
+
+if TYPE_CHECKING:
+    from concurrent.futures import Future
+
+IMAGE_EXTENSIONS = {
+    '.bmp', '.dib', '.gif', '.ico', '.jfif', '.jpe', '.jpeg', '.jpg', '.pbm', '.pgm', '.png', '.pnm', '.ppm',
+    '.tga', '.tif', '.tiff', '.webp',
+}
+MAGIC_NUMBERS = [
+    b'\xff\xd8\xff',  # JPEG
+    b'\x89PNG\r\n\x1a\n',
+    b'GIF87a',
+    b'GIF89a',
+    b'BM',
+    b'II*\x00',  # little-endian TIFF
+    b'MM\x00*',  # big-endian TIFF
+    b'\x00\x00\x01\x00',  # ICO
+    b'P1', b'P2', b'P3', b'P4', b'P5', b'P6',  # netpbm
+]
+MAGIC_LENGTH = 12
+
+FILTERS = ['extension', 'magic', 'none']
+
+DirKey = Tuple[int, int]
+
+
+def has_image_extension(path: str) -> bool:
+    return os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS
+
+
+def has_image_magic(path: str) -> bool:
+    try:
+        with open(path, 'rb') as f:
+            head = f.read(MAGIC_LENGTH)
+    except OSError:
+        return False
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return True
+    return any(head.startswith(magic) for magic in MAGIC_NUMBERS)
+
+
+def _dir_key(path: str) -> DirKey:
+    st = os.stat(path)
+    return st.st_dev, st.st_ino
+
+
+def _scan_dir(path: str, file_filter: str, follow_symlinks: bool) -> Tuple[List[str], List[Tuple[str, DirKey]]]:
+    files = []
+    dirs = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=follow_symlinks):
+                        st = entry.stat(follow_symlinks=follow_symlinks)
+                        dirs.append((entry.path, (st.st_dev, st.st_ino)))
+                    elif entry.is_file():
+                        if file_filter == 'extension' and not has_image_extension(entry.name):
+                            continue
+                        if file_filter == 'magic' and not has_image_magic(entry.path):
+                            continue
+                        files.append(entry.path)
+                except OSError:
+                    continue
+    except OSError as e:
+        print('Exception scanning directory {}. Reason: {}'.format(path, e))
+    return files, dirs
+
+
+def scan(parent_dir: str, recursive: bool = True, file_filter: str = 'extension', follow_symlinks: bool = False,
+         threads: int = 4) -> Iterator[str]:
+    # Directories are listed concurrently and files are yielded as soon as their directory has been read,
+    # so hashing can start before the walk is over. Every directory is visited once, identified by its
+    # (device, inode), which also stops symlink loops.
+    if file_filter not in FILTERS:
+        raise ValueError('invalid file filter {}'.format(file_filter))
+    # imported here so the command line parser, which reads FILTERS, stays cheap to load
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+    root = os.path.abspath(parent_dir)
+    visited: Set[DirKey] = {_dir_key(root)}
+    with ThreadPoolExecutor(max(1, threads)) as executor:
+        pending: Set['Future'] = {executor.submit(_scan_dir, root, file_filter, follow_symlinks)}
+        while len(pending) != 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, dirs = future.result()
+                yield from files
+                if not recursive:
+                    continue
+                for path, key in dirs:
+                    if key in visited:
+                        continue
+                    visited.add(key)
+                    pending.add(executor.submit(_scan_dir, path, file_filter, follow_symlinks))
@@ -0,0 +1,261 @@
+import json
+import os
+import socketserver
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Deque, Dict, Iterator, List, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from db.cache import QueryHasher, ResultCache, open_hash_cache
+from db.db import database_files, open_index
+from image import image, pipeline
+
+LATENCY_WINDOW = 10000
+
+
+class LatencyStats:
+    latencies: Dict[str, Deque[float]]
+    counts: Dict[str, int]
+    errors: Dict[str, int]
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self.window = window
+        self.latencies = {}
+        self.counts = {}
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    def record(self, endpoint: str, seconds: float, failed: bool = False):
+        with self.lock:
+            if endpoint not in self.latencies:
+                self.latencies[endpoint] = deque(maxlen=self.window)
+                self.counts[endpoint] = 0
+                self.errors[endpoint] = 0
+            self.latencies[endpoint].append(seconds)
+            self.counts[endpoint] += 1
+            if failed:
+                self.errors[endpoint] += 1
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        with self.lock:
+            result = {}
+            for endpoint, latencies in self.latencies.items():
+                ordered = sorted(latencies)
+                result[endpoint] = {
+                    'requests': self.counts[endpoint],
+                    'errors': self.errors[endpoint],
+                    'p50_ms': _percentile(ordered, 0.50) * 1000,
+                    'p99_ms': _percentile(ordered, 0.99) * 1000,
+                }
+            return result
+
+
+def _percentile(ordered: List[float], q: float) -> float:
+    if len(ordered) == 0:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def db_fingerprint(db_path: str) -> Tuple[pipeline.Fingerprint, ...]:
+    # covers the shards and logs too, which change without the database file itself
+    fingerprints = []
+    for path in database_files(db_path):
+        try:
+            fingerprints.append(pipeline.fingerprint(path))
+        except FileNotFoundError:
+            # a log removed by a concurrent compaction
+            continue
+    return tuple(fingerprints)
+
+
+class OpenIndex:
+    # An opened database and the queries running on it. Once a newer one replaces it, it is closed by whichever
+    # of them finishes last, since the mapped index and its tree refer to each other and would otherwise keep
+    # the mapping and file open until the cyclic garbage collector runs.
+    def __init__(self, db, hasher: QueryHasher, generation: int):
+        self.db = db
+        self.hasher = hasher
+        self.generation = generation
+        self.users = 0
+        self.retired = False
+
+    def close(self):
+        # pickled databases are plain objects with nothing to close
+        close = getattr(self.db, 'close', None)
+        if close is not None:
+            close()
+
+
+class QueryService:
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        db = open_index(db_path)
+        self.current = OpenIndex(db, QueryHasher(db, open_hash_cache(db_path)), 0)
+        self.db_fingerprint = db_fingerprint(db_path)
+        self.results = ResultCache()
+        self.stats = LatencyStats()
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        # reopens the database and drops cached results once it has been rewritten or logged to
+        fingerprint = db_fingerprint(self.db_path)
+        if fingerprint == self.db_fingerprint:
+            return
+        with self.lock:
+            if fingerprint == self.db_fingerprint:
+                return
+            old = self.current
+            db = open_index(self.db_path)
+            self.current = OpenIndex(db, QueryHasher(db, old.hasher.cache), old.generation + 1)
+            self.results.clear()
+            self.db_fingerprint = fingerprint
+            old.retired = True
+            unused = old.users == 0
+        if unused:
+            old.close()
+
+    @contextmanager
+    def acquire(self) -> Iterator[OpenIndex]:
+        # the current index, kept open until the caller is done with it
+        self.refresh()
+        with self.lock:
+            index = self.current
+            index.users += 1
+        try:
+            yield index
+        finally:
+            with self.lock:
+                index.users -= 1
+                unused = index.retired and index.users == 0
+            if unused:
+                index.close()
+
+    def query_image(self, index: OpenIndex, params: Dict[str, str]) -> image.Image:
+        if 'hash' in params:
+            return image.Image.from_hash('', int(params['hash'], 16))
+        if 'path' in params:
+            path = os.path.abspath(params['path'])
+            return image.Image.from_hash(path, index.hasher.hash(path, (index.db.hash_type, index.db.hash_size)))
+        raise ValueError('either path or hash is required')
+
+    def _cached(self, index: OpenIndex, key: Tuple, query: Callable[[], List[Tuple[image.Image, int]]]
+                ) -> List[Tuple[image.Image, int]]:
+        # keys carry the index generation, so a query that raced with a reload cannot serve its result from
+        # the newer index; it is not even stored once its index has been replaced
+        key = (index.generation,) + key
+        out = self.results.get(key)
+        if out is None:
+            out = query()
+            if not index.retired:
+                self.results.put(key, out)
+        return out
+
+    def search(self, params: Dict[str, str]) -> List[Dict[str, Any]]:
+        with self.acquire() as index:
+            query = self.query_image(index, params)
+            max_distance = int(params.get('max_distance', 3))
+            out = self._cached(index, ('search', query.hash, max_distance),
+                               lambda: index.db.tree.get_within_distance_pairs(query, max_distance))
+        return _results(query, out)
+
+    def nearest(self, params: Dict[str, str]) -> List[Dict[str, Any]]:
+        with self.acquire() as index:
+            query = self.query_image(index, params)
+            num_neighbours = int(params.get('num_neighbours', 3))
+            max_results = int(params.get('max_results', 16))
+            max_distance = int(params['max_distance']) if 'max_distance' in params else None
+            out = self._cached(
+                index, ('nearest', query.hash, num_neighbours, max_results, max_distance),
+                lambda: index.db.tree.get_nearest_neighbour_pairs(query, num_neighbours, max_results, max_distance))
+        return _results(query, out)
+
+
+def _results(query: image.Image, out: List[Tuple[image.Image, int]]) -> List[Dict[str, Any]]:
+    return [{'path': img.path, 'distance': distance} for img, distance in out if img.path != query.path]
+
+
+class Handler(BaseHTTPRequestHandler):
+    server: Any
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        self._handle(url.path, params)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            params = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self._reply(400, {'error': 'invalid JSON body'})
+            return
+        self._handle(urlparse(self.path).path, {k: str(v) for k, v in params.items()})
+
+    def _handle(self, endpoint: str, params: Dict[str, str]):
+        service = self.server.service
+        if endpoint == '/stats':
+            self._reply(200, service.stats.summary())
+            return
+
+        handlers = {'/search': service.search, '/nearest': service.nearest}
+        if endpoint not in handlers:
+            self._reply(404, {'error': 'unknown endpoint {}'.format(endpoint)})
+            return
+
+        start = time.perf_counter()
+        status, body = _call(handlers[endpoint], params)
+        service.stats.record(endpoint, time.perf_counter() - start, status != 200)
+        self._reply(status, body)
+
+    def _reply(self, status: int, body: Any):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _call(handler, params: Dict[str, str]) -> Tuple[int, Any]:
+    try:
+        return 200, {'results': handler(params)}
+    except (ValueError, OSError) as e:
+        return 400, {'error': str(e)}
+
+
+class UnixHTTPServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler expects an (host, port) client address
+        return request, ('local', 0)
+
+
+def serve(args):
+    service = QueryService(args.db)
+    if len(args.socket) != 0:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = UnixHTTPServer(args.socket, Handler)
+        print('serving {} on {}'.format(args.db, args.socket))
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), Handler)
+        print('serving {} on http://{}:{}'.format(args.db, args.host, args.port))
+    server.service = service
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for endpoint, summary in service.stats.summary().items():
+            print('{} requests: {} errors: {} p50: {:.2f}ms p99: {:.2f}ms'.format(
+                endpoint, summary['requests'], summary['errors'], summary['p50_ms'], summary['p99_ms']))
@@ -0,0 +1,151 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import numpy
+from PIL import Image as PILImage
+
+from db.db import decode
+from image import image
+
+MAIN = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'main.py')
+
+
+class CommandTest(unittest.TestCase):
+    # a database of two identical images, a different one and a file that cannot be decoded
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.images = os.path.join(self.tmp.name, 'images')
+        os.mkdir(self.images)
+        gradient = numpy.linspace(0, 255, 64 * 64).reshape(64, 64).astype('uint8')
+        for name, pixels in [('a.png', gradient), ('a_copy.png', gradient), ('b.png', gradient.T[::-1])]:
+            PILImage.fromarray(pixels).convert('RGB').save(self.path(name))
+        with open(self.path('broken.png'), 'wb') as f:
+            f.write(b'not an image')
+        self.db = os.path.join(self.tmp.name, 'db')
+        self.run_main('init', '--dir', self.images, '--workers', '1')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.images, name)
+
+    def run_main(self, *args: str, stdin: str = '') -> str:
+        return subprocess.run([sys.executable, MAIN, '--db', self.db] + list(args), input=stdin, text=True,
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+
+
+class TestBatchSearch(CommandTest):
+    def batch(self, command: str, source: str, stdin: str = '', *args: str):
+        lines = self.run_main(command, source, '--batch', '--workers', '1', *args, stdin=stdin).splitlines()
+        return sorted((json.loads(line) for line in lines), key=lambda r: (r['path'], r.get('match', '')))
+
+    def expected(self, broken: str):
+        return [
+            {'path': self.path('a.png'), 'match': self.path('a_copy.png'), 'distance': 0},
+            {'path': self.path('a_copy.png'), 'match': self.path('a.png'), 'distance': 0},
+            {'path': broken, 'error': mock.ANY},
+        ]
+
+    def test_directory(self):
+        results = self.batch('search', self.images, '', '--max_distance', '0')
+        self.assertEqual(self.expected(self.path('broken.png')), results)
+        self.assertTrue(all(isinstance(r['error'], str) for r in results if 'error' in r))
+
+    def test_list_file(self):
+        # a listed file that does not exist is reported like one that cannot be decoded, later ones still run
+        listing = os.path.join(self.tmp.name, 'queries.txt')
+        missing = os.path.join(self.tmp.name, 'missing.png')
+        with open(listing, 'w') as f:
+            f.write('{}\n\n{}\n{}\n'.format(missing, self.path('a.png'), self.path('a_copy.png')))
+        self.assertEqual(self.expected(missing), self.batch('search', listing, '', '--max_distance', '0'))
+
+    def test_stdin(self):
+        stdin = '\n'.join(self.path(name) for name in ['broken.png', 'a.png', 'a_copy.png']) + '\n'
+        results = self.batch('nearest', '-', stdin, '--num_neighbours', '2', '--max_distance', '0')
+        self.assertEqual(self.expected(self.path('broken.png')), results)
+
+    def test_streaming(self):
+        # a query whose hash is stored is answered while the next one is not even written yet
+        for workers in ['1', '2']:
+            command = [sys.executable, MAIN, '--db', self.db, 'search', '-', '--batch', '--workers', workers,
+                       '--max_distance', '0']
+            with subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                  text=True) as proc:
+                timeout = threading.Timer(30, proc.kill)
+                timeout.start()
+                proc.stdin.write(self.path('a.png') + '\n')
+                proc.stdin.flush()
+                first = proc.stdout.readline()
+                timeout.cancel()
+                proc.stdin.write(self.path('b.png') + '\n')
+                proc.stdin.close()
+                self.assertEqual('', proc.stdout.read())
+            self.assertEqual({'path': self.path('a.png'), 'match': self.path('a_copy.png'), 'distance': 0},
+                             json.loads(first))
+            self.assertEqual(0, proc.returncode)
+
+
+class TestUpdate(CommandTest):
+    def test_counts(self):
+        # one new image, and three failures: the file init could not hash is new again, one more that cannot be
+        # decoded and one image that changed into something that cannot be
+        PILImage.new('RGB', (32, 32), 'red').save(self.path('c.png'))
+        with open(self.path('broken2.png'), 'wb') as f:
+            f.write(b'still not an image')
+        with open(self.path('b.png'), 'wb') as f:
+            f.write(b'no longer an image')
+        out = self.run_main('update', '--dir', self.images, '--workers', '1')
+        self.assertIn('added: 1 changed: 0 removed: 0 unchanged: 2 failed: 3', out)
+
+
+class TestRebuild(CommandTest):
+    def test_changed_file_extra_hashes(self):
+        self.run_main('rebuild', '--extra_hashes', 'phash_8', '--workers', '1')
+        # a.png changes, then the indexed hash changes while phash is carried over from the database
+        PILImage.new('RGB', (64, 64), 'blue').save(self.path('a.png'))
+        self.run_main('rebuild', '--hash_type', 'ahash', '--workers', '1')
+        db = decode(self.db)
+        self.assertEqual('ahash', db.hash_type)
+        for name in ['a.png', 'a_copy.png', 'b.png']:
+            self.assertEqual(image.get_hash(self.path(name), 'phash'), db.extra_hashes['phash_8'][self.path(name)])
+
+    def test_single_shard(self):
+        self.db = os.path.join(self.tmp.name, 'sharded')
+        self.run_main('init', '--dir', self.images, '--workers', '1', '--shards', '2')
+        # shards storing different extra hashes could not be updated or queried by them together
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.run_main('rebuild', '--shard', '1', '--extra_hashes', 'phash_8', '--workers', '1')
+        self.run_main('rebuild', '--extra_hashes', 'phash_8', '--workers', '1')
+        for shard in ['.0', '.1']:
+            self.assertEqual(['phash_8'], list(decode(self.db + shard).extra_hashes))
+        self.run_main('rebuild', '--shard', '1', '--workers', '1')
+        self.assertEqual(['phash_8'], list(decode(self.db + '.1').extra_hashes))
+
+
+class TestLazyImports(unittest.TestCase):
+    def test_query_modules(self):
+        # querying stored hashes goes through these modules and should not pay for loading the hashing libraries
+        code = 'import sys, cli.commands, db.db; print(" ".join(sorted(sys.modules)))'
+        modules = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(MAIN), stdout=subprocess.PIPE,
+                                 text=True, check=True).stdout.split()
+        for name in ['PIL', 'imagehash', 'scipy', 'multiprocessing']:
+            self.assertNotIn(name, modules)
+
+    def test_help(self):
+        # parsing arguments imports none of the command modules
+        stderr = subprocess.run([sys.executable, '-X', 'importtime', MAIN, '--help'], stdout=subprocess.DEVNULL,
+                                stderr=subprocess.PIPE, text=True, check=True).stderr
+        modules = {line.split('|')[-1].strip() for line in stderr.splitlines() if line.startswith('import time:')}
+        for name in ['numpy', 'cli.commands', 'db.db']:
+            self.assertNotIn(name, modules)
+
+
+if __name__ == '__main__':
+    unittest.main()
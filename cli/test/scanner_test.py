@@ -0,0 +1,62 @@
+import os
+import tempfile
+import unittest
+
+from cli import scanner
+
+JPEG_HEADER = b'\xff\xd8\xff\xe0\x00\x10JFIF\x00'
+
+
+def touch(path: str, data: bytes = b''):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+class TestScanner(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name
+        os.makedirs(os.path.join(self.root, 'a', 'b'))
+        touch(os.path.join(self.root, 'top.jpg'), JPEG_HEADER)
+        touch(os.path.join(self.root, 'notes.txt'), b'text')
+        touch(os.path.join(self.root, 'a', 'photo.PNG'), b'\x89PNG\r\n\x1a\n')
+        touch(os.path.join(self.root, 'a', 'b', 'no_extension'), JPEG_HEADER)
+        # a loop back to the root
+        os.symlink(self.root, os.path.join(self.root, 'a', 'b', 'loop'))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def relative(self, paths):
+        return sorted(os.path.relpath(p, self.root) for p in paths)
+
+    def test_extension_filter(self):
+        self.assertEqual(['a/photo.PNG', 'top.jpg'], self.relative(scanner.scan(self.root)))
+
+    def test_magic_filter(self):
+        self.assertEqual(['a/b/no_extension', 'a/photo.PNG', 'top.jpg'],
+                         self.relative(scanner.scan(self.root, file_filter='magic')))
+
+    def test_no_filter(self):
+        self.assertEqual(['a/b/no_extension', 'a/photo.PNG', 'notes.txt', 'top.jpg'],
+                         self.relative(scanner.scan(self.root, file_filter='none')))
+
+    def test_not_recursive(self):
+        self.assertEqual(['top.jpg'], self.relative(scanner.scan(self.root, recursive=False)))
+
+    def test_symlink_loop(self):
+        paths = self.relative(scanner.scan(self.root, follow_symlinks=True, threads=2))
+        self.assertEqual(['a/photo.PNG', 'top.jpg'], paths)
+
+    def test_relative_dir(self):
+        cwd = os.getcwd()
+        os.chdir(self.root)
+        try:
+            paths = list(scanner.scan('a'))
+        finally:
+            os.chdir(cwd)
+        self.assertEqual([os.path.join(self.root, 'a', 'photo.PNG')], paths)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+import numpy
+from PIL import Image as PILImage
+
+from cli.server import Handler, LatencyStats, QueryService, _percentile
+from db import journal
+from db.db import log_changes
+from db.test.index_test import create_test_db
+from image import image
+from image.image import Image
+
+
+class TestLatencyStats(unittest.TestCase):
+    def test_percentile(self):
+        self.assertEqual(0.0, _percentile([], 0.5))
+        ordered = [float(i) for i in range(1, 101)]
+        self.assertEqual(51.0, _percentile(ordered, 0.50))
+        self.assertEqual(100.0, _percentile(ordered, 0.99))
+        self.assertEqual(7.0, _percentile([7.0], 0.99))
+
+    def test_summary(self):
+        stats = LatencyStats(window=100)
+        for i in range(200):
+            stats.record('/search', (i % 100 + 1) / 1000, failed=i == 0)
+        stats.record('/nearest', 0.002)
+        summary = stats.summary()
+        self.assertEqual({'/search', '/nearest'}, set(summary))
+        self.assertEqual(200, summary['/search']['requests'])
+        self.assertEqual(1, summary['/search']['errors'])
+        self.assertAlmostEqual(51.0, summary['/search']['p50_ms'])
+        self.assertAlmostEqual(100.0, summary['/search']['p99_ms'])
+        self.assertAlmostEqual(2.0, summary['/nearest']['p99_ms'])
+
+
+class TestQueryService(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'db')
+        self.db = create_test_db(200)
+        self.db.encode(self.path)
+        self.service = QueryService(self.path)
+
+    def tearDown(self):
+        self.service.current.close()
+        self.dir.cleanup()
+
+    def log_add(self, path: str, h: int):
+        log_changes(self.path, [journal.add_record(Image.from_hash(path, h), {'dhash_8': h}, None)])
+
+    def test_queries_by_hash(self):
+        h = self.db.image_hashes['/images/0.jpg']
+        query = Image.from_hash('', h)
+        params = {'hash': '{:x}'.format(h), 'max_distance': '10'}
+        expected = sorted((img.path, d) for img, d in self.db.tree.get_within_distance_pairs(query, 10))
+        self.assertEqual(expected, sorted((r['path'], r['distance']) for r in self.service.search(params)))
+        # cached the second time
+        self.assertEqual(self.service.search(params), self.service.search(params))
+        self.assertEqual(2, self.service.results.hits)
+
+        nearest = self.service.nearest({'hash': '{:x}'.format(h), 'num_neighbours': '5'})
+        self.assertEqual({'path': '/images/0.jpg', 'distance': 0}, nearest[0])
+        self.assertEqual([d for _, d in self.db.tree.get_nearest_neighbour_pairs(query, 5)],
+                         [r['distance'] for r in nearest])
+
+    def test_queries_by_path(self):
+        path = os.path.join(self.dir.name, 'query.png')
+        pixels = numpy.linspace(0, 255, 64 * 64).reshape(64, 64).astype('uint8')
+        PILImage.fromarray(pixels).convert('RGB').save(path)
+        self.log_add('/images/copy.jpg', image.get_hash(path, 'dhash', 8))
+        # the query image itself is left out of its results
+        expected = [{'path': '/images/copy.jpg', 'distance': 0}]
+        self.assertEqual(expected, self.service.search({'path': path, 'max_distance': '0'}))
+        self.assertEqual(expected, self.service.nearest({'path': path, 'num_neighbours': '1'}))
+        with self.assertRaises(OSError):
+            self.service.search({'path': os.path.join(self.dir.name, 'missing.png')})
+
+    def test_reload(self):
+        h = next(iter(self.db.image_hashes.values()))
+        params = {'hash': '{:x}'.format(h), 'max_distance': '0'}
+        self.service.search(params)
+        with self.service.acquire() as old:
+            # a query still running on the replaced index keeps it open, and does not cache its result
+            self.log_add('/images/new.jpg', h)
+            self.assertIn({'path': '/images/new.jpg', 'distance': 0}, self.service.search(params))
+            self.assertTrue(old.retired)
+            self.assertFalse(old.db._mm.closed)
+            self.service._cached(old, ('search', h, 1), lambda: [])
+        self.assertTrue(old.db._mm.closed)
+        self.assertEqual(1, self.service.current.generation)
+        self.assertIsNone(self.service.results.get((0, 'search', h, 1)))
+        self.assertIsNotNone(self.service.results.get((1, 'search', h, 0)))
+
+
+class TestHandler(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'db')
+        self.db = create_test_db(100)
+        self.db.encode(self.path)
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.service = QueryService(self.path)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.server.service.current.close()
+        self.dir.cleanup()
+
+    def request(self, endpoint: str, body: bytes = None):
+        url = 'http://127.0.0.1:{}{}'.format(self.server.server_address[1], endpoint)
+        try:
+            with urllib.request.urlopen(url, data=body) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read())
+
+    def test_requests(self):
+        h = '{:x}'.format(self.db.image_hashes['/images/0.jpg'])
+        status, body = self.request('/search?hash={}&max_distance=0'.format(h))
+        self.assertEqual(200, status)
+        self.assertEqual([{'path': '/images/0.jpg', 'distance': 0}], body['results'])
+        status, body = self.request('/nearest', json.dumps({'hash': h, 'num_neighbours': 2}).encode('utf-8'))
+        self.assertEqual(200, status)
+        self.assertEqual(2, len(body['results']))
+
+        self.assertEqual(400, self.request('/search')[0])
+        self.assertEqual(400, self.request('/search?hash=xyz')[0])
+        self.assertEqual(400, self.request('/nearest?hash={}&num_neighbours=many'.format(h))[0])
+        self.assertEqual(400, self.request('/search', b'{not json')[0])
+        status, body = self.request('/unknown')
+        self.assertEqual(404, status)
+        self.assertIn('error', body)
+
+        # the malformed body is rejected before it counts as a request
+        status, body = self.request('/stats')
+        self.assertEqual(200, status)
+        self.assertEqual({'requests': 3, 'errors': 2}, {k: body['/search'][k] for k in ('requests', 'errors')})
+        self.assertEqual({'requests': 2, 'errors': 1}, {k: body['/nearest'][k] for k in ('requests', 'errors')})
+        self.assertLessEqual(body['/search']['p50_ms'], body['/search']['p99_ms'])
+
+
+if __name__ == '__main__':
+    unittest.main()
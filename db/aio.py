@@ -0,0 +1,84 @@
+import asyncio
+import os
+from concurrent.futures import Executor
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple, Union
+
+from db.cache import QueryHasher, open_hash_cache
+from db.db import open_index
+from image.image import Image
+
+# queries running in the executor at once, further ones wait for a slot
+DEFAULT_MAX_CONCURRENCY = 8
+
+Query = Union[str, int, Image]
+
+
+class AsyncIndex:
+    # Asyncio front end to a database: hashing query images and searching run in an executor, so the event loop
+    # never blocks on image decoding or tree traversal. Identical queries made while one is in flight share its
+    # result, and at most max_concurrency of them run at a time. Queries must not overlap with changes to a DB
+    # loaded in memory; indexes opened with open_index are read-only.
+    def __init__(self, db, hasher: Optional[QueryHasher] = None, executor: Optional[Executor] = None,
+                 max_concurrency: int = DEFAULT_MAX_CONCURRENCY):
+        self.db = db
+        self.hasher = hasher if hasher is not None else QueryHasher(db, None)
+        # None is the event loop's default thread pool
+        self.executor = executor
+        self.max_concurrency = max_concurrency
+        # created on first use, since before Python 3.10 it binds to the event loop current at creation, which
+        # is not the one queries run on when the index is opened outside of it
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self.in_flight: Dict[Hashable, asyncio.Task] = {}
+
+    @classmethod
+    def open(cls, db_path: str, workers: int = 1, executor: Optional[Executor] = None,
+             max_concurrency: int = DEFAULT_MAX_CONCURRENCY) -> 'AsyncIndex':
+        db = open_index(db_path, workers)
+        return cls(db, QueryHasher(db, open_hash_cache(db_path)), executor, max_concurrency)
+
+    async def _run(self, fn: Callable[[], Any]) -> Any:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn)
+
+    def _shared(self, key: Hashable, fn: Callable[[], Any]) -> 'asyncio.Future[Any]':
+        # a caller that is cancelled leaves the shared work running for the others
+        task = self.in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._run(fn))
+            self.in_flight[key] = task
+            task.add_done_callback(lambda _: self._done(key, task))
+        return asyncio.shield(task)
+
+    def _done(self, key: Hashable, task: asyncio.Task):
+        del self.in_flight[key]
+        if not task.cancelled():
+            # retrieved here so that a failure nobody waits for anymore is not reported as unhandled
+            task.exception()
+
+    async def hash(self, path: str) -> int:
+        path = os.path.abspath(path)
+        spec = (self.db.hash_type, self.db.hash_size)
+        return await self._shared(('hash', path, spec), lambda: self.hasher.hash(path, spec))
+
+    async def query_image(self, query: Query) -> Image:
+        # a path is hashed, preferring the hash stored in the database; a hash or an Image is used as is
+        if isinstance(query, Image):
+            return query
+        if isinstance(query, int):
+            return Image.from_hash('', query)
+        path = os.path.abspath(query)
+        return Image.from_hash(path, await self.hash(path))
+
+    async def search(self, query: Query, max_distance: int = 3) -> List[Tuple[Image, int]]:
+        img = await self.query_image(query)
+        return await self._shared(('search', img.hash, max_distance),
+                                  lambda: self.db.tree.get_within_distance_pairs(img, max_distance))
+
+    async def nearest(self, query: Query, num_neighbours: int = 3, max_results: int = 16,
+                      max_distance: Optional[int] = None) -> List[Tuple[Image, int]]:
+        img = await self.query_image(query)
+        return await self._shared(
+            ('nearest', img.hash, num_neighbours, max_results, max_distance),
+            lambda: self.db.tree.get_nearest_neighbour_pairs(img, num_neighbours, max_results, max_distance))
@@ -0,0 +1,113 @@
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Any, Hashable, Iterable, Optional, Tuple, Union
+
+from image import image, pipeline
+from image.pipeline import Fingerprint
+
+HASH_CACHE_SUFFIX = '.hashes'
+RESULT_CACHE_SIZE = 1024
+
+if TYPE_CHECKING:
+    from db.db import DB
+    from db.index import MappedIndex
+
+
+def hash_cache_path(db_path: str) -> str:
+    return db_path + HASH_CACHE_SUFFIX
+
+
+class HashCache:
+    # Hashes of query images that are not in the database, persisted next to it. Entries are keyed by the
+    # file fingerprint rather than the path, so a renamed or moved file still hits.
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute('CREATE TABLE IF NOT EXISTS hashes (size INTEGER, mtime_ns INTEGER, inode INTEGER, '
+                               'key TEXT, hash TEXT, PRIMARY KEY (size, mtime_ns, inode, key))')
+
+    def get(self, fingerprint: Fingerprint, key: str) -> Optional[int]:
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT hash FROM hashes WHERE size = ? AND mtime_ns = ? AND inode = ? AND key = ?',
+                (*fingerprint, key)).fetchone()
+        return int(row[0], 16) if row is not None else None
+
+    def put_many(self, entries: Iterable[Tuple[Fingerprint, str, int]]):
+        rows = [(*fingerprint, key, '{:x}'.format(h)) for fingerprint, key, h in entries]
+        if len(rows) == 0:
+            return
+        with self._lock, self._conn:
+            self._conn.executemany('INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?)', rows)
+
+    def put(self, fingerprint: Fingerprint, key: str, h: int):
+        self.put_many([(fingerprint, key, h)])
+
+    def close(self):
+        self._conn.close()
+
+
+def open_hash_cache(db_path: str) -> Optional[HashCache]:
+    # queries still work, just without the cache, when its file cannot be created next to the database
+    try:
+        return HashCache(hash_cache_path(db_path))
+    except sqlite3.Error:
+        return None
+
+
+class QueryHasher:
+    # Hashes query images, preferring the hash stored in the database, then the hash cache, and decoding the
+    # image only when neither has it.
+    def __init__(self, db: Union['DB', 'MappedIndex'], cache: Optional[HashCache]):
+        self.db = db
+        self.cache = cache
+
+    def lookup(self, path: str, key: str, fingerprint: Fingerprint) -> Optional[int]:
+        h = self.db.stored_hash(path, key, fingerprint)
+        if h is None and self.cache is not None:
+            h = self.cache.get(fingerprint, key)
+        return h
+
+    def hash(self, path: str, spec: Tuple[str, int]) -> int:
+        path = os.path.abspath(path)
+        key = image.hash_key(*spec)
+        fingerprint = pipeline.fingerprint(path)
+        h = self.lookup(path, key, fingerprint)
+        if h is None:
+            h = image.get_hash(path, *spec)
+            if self.cache is not None:
+                self.cache.put(fingerprint, key, h)
+        return h
+
+
+class ResultCache:
+    # bounded LRU of query results, cleared whenever the index they came from changes
+    def __init__(self, max_size: int = RESULT_CACHE_SIZE):
+        self.max_size = max_size
+        self._entries: 'OrderedDict[Hashable, Any]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+    def put(self, key: Hashable, value: Any):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,114 @@
+import json
+import os
+from typing import Container, Dict, List, Optional, Tuple
+
+from db import journal
+from db.index import atomic_writer
+from db.journal import Record
+from image import image, pipeline
+from image.image import Image
+from image.pipeline import Fingerprint
+
+# init streams hashed images to a checkpoint next to the database, one journal add record per line, so a run
+# that is interrupted resumes with the images it already hashed. The first line holds the settings the hashes
+# were computed with; a checkpoint left by a run with other settings is started over.
+#   {"specs": [[hash type, hash size], ...], "exif_thumbnails": bool}
+CHECKPOINT_SUFFIX = '.checkpoint'
+# records are synced to disk in batches of this many
+BATCH_SIZE = 1000
+
+
+def checkpoint_path(db_path: str) -> str:
+    return db_path + CHECKPOINT_SUFFIX
+
+
+class Checkpoint:
+    path: str
+    specs: List[Tuple[str, int]]
+    # path -> fingerprint of the images hashed by earlier runs
+    hashed: Dict[str, Optional[Fingerprint]]
+    pending: List[Record]
+
+    def __init__(self, db_path: str, specs: List[Tuple[str, int]], exif_thumbnails: bool, restart: bool = False):
+        self.path = checkpoint_path(db_path)
+        self.specs = specs
+        self.hashed = {}
+        self.pending = []
+        header = {'specs': [list(spec) for spec in specs], 'exif_thumbnails': exif_thumbnails}
+        records = [] if restart else journal.read_records(self.path)
+        if len(records) == 0 or records[0] != header:
+            records = []
+            with atomic_writer(self.path) as f:
+                f.write(json.dumps(header).encode('utf-8') + b'\n')
+        for record in records[1:]:
+            fingerprint = record['fingerprint']
+            self.hashed[record['path']] = tuple(fingerprint) if fingerprint is not None else None
+        self.file = open(self.path, 'r+b')
+        journal.drop_torn_record(self.file)
+
+    def __enter__(self) -> 'Checkpoint':
+        return self
+
+    def __exit__(self, *exc):
+        # also on errors and interrupts, so that everything hashed so far is kept
+        self.close()
+
+    def is_hashed(self, path: str) -> bool:
+        if path not in self.hashed:
+            return False
+        try:
+            return pipeline.same_file(self.hashed[path], pipeline.fingerprint(path))
+        except OSError:
+            return False
+
+    def add(self, path: str, hashes: Dict[str, int], fingerprint: Optional[Fingerprint]):
+        primary = image.hash_key(*self.specs[0])
+        self.pending.append(journal.add_record(Image.from_hash(path, hashes[primary]), hashes, fingerprint))
+        if len(self.pending) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        self.file.write(b''.join(json.dumps(r).encode('utf-8') + b'\n' for r in self.pending))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.pending = []
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.flush()
+        self.file.close()
+
+    def load(self, paths: Container[str]
+             ) -> Tuple[List[Image], Dict[str, Fingerprint], Dict[str, Dict[str, int]]]:
+        # The checkpointed images that are among paths, in the form hash_images returns them. An image hashed
+        # again after it changed is in the checkpoint twice, the later record wins.
+        self.flush()
+        primary = image.hash_key(*self.specs[0])
+        imgs = {}
+        fingerprints = {}
+        extra_hashes = {image.hash_key(*spec): {} for spec in self.specs[1:]}
+        with open(self.path, 'rb') as f:
+            f.readline()
+            for line in f:
+                record = json.loads(line.decode('utf-8'))
+                path = record['path']
+                if path not in paths:
+                    continue
+                hashes = {key: int(h, 16) for key, h in record['hashes'].items()}
+                imgs.pop(path, None)
+                imgs[path] = Image.from_hash(path, hashes[primary])
+                if record['fingerprint'] is not None:
+                    fingerprints[path] = tuple(record['fingerprint'])
+                for key, extra in extra_hashes.items():
+                    extra[path] = hashes[key]
+        return list(imgs.values()), fingerprints, extra_hashes
+
+    def remove(self):
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
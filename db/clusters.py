@@ -0,0 +1,90 @@
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from db.index import MappedIndex
+
+CHUNK_SIZE = 1024
+
+# index opened once per worker process; the mapping shares the page cache between workers
+_worker_index: Optional[MappedIndex] = None
+
+
+class UnionFind:
+    parent: List[int]
+    rank: List[int]
+
+    def __init__(self, size: int):
+        self.parent = list(range(size))
+        self.rank = [0] * size
+
+    def find(self, x: int) -> int:
+        root = x
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[x] != root:
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, x: int, y: int):
+        x = self.find(x)
+        y = self.find(y)
+        if x == y:
+            return
+        if self.rank[x] < self.rank[y]:
+            x, y = y, x
+        self.parent[y] = x
+        if self.rank[x] == self.rank[y]:
+            self.rank[x] += 1
+
+    def groups(self) -> List[List[int]]:
+        members: Dict[int, List[int]] = {}
+        for x in range(len(self.parent)):
+            members.setdefault(self.find(x), []).append(x)
+        return [m for m in members.values() if len(m) > 1]
+
+
+def _open_worker_index(index_path: str):
+    global _worker_index
+    _worker_index = MappedIndex(index_path)
+
+
+def _join_range(index: MappedIndex, start: int, end: int, max_distance: int) -> List[Tuple[int, int]]:
+    # every pair is found from both ends, keep it once
+    edges = []
+    for i in range(start, end):
+        for j, _ in index.tree.get_within_distance_indices(index.point(i), max_distance):
+            if j > i:
+                edges.append((i, j))
+    return edges
+
+
+def _worker_join_range(task: Tuple[int, int, int]) -> List[Tuple[int, int]]:
+    return _join_range(_worker_index, *task)
+
+
+def _chunks(size: int, max_distance: int) -> Iterator[Tuple[int, int, int]]:
+    for start in range(0, size, CHUNK_SIZE):
+        yield start, min(start + CHUNK_SIZE, size), max_distance
+
+
+def _join(index: MappedIndex, index_path: str, max_distance: int, workers: int) -> Iterator[List[Tuple[int, int]]]:
+    tasks = _chunks(index.num_points, max_distance)
+    if workers <= 1:
+        for task in tasks:
+            yield _join_range(index, *task)
+        return
+
+    from multiprocessing import Pool
+    with Pool(workers, _open_worker_index, (index_path,)) as pool:
+        yield from pool.imap_unordered(_worker_join_range, tasks)
+
+
+def find_groups(index_path: str, max_distance: int, workers: int = 1) -> List[List[str]]:
+    # self-join of the index: every pair of images within max_distance is an edge,
+    # connected components of that graph are the near-duplicate groups
+    with MappedIndex(index_path) as index:
+        uf = UnionFind(index.num_points)
+        for edges in _join(index, index_path, max_distance, workers):
+            for i, j in edges:
+                uf.union(i, j)
+
+        return [sorted(index.path(i) for i in group) for group in uf.groups()]
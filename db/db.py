@@ -1,31 +1,230 @@
+import os
 import pickle
-from typing import List, Dict, Set
-
-import imagehash
+import time
+from operator import attrgetter
+from typing import TYPE_CHECKING, List, Dict, Optional, Set, Tuple, Union
 
+from db import journal, options
+from db.index import MappedIndex, is_index, write_index
+from db.journal import JournaledIndex, Record
+from db.linear import LinearIndex
+from image import image
 from image.image import Image
+from image import pipeline
+from image.pipeline import Fingerprint
+from mih.index import MultiIndexHash
+from vptree.hooks import Hooks
 from vptree.vptree import VPTree
 
+if TYPE_CHECKING:
+    from db.shards import ShardedDB, ShardedIndex
+
+ENGINES = options.ENGINES
+
 
 class DB:
     hash_size: int
     hash_type: str
     images: Set[Image]
-    image_hashes: Dict[str, imagehash.ImageHash]
-    tree: VPTree
+    image_hashes: Dict[str, int]
+    fingerprints: Dict[str, Fingerprint]
+    # hash key (see image.hash_key) -> path -> hash, for every stored hash type besides the indexed one
+    extra_hashes: Dict[str, Dict[str, int]]
+    # one of ENGINES
+    engine: str
+    tree: Union[VPTree, MultiIndexHash]
+    # changes not yet saved, as journal records
+    log: List[Record]
+    # receives timings and counters of updates and writes, and of the tree, when set
+    hooks: Optional[Hooks] = None
 
-    def __init__(self, tree: VPTree, images: List[Image], hash_type: str, hash_size: int):
+    def __init__(self, tree: Union[VPTree, MultiIndexHash], images: List[Image], hash_type: str, hash_size: int,
+                 fingerprints: Optional[Dict[str, Fingerprint]] = None,
+                 extra_hashes: Optional[Dict[str, Dict[str, int]]] = None, engine: str = 'vptree'):
         self.tree = tree
+        self.engine = engine
         self.image_hashes = {img.path: img.hash for img in images}
         self.images = set(images)
         self.hash_type = hash_type
         self.hash_size = hash_size
+        self.fingerprints = fingerprints if fingerprints is not None else {}
+        self.extra_hashes = extra_hashes if extra_hashes is not None else {}
+        self.log = []
+
+    def hash_specs(self) -> List[Tuple[str, int]]:
+        # the indexed hash first, then every additional stored one
+        return [(self.hash_type, self.hash_size)] + [image.parse_hash_key(key) for key in sorted(self.extra_hashes)]
+
+    def set_hooks(self, hooks: Optional[Hooks]):
+        self.hooks = hooks
+        if isinstance(self.tree, VPTree):
+            self.tree.hooks = hooks
+
+    def add(self, images: List[Image], fingerprints: Dict[str, Fingerprint],
+            extra_hashes: Optional[Dict[str, Dict[str, int]]] = None):
+        if self.hooks is not None:
+            self.hooks.count('db.added', len(images))
+        self.tree.add_list(images)
+        for img in images:
+            self.image_hashes[img.path] = img.hash
+            self.images.add(img)
+            if img.path in fingerprints:
+                self.fingerprints[img.path] = fingerprints[img.path]
+            for key, hashes in self.extra_hashes.items():
+                hashes[img.path] = extra_hashes[key][img.path]
+            stored = {key: hashes[img.path] for key, hashes in self.extra_hashes.items()}
+            stored[image.hash_key(self.hash_type, self.hash_size)] = img.hash
+            self.log.append(journal.add_record(img, stored, fingerprints.get(img.path)))
+
+    def remove(self, path: str) -> bool:
+        if path not in self.image_hashes:
+            return False
+        img = Image.from_hash(path, self.image_hashes[path])
+        if not self.tree.remove(img):
+            raise ValueError('path is in dict but not in tree')
+        del self.image_hashes[path]
+        self.images.discard(img)
+        self.fingerprints.pop(path, None)
+        for hashes in self.extra_hashes.values():
+            hashes.pop(path, None)
+        self.log.append(journal.remove_record(path))
+        if self.hooks is not None:
+            self.hooks.count('db.removed')
+        return True
+
+    def tree_for(self, key: str) -> Union[VPTree, MultiIndexHash, LinearIndex]:
+        if key == image.hash_key(self.hash_type, self.hash_size):
+            return self.tree
+        if key not in self.extra_hashes:
+            raise ValueError('hash {} is not stored in the database'.format(key))
+        images = [Image.from_hash(path, h) for path, h in self.extra_hashes[key].items()]
+        return LinearIndex(images, image.parse_hash_key(key)[1])
+
+    def stored_hash(self, path: str, key: str, fingerprint: Fingerprint) -> Optional[int]:
+        # the stored hash of path, if the file has not changed since it was hashed
+        if not pipeline.same_file(self.fingerprints.get(path), fingerprint):
+            return None
+        if key == image.hash_key(self.hash_type, self.hash_size):
+            return self.image_hashes.get(path)
+        return self.extra_hashes.get(key, {}).get(path)
+
+    def reindex(self, hash_type: str, hash_size: int) -> bool:
+        # makes another stored hash type the indexed one without touching any image
+        key = image.hash_key(hash_type, hash_size)
+        if key == image.hash_key(self.hash_type, self.hash_size):
+            return True
+        if key not in self.extra_hashes:
+            return False
+
+        hashes = self.extra_hashes.pop(key)
+        self.extra_hashes[image.hash_key(self.hash_type, self.hash_size)] = self.image_hashes
+        images = [Image.from_hash(path, h) for path, h in hashes.items()]
+        self.tree = new_tree(hash_size, self.engine, self.hooks)
+        self.tree.add_list(images)
+        self.image_hashes = hashes
+        self.images = set(images)
+        self.hash_type = hash_type
+        self.hash_size = hash_size
+        return True
+
+    def set_engine(self, engine: str):
+        self.tree = new_tree(self.hash_size, engine, self.hooks)
+        self.tree.add_list(list(self.images))
+        self.engine = engine
+
+    def save(self, path: str):
+        # Appends the changes since loading from path to its log, rewriting the whole index only once the log
+        # has grown too long. Pickled databases are converted.
+        start = time.perf_counter()
+        if is_index(path) and journal.append(path, self.log):
+            if self.hooks is not None:
+                self.hooks.timing('db.log', time.perf_counter() - start)
+                self.hooks.count('db.logged', len(self.log))
+        else:
+            self.encode(path)
+        self.log = []
 
     def encode(self, path: str):
-        with open(path, 'wb') as f:
-            pickle.dump(self, f)
+        start = time.perf_counter()
+        write_index(path, self)
+        if self.hooks is not None:
+            self.hooks.timing('db.encode', time.perf_counter() - start)
+        # everything logged against the previous index is in the new one
+        journal.clear(path)
+        self.log = []
+
+
+def new_tree(hash_size: int, engine: str = 'vptree', hooks: Optional[Hooks] = None) -> Union[VPTree, MultiIndexHash]:
+    if engine == 'mih':
+        return MultiIndexHash(hash_size * hash_size, key_fn=attrgetter('hash'))
+    if engine != 'vptree':
+        raise ValueError('unknown index engine {}'.format(engine))
+    return VPTree(distance_fn=image.distance_fn, leaf_kernel=image.HashKernel(hash_size), hooks=hooks)
+
+
+def decode(path: str) -> Union[DB, 'ShardedDB']:
+    from db.shards import ShardedDB, is_manifest
+    if is_manifest(path):
+        return ShardedDB.load(path)
+    if not is_index(path):
+        return decode_pickle(path)
+
+    with MappedIndex(path) as index:
+        tree = index.load_tree()
+        images = list(tree.iter_points())
+        paths = index.paths()
+        extra_hashes = {key: dict(zip(paths, index.extra_hashes(key))) for key in index.extra_hash_keys}
+        db = DB(tree, images, index.hash_type, index.hash_size, index.fingerprints(), extra_hashes, index.engine)
+    journal.replay(db, journal.read(path))
+    db.log = []
+    return db
+
 
+def open_index(path: str, workers: int = 1) -> Union[MappedIndex, JournaledIndex, DB, 'ShardedIndex']:
+    # read-only access: queries on an index file only touch the pages they need
+    from db.shards import ShardedIndex, is_manifest
+    if is_manifest(path):
+        return ShardedIndex(path, workers)
+    if is_index(path):
+        return journal.open_mapped(path)
+    return decode_pickle(path)
 
-def decode(path: str) -> DB:
+
+def log_changes(path: str, records: List[Record]):
+    # appends changes to the log of an index file without loading it, compacting once the log is too long
+    if is_index(path) and journal.append(path, records):
+        return
+    db = decode(path)
+    journal.replay(db, records)
+    db.encode(path)
+
+
+def database_files(path: str) -> List[str]:
+    # every file a database at path is read from, those that changed tell readers to reopen it
+    from db.shards import Manifest, is_manifest
+    paths = [path] + (Manifest.read(path).shards if is_manifest(path) else [])
+    return paths + [journal.journal_path(p) for p in paths if os.path.exists(journal.journal_path(p))]
+
+
+def decode_pickle(path: str) -> DB:
+    # databases written before the index format were pickled DB objects
     with open(path, 'rb') as f:
-        return pickle.load(f)
+        db = pickle.load(f)
+    if not hasattr(db, 'fingerprints'):
+        db.fingerprints = {}
+    if not hasattr(db, 'extra_hashes'):
+        db.extra_hashes = {}
+    if not hasattr(db, 'engine'):
+        db.engine = 'vptree'
+    db.log = []
+    if any(not isinstance(h, int) for h in db.image_hashes.values()):
+        db = _pack_hashes(db)
+    return db
+
+
+def _pack_hashes(db: DB) -> DB:
+    # databases written before hashes were packed hold imagehash.ImageHash objects
+    images = [Image.from_hash(img.path, image.pack_hash(img.hash)) for img in db.images]
+    tree = new_tree(db.hash_size)
+    tree.add_list(images)
+    return DB(tree, images, db.hash_type, db.hash_size)
@@ -0,0 +1,521 @@
+import json
+import math
+import mmap
+import os
+import struct
+from contextlib import contextmanager
+from operator import attrgetter
+from typing import TYPE_CHECKING, Any, BinaryIO, Dict, Iterator, List, Optional, Tuple, Union
+
+import numpy
+
+from db.linear import LinearIndex
+from image import image
+from image.image import Image
+from image import pipeline
+from image.pipeline import Fingerprint
+from mih.index import MultiIndexHash
+from vptree.node import VPTreeNode
+from vptree.priority_queue import PriorityQueue
+from vptree.stats import SearchStats
+from vptree.vptree import VPTree
+
+if TYPE_CHECKING:
+    from db.db import DB
+
+# File layout:
+#   prelude: MAGIC, format version (uint32), header length (uint32)
+#   header:  JSON object with metadata and the (offset, length) of every section,
+#            offsets are relative to the first byte after the header padding
+#   sections, each aligned to 8 bytes:
+#     nodes:        NODE records in pre-order, the root is record 0
+#     vantage:      vantage point hash of every node, num_words little-endian uint64 each
+#     hashes:       hash of every indexed image in leaf order, same encoding as vantage
+#     path_offsets: num_points + 1 little-endian uint64 offsets into paths
+#     paths:        UTF-8 encoded paths, bytes that are not valid UTF-8 kept as they are on disk
+#     fingerprints: FINGERPRINT records in leaf order, all -1 when unknown (since version 2)
+#     hashes.<key>: every additional stored hash type in leaf order, same encoding as hashes,
+#                   the header maps each key to its number of words (since version 3)
+#     path_order:   num_points little-endian uint64 leaf indices, ordered by their encoded path (since version 4)
+# The header engine is 'vptree' when missing. Databases using the 'mih' engine store all points in a single
+# leaf and build their substring tables when loaded, so older readers still see a valid (flat) tree.
+MAGIC = b'RISIDX\x00\x00'
+VERSION = 4
+PRELUDE = struct.Struct('<8sII')
+# threshold, closer, farther (-1 for leaves), first point, number of points
+NODE = struct.Struct('<dqqQQ')
+# size, modification time in nanoseconds, inode
+FINGERPRINT = struct.Struct('<qqq')
+NO_FINGERPRINT = (-1, -1, -1)
+ALIGNMENT = 8
+
+
+def encode_path(path: str) -> bytes:
+    # paths with undecodable bytes reach us surrogate-escaped, as os.fsdecode leaves them; they round-trip
+    return path.encode('utf-8', 'surrogateescape')
+
+
+def decode_path(data: bytes) -> str:
+    return data.decode('utf-8', 'surrogateescape')
+
+
+def is_index(path: str) -> bool:
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+@contextmanager
+def atomic_writer(path: str) -> Iterator[BinaryIO]:
+    # writes a temporary file next to path and renames it over path once complete, so a crash leaves either
+    # the old or the new file; readers that mapped the old file keep seeing it
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    f = open(tmp, 'wb')
+    try:
+        with f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def write_index(path: str, db: 'DB'):
+    num_words = image.HashKernel(db.hash_size).num_words
+    if db.engine == 'mih':
+        points = list(db.tree.iter_points())
+        nodes, vantage_hashes = [[0.0, -1, -1, 0, len(points)]], [0]
+        capacity = len(points)
+    else:
+        nodes, vantage_hashes, points = _flatten(db.tree.root)
+        capacity = db.tree.capacity
+
+    paths = [encode_path(p.path) for p in points]
+    path_offsets = [0]
+    for p in paths:
+        path_offsets.append(path_offsets[-1] + len(p))
+
+    sections = [
+        ('nodes', b''.join(NODE.pack(*n) for n in nodes)),
+        ('vantage', _pack_hashes(vantage_hashes, num_words)),
+        ('hashes', _pack_hashes([p.hash for p in points], num_words)),
+        ('path_offsets', struct.pack('<{}Q'.format(len(path_offsets)), *path_offsets)),
+        ('paths', b''.join(paths)),
+        ('fingerprints', b''.join(FINGERPRINT.pack(*db.fingerprints.get(p.path, NO_FINGERPRINT)) for p in points)),
+        ('path_order', numpy.array(sorted(range(len(paths)), key=paths.__getitem__), dtype='<u8').tobytes()),
+    ]
+    extra_words = {}
+    for key, hashes in sorted(db.extra_hashes.items()):
+        extra_words[key] = image.HashKernel(image.parse_hash_key(key)[1]).num_words
+        sections.append(('hashes.' + key, _pack_hashes([hashes[p.path] for p in points], extra_words[key])))
+
+    offset = 0
+    layout = {}
+    for name, data in sections:
+        layout[name] = [offset, len(data)]
+        offset += _aligned(len(data))
+
+    header = json.dumps({
+        'hash_type': db.hash_type,
+        'hash_size': db.hash_size,
+        'num_words': num_words,
+        'extra_hashes': extra_words,
+        'engine': db.engine,
+        'capacity': capacity,
+        'num_nodes': len(nodes),
+        'num_points': len(points),
+        'sections': layout,
+    }).encode('utf-8')
+
+    with atomic_writer(path) as f:
+        f.write(PRELUDE.pack(MAGIC, VERSION, len(header)))
+        f.write(header)
+        _pad(f, PRELUDE.size + len(header))
+        for _, data in sections:
+            f.write(data)
+            _pad(f, len(data))
+
+
+def _flatten(root: Optional[VPTreeNode]) -> Tuple[List[List[Any]], List[int], List[Image]]:
+    nodes = []
+    vantage_hashes = []
+    points = []
+    if root is None:
+        return nodes, vantage_hashes, points
+
+    def new_record(node: VPTreeNode) -> int:
+        nodes.append([0.0, -1, -1, 0, 0])
+        vantage_hashes.append(node.vantage_point.hash)
+        return len(nodes) - 1
+
+    stack = [(root, new_record(root))]
+    while len(stack) != 0:
+        node, idx = stack.pop()
+        record = nodes[idx]
+        if node.points is None:
+            record[0] = node.threshold
+            record[1] = new_record(node.closer)
+            record[2] = new_record(node.farther)
+            stack.append((node.farther, record[2]))
+            stack.append((node.closer, record[1]))
+        else:
+            record[3] = len(points)
+            record[4] = len(node.points)
+            points.extend(node.points)
+
+    return nodes, vantage_hashes, points
+
+
+def _pack_hashes(hashes: List[int], num_words: int) -> bytes:
+    return numpy.array([image.hash_words(h, num_words) for h in hashes], dtype='<u8').tobytes()
+
+
+def _aligned(length: int) -> int:
+    return (length + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def _pad(f: BinaryIO, length: int):
+    f.write(b'\x00' * (_aligned(length) - length))
+
+
+class MappedIndex:
+    hash_type: str
+    hash_size: int
+    engine: str
+    capacity: int
+    num_nodes: int
+    num_points: int
+    extra_hash_keys: List[str]
+    kernel: image.HashKernel
+    tree: Union['MappedTree', 'MappedMultiIndexHash']
+
+    def __init__(self, path: str):
+        self._file = open(path, 'rb')
+        try:
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty files cannot be mapped
+            self._file.close()
+            raise ValueError('{} is not an index file'.format(path))
+
+        magic, version, header_len = PRELUDE.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError('{} is not an index file'.format(path))
+        if version > VERSION:
+            raise ValueError('index format version {} is newer than supported version {}'.format(version, VERSION))
+
+        header = json.loads(self._mm[PRELUDE.size:PRELUDE.size + header_len].decode('utf-8'))
+        self.hash_type = header['hash_type']
+        self.hash_size = header['hash_size']
+        self.engine = header.get('engine', 'vptree')
+        self.capacity = header['capacity']
+        self.num_nodes = header['num_nodes']
+        self.num_points = header['num_points']
+        self._num_words = header['num_words']
+        self._extra_words = header.get('extra_hashes', {})
+        self.extra_hash_keys = sorted(self._extra_words)
+        self.kernel = image.HashKernel(self.hash_size)
+
+        data_start = _aligned(PRELUDE.size + header_len)
+        self._sections = {name: data_start + offset for name, (offset, _) in header['sections'].items()}
+        self.tree = MappedMultiIndexHash(self) if self.engine == 'mih' else MappedTree(self)
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+    def __enter__(self) -> 'MappedIndex':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def node(self, idx: int) -> Tuple[float, int, int, int, int]:
+        return NODE.unpack_from(self._mm, self._sections['nodes'] + idx * NODE.size)
+
+    def read_hash(self, section: str, idx: int, num_words: Optional[int] = None) -> int:
+        size = (num_words if num_words is not None else self._num_words) * 8
+        start = self._sections[section] + idx * size
+        return int.from_bytes(self._mm[start:start + size], 'little')
+
+    def hashes(self, section: str, num_words: int) -> List[int]:
+        words = numpy.frombuffer(self._mm, dtype='<u8', count=self.num_points * num_words,
+                                 offset=self._sections[section]).reshape(self.num_points, num_words)
+        if num_words == 1:
+            return words[:, 0].tolist()
+        return [sum(int(w) << (image.WORD_BITS * i) for i, w in enumerate(row)) for row in words]
+
+    def hash_specs(self) -> List[Tuple[str, int]]:
+        return [(self.hash_type, self.hash_size)] + [image.parse_hash_key(key) for key in self.extra_hash_keys]
+
+    def extra_hashes(self, key: str) -> List[int]:
+        return self.hashes('hashes.' + key, self._extra_words[key])
+
+    def tree_for(self, key: str) -> Union['MappedTree', 'MappedMultiIndexHash', LinearIndex]:
+        if key == image.hash_key(self.hash_type, self.hash_size):
+            return self.tree
+        if key not in self._extra_words:
+            raise ValueError('hash {} is not stored in the database'.format(key))
+        images = [Image.from_hash(p, h) for p, h in zip(self.paths(), self.extra_hashes(key))]
+        return LinearIndex(images, image.parse_hash_key(key)[1])
+
+    def leaf_hashes(self, start: int, count: int) -> numpy.ndarray:
+        return numpy.frombuffer(self._mm, dtype='<u8', count=count * self._num_words,
+                                offset=self._sections['hashes'] + start * self._num_words * 8
+                                ).reshape(count, self._num_words)
+
+    def _path_bytes(self, idx: int) -> bytes:
+        begin, end = struct.unpack_from('<QQ', self._mm, self._sections['path_offsets'] + idx * 8)
+        start = self._sections['paths']
+        return self._mm[start + begin:start + end]
+
+    def path(self, idx: int) -> str:
+        return decode_path(self._path_bytes(idx))
+
+    def find_path(self, path: str) -> Optional[int]:
+        if self.num_points == 0:
+            return None
+        needle = encode_path(path)
+        if 'path_order' not in self._sections:
+            return self._scan_paths(needle)
+
+        # binary search over the leaf indices ordered by path
+        order = numpy.frombuffer(self._mm, dtype='<u8', count=self.num_points, offset=self._sections['path_order'])
+        lo, hi = 0, self.num_points
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._path_bytes(int(order[mid])) < needle:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.num_points and self._path_bytes(int(order[lo])) == needle:
+            return int(order[lo])
+        return None
+
+    def _scan_paths(self, needle: bytes) -> Optional[int]:
+        # files written before version 4 have no path order, the paths section is searched in place instead
+        offsets = numpy.frombuffer(self._mm, dtype='<u8', count=self.num_points + 1,
+                                   offset=self._sections['path_offsets'])
+        start = self._sections['paths']
+        end = start + int(offsets[-1])
+        pos = self._mm.find(needle, start, end)
+        while pos != -1:
+            begin = pos - start
+            idx = int(numpy.searchsorted(offsets, begin))
+            if idx < self.num_points and offsets[idx] == begin and offsets[idx + 1] == begin + len(needle):
+                return idx
+            pos = self._mm.find(needle, pos + 1, end)
+        return None
+
+    def stored_hash(self, path: str, key: str, fingerprint: Fingerprint) -> Optional[int]:
+        # the stored hash of path, if the file has not changed since it was hashed
+        if key == image.hash_key(self.hash_type, self.hash_size):
+            section, num_words = 'hashes', self._num_words
+        elif key in self._extra_words:
+            section, num_words = 'hashes.' + key, self._extra_words[key]
+        else:
+            return None
+        idx = self.find_path(path)
+        if idx is None or 'fingerprints' not in self._sections:
+            return None
+        fp = FINGERPRINT.unpack_from(self._mm, self._sections['fingerprints'] + idx * FINGERPRINT.size)
+        if fp == NO_FINGERPRINT or not pipeline.same_file(fp, fingerprint):
+            return None
+        return self.read_hash(section, idx, num_words)
+
+    def paths(self) -> List[str]:
+        return [self.path(i) for i in range(self.num_points)]
+
+    def fingerprints(self) -> Dict[str, Fingerprint]:
+        if 'fingerprints' not in self._sections:
+            return {}
+
+        result = {}
+        for idx in range(self.num_points):
+            fp = FINGERPRINT.unpack_from(self._mm, self._sections['fingerprints'] + idx * FINGERPRINT.size)
+            if fp != NO_FINGERPRINT:
+                result[self.path(idx)] = fp
+        return result
+
+    def point(self, idx: int) -> Image:
+        return Image.from_hash(self.path(idx), self.read_hash('hashes', idx))
+
+    def load_tree(self) -> Union[VPTree, MultiIndexHash]:
+        if self.engine == 'mih':
+            tree = MultiIndexHash(self.hash_size * self.hash_size, key_fn=attrgetter('hash'))
+            tree.add_list([Image.from_hash(p, h) for p, h in zip(self.paths(), self.hashes('hashes', self._num_words))])
+            return tree
+
+        tree = VPTree(distance_fn=image.distance_fn, capacity=self.capacity, leaf_kernel=self.kernel)
+        if self.num_nodes == 0:
+            return tree
+
+        nodes = [VPTreeNode.__new__(VPTreeNode) for _ in range(self.num_nodes)]
+        for idx, node in enumerate(nodes):
+            threshold, closer, farther, start, count = self.node(idx)
+            node.capacity = self.capacity
+            node.distance_fn = image.distance_fn
+            node.leaf_kernel = self.kernel
+            node.packed = None
+            node.threshold = threshold
+            node.vantage_point = Image.from_hash('', self.read_hash('vantage', idx))
+            node.changes = 0
+            node.count = count
+            if closer < 0:
+                node.closer = None
+                node.farther = None
+                node.points = [self.point(i) for i in range(start, start + count)]
+            else:
+                node.closer = nodes[closer]
+                node.farther = nodes[farther]
+                node.points = None
+
+        # children follow their parent in pre-order
+        for node in reversed(nodes):
+            if node.points is None:
+                node.count = node.closer.count + node.farther.count
+        tree.root = nodes[0]
+        return tree
+
+
+class MappedTree:
+    # read-only counterpart of VPTree answering queries straight from the mapped file
+    _index: MappedIndex
+
+    def __init__(self, index: MappedIndex):
+        self._index = index
+
+    def _leaf_distances(self, query: Image, start: int, count: int) -> List[int]:
+        if count == 0:
+            return []
+        return self._index.kernel.distances(query, self._index.leaf_hashes(start, count))
+
+    def _vantage_distance(self, idx: int, query: Image) -> int:
+        return image.popcount(self._index.read_hash('vantage', idx) ^ query.hash)
+
+    def get_within_distance(self, query: Image, max_distance: float,
+                            stats: Optional[SearchStats] = None) -> List[Image]:
+        return [self._index.point(idx) for idx, _ in self.get_within_distance_indices(query, max_distance, stats)]
+
+    def get_within_distance_pairs(self, query: Image, max_distance: float,
+                                  stats: Optional[SearchStats] = None) -> List[Tuple[Image, int]]:
+        return [(self._index.point(idx), d) for idx, d in self.get_within_distance_indices(query, max_distance, stats)]
+
+    def get_within_distance_indices(self, query: Image, max_distance: float,
+                                    stats: Optional[SearchStats] = None) -> List[Tuple[int, int]]:
+        result = []
+        if stats is not None:
+            stats.queries += 1
+        if self._index.num_nodes == 0:
+            return result
+
+        stack = [0]
+        while len(stack) != 0:
+            idx = stack.pop()
+            threshold, closer, farther, start, count = self._index.node(idx)
+            if stats is not None:
+                stats.nodes_visited += 1
+                stats.distance_calls += count if closer < 0 else 1
+            if closer < 0:
+                for i, distance in enumerate(self._leaf_distances(query, start, count)):
+                    if distance <= max_distance:
+                        result.append((start + i, distance))
+                continue
+
+            distance_from_vantage_point_to_query_point = self._vantage_distance(idx, query)
+            if distance_from_vantage_point_to_query_point + max_distance > threshold:
+                stack.append(farther)
+            if distance_from_vantage_point_to_query_point <= threshold + max_distance:
+                stack.append(closer)
+
+        return result
+
+    def get_nearest_neighbours(self, query: Image, num_neighbours: int, max_results: int = 16,
+                               max_distance: Optional[float] = None,
+                               stats: Optional[SearchStats] = None) -> List[Image]:
+        return [p for p, _ in self.get_nearest_neighbour_pairs(query, num_neighbours, max_results, max_distance, stats)]
+
+    def get_nearest_neighbour_pairs(self, query: Image, num_neighbours: int, max_results: int = 16,
+                                    max_distance: Optional[float] = None,
+                                    stats: Optional[SearchStats] = None) -> List[Tuple[Image, int]]:
+        return [(self._index.point(idx), d) for idx, d in
+                self.get_nearest_neighbour_indices(query, num_neighbours, max_results, max_distance, stats)]
+
+    def get_nearest_neighbour_indices(self, query: Image, num_neighbours: int, max_results: int = 16,
+                                      max_distance: Optional[float] = None,
+                                      stats: Optional[SearchStats] = None) -> List[Tuple[int, int]]:
+        # same search as VPTreeNode.get_nearest_neighbours, over point indices so paths are only read for results
+        heap = PriorityQueue(query, None, min(num_neighbours, max_results))
+        if stats is not None:
+            stats.queries += 1
+        if self._index.num_nodes == 0 or heap.max_entries <= 0:
+            return []
+        if max_distance is None:
+            max_distance = math.inf
+
+        stack = [(0, 0.0)]
+        while len(stack) != 0:
+            idx, bound = stack.pop()
+            if bound > max_distance or not heap.accepts(bound):
+                continue
+            threshold, closer, farther, start, count = self._index.node(idx)
+            if stats is not None:
+                stats.nodes_visited += 1
+                stats.distance_calls += count if closer < 0 else 1
+            if closer < 0:
+                for i, distance in enumerate(self._leaf_distances(query, start, count)):
+                    if distance <= max_distance:
+                        heap.push_distance(start + i, distance)
+                continue
+
+            distance_from_vantage_point_to_query_point = self._vantage_distance(idx, query)
+            distance_from_query_point_to_threshold = abs(distance_from_vantage_point_to_query_point - threshold)
+            if distance_from_vantage_point_to_query_point <= threshold:
+                stack.append((farther, max(bound, distance_from_query_point_to_threshold)))
+                stack.append((closer, bound))
+            else:
+                stack.append((closer, max(bound, distance_from_query_point_to_threshold)))
+                stack.append((farther, bound))
+
+        return heap.pairs()
+
+
+class MappedMultiIndexHash:
+    # substring tables over point indices, built from the mapped hashes on the first query
+    _index: MappedIndex
+    _tables: Optional[MultiIndexHash]
+
+    def __init__(self, index: MappedIndex):
+        self._index = index
+        self._tables = None
+
+    def tables(self) -> MultiIndexHash:
+        if self._tables is None:
+            hashes = self._index.hashes('hashes', self._index._num_words)
+            self._tables = MultiIndexHash(self._index.hash_size * self._index.hash_size, key_fn=hashes.__getitem__)
+            self._tables.add_list(range(self._index.num_points))
+        return self._tables
+
+    def get_within_distance(self, query: Image, max_distance: float,
+                            stats: Optional[SearchStats] = None) -> List[Image]:
+        return [self._index.point(idx) for idx, _ in self.get_within_distance_indices(query, max_distance, stats)]
+
+    def get_within_distance_pairs(self, query: Image, max_distance: float,
+                                  stats: Optional[SearchStats] = None) -> List[Tuple[Image, int]]:
+        return [(self._index.point(idx), d) for idx, d in self.get_within_distance_indices(query, max_distance, stats)]
+
+    def get_within_distance_indices(self, query: Image, max_distance: float,
+                                    stats: Optional[SearchStats] = None) -> List[Tuple[int, int]]:
+        return self.tables().within_distance_of_key(query.hash, max_distance, stats)
+
+    def get_nearest_neighbours(self, query: Image, num_neighbours: int, max_results: int = 16,
+                               max_distance: Optional[float] = None,
+                               stats: Optional[SearchStats] = None) -> List[Image]:
+        return [p for p, _ in self.get_nearest_neighbour_pairs(query, num_neighbours, max_results, max_distance, stats)]
+
+    def get_nearest_neighbour_pairs(self, query: Image, num_neighbours: int, max_results: int = 16,
+                                    max_distance: Optional[float] = None,
+                                    stats: Optional[SearchStats] = None) -> List[Tuple[Image, int]]:
+        nearest = self.tables().nearest_to_key(query.hash, min(num_neighbours, max_results), max_distance, stats)
+        return [(self._index.point(idx), d) for idx, d in nearest]
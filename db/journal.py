@@ -0,0 +1,253 @@
+import heapq
+import json
+import os
+from operator import itemgetter
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Set, Tuple, Union
+
+from db.index import MappedIndex, MappedMultiIndexHash, MappedTree, atomic_writer
+from db.linear import LinearIndex
+from image import image, pipeline
+from image.image import Image
+from image.pipeline import Fingerprint
+from vptree.stats import SearchStats
+
+# Changes to an index file are appended to a log next to it, one JSON record per line, and the index itself is
+# only rewritten when the log is compacted. The first line names the index the log applies to by its
+# fingerprint; since indexes are replaced by renaming, a log left behind by a compaction that crashed before
+# removing it no longer matches and is ignored. A torn last line is dropped.
+#   {"base": [size, mtime_ns, inode]}
+#   {"op": "add", "path": ..., "hashes": {hash key: hex hash}, "fingerprint": [size, mtime_ns, inode] or null}
+#   {"op": "remove", "path": ...}
+JOURNAL_SUFFIX = '.log'
+# the log is compacted once it would grow past this many bytes, or a quarter of the index size
+COMPACT_MIN_BYTES = 1 << 20
+COMPACT_FRACTION = 0.25
+
+Record = Dict[str, Any]
+
+
+def journal_path(db_path: str) -> str:
+    return db_path + JOURNAL_SUFFIX
+
+
+def add_record(img: Image, hashes: Dict[str, int], fingerprint: Optional[Fingerprint]) -> Record:
+    return {
+        'op': 'add',
+        'path': img.path,
+        'hashes': {key: '{:x}'.format(h) for key, h in hashes.items()},
+        'fingerprint': list(fingerprint) if fingerprint is not None else None,
+    }
+
+
+def remove_record(path: str) -> Record:
+    return {'op': 'remove', 'path': path}
+
+
+def read_records(path: str) -> List[Record]:
+    # the JSON lines of a file up to the first torn or garbled one
+    try:
+        with open(path, 'rb') as f:
+            lines = f.read().split(b'\n')
+    except FileNotFoundError:
+        return []
+
+    # the last element is empty unless the last write was torn
+    records = []
+    for line in lines[:-1]:
+        try:
+            records.append(json.loads(line.decode('utf-8')))
+        except ValueError:
+            break
+    return records
+
+
+def drop_torn_record(f: BinaryIO):
+    # truncates a file opened for update after its last complete line
+    f.seek(0, os.SEEK_END)
+    if f.tell() == 0:
+        return
+    f.seek(-1, os.SEEK_END)
+    if f.read(1) != b'\n':
+        f.seek(0)
+        f.truncate(f.read().rfind(b'\n') + 1)
+    f.seek(0, os.SEEK_END)
+
+
+def read(db_path: str) -> List[Record]:
+    records = read_records(journal_path(db_path))
+    if len(records) == 0 or records[0].get('base') != list(pipeline.fingerprint(db_path)):
+        return []
+    return records[1:]
+
+
+def append(db_path: str, records: List[Record]) -> bool:
+    # Appends records to the log and syncs it. Returns False without writing when the log would outgrow
+    # the index, the caller then compacts instead.
+    if len(records) == 0:
+        return True
+    data = b''.join(json.dumps(r).encode('utf-8') + b'\n' for r in records)
+    path = journal_path(db_path)
+    base = list(pipeline.fingerprint(db_path))
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    if size + len(data) > max(COMPACT_MIN_BYTES, COMPACT_FRACTION * os.path.getsize(db_path)):
+        return False
+
+    if size == 0 or not _matches(path, base):
+        with atomic_writer(path) as f:
+            f.write(json.dumps({'base': base}).encode('utf-8') + b'\n')
+            f.write(data)
+        return True
+
+    with open(path, 'r+b') as f:
+        # drop the torn record of an interrupted append
+        drop_torn_record(f)
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    return True
+
+
+def _matches(path: str, base: List[int]) -> bool:
+    with open(path, 'rb') as f:
+        try:
+            return json.loads(f.readline().decode('utf-8')).get('base') == base
+        except ValueError:
+            return False
+
+
+def clear(db_path: str):
+    try:
+        os.remove(journal_path(db_path))
+    except FileNotFoundError:
+        pass
+
+
+def replay(db, records: List[Record]):
+    # applies logged changes to a DB decoded from the index they were logged against
+    primary = image.hash_key(db.hash_type, db.hash_size)
+    for record in records:
+        path = record['path']
+        db.remove(path)
+        if record['op'] != 'add':
+            continue
+        hashes = {key: int(h, 16) for key, h in record['hashes'].items()}
+        fingerprints = {path: tuple(record['fingerprint'])} if record['fingerprint'] is not None else {}
+        extra_hashes = {key: {path: hashes[key]} for key in db.extra_hashes}
+        db.add([Image.from_hash(path, hashes[primary])], fingerprints, extra_hashes)
+
+
+class JournaledIndex:
+    # Read-only view of an index file with its log applied: logged images are scanned linearly, and images
+    # removed or replaced since the index was written are filtered out of its results.
+    hash_type: str
+    hash_size: int
+    engine: str
+    extra_hash_keys: List[str]
+    # path -> (hashes by hash key, fingerprint)
+    added: Dict[str, Tuple[Dict[str, int], Optional[Fingerprint]]]
+    # paths whose entry in the index is outdated
+    hidden: Set[str]
+
+    def __init__(self, path: str, records: Optional[List[Record]] = None):
+        self.base = MappedIndex(path)
+        self.hash_type = self.base.hash_type
+        self.hash_size = self.base.hash_size
+        self.engine = self.base.engine
+        self.extra_hash_keys = self.base.extra_hash_keys
+        self.added = {}
+        self.hidden = set()
+        for record in records if records is not None else read(path):
+            self.hidden.add(record['path'])
+            self.added.pop(record['path'], None)
+            if record['op'] == 'add':
+                fingerprint = tuple(record['fingerprint']) if record['fingerprint'] is not None else None
+                hashes = {key: int(h, 16) for key, h in record['hashes'].items()}
+                self.added[record['path']] = hashes, fingerprint
+        self.tree = self.tree_for(image.hash_key(self.hash_type, self.hash_size))
+
+    def close(self):
+        self.base.close()
+
+    def __enter__(self) -> 'JournaledIndex':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def hash_specs(self) -> List[Tuple[str, int]]:
+        return self.base.hash_specs()
+
+    def contains(self, path: str) -> bool:
+        if path in self.hidden:
+            return path in self.added
+        return self.base.find_path(path) is not None
+
+    def tree_for(self, key: str) -> 'JournaledTree':
+        images = [Image.from_hash(path, hashes[key]) for path, (hashes, _) in self.added.items()]
+        return JournaledTree(self.base.tree_for(key), LinearIndex(images, image.parse_hash_key(key)[1]),
+                             self.hidden)
+
+    def stored_hash(self, path: str, key: str, fingerprint: Fingerprint) -> Optional[int]:
+        if path not in self.hidden:
+            return self.base.stored_hash(path, key, fingerprint)
+        if path not in self.added:
+            return None
+        hashes, stored = self.added[path]
+        return hashes.get(key) if pipeline.same_file(stored, fingerprint) else None
+
+
+class JournaledTree:
+    def __init__(self, base: Union[MappedTree, MappedMultiIndexHash, LinearIndex], added: LinearIndex,
+                 hidden: Set[str]):
+        self._base = base
+        self._added = added
+        self._hidden = hidden
+
+    @staticmethod
+    def _search_added(search: Callable[[Optional[SearchStats]], List[Tuple[Image, int]]],
+                      stats: Optional[SearchStats]) -> List[Tuple[Image, int]]:
+        # the scan of logged images is part of the same query
+        if stats is None:
+            return search(None)
+        added = SearchStats()
+        result = search(added)
+        stats.nodes_visited += added.nodes_visited
+        stats.distance_calls += added.distance_calls
+        return result
+
+    def get_within_distance_pairs(self, query: Image, max_distance: float,
+                                  stats: Optional[SearchStats] = None) -> List[Tuple[Image, int]]:
+        pairs = [p for p in self._base.get_within_distance_pairs(query, max_distance, stats)
+                 if p[0].path not in self._hidden]
+        return pairs + self._search_added(lambda s: self._added.get_within_distance_pairs(query, max_distance, s),
+                                          stats)
+
+    def get_within_distance(self, query: Image, max_distance: float,
+                            stats: Optional[SearchStats] = None) -> List[Image]:
+        return [img for img, _ in self.get_within_distance_pairs(query, max_distance, stats)]
+
+    def get_nearest_neighbour_pairs(self, query: Image, num_neighbours: int, max_results: int = 16,
+                                    max_distance: Optional[float] = None,
+                                    stats: Optional[SearchStats] = None) -> List[Tuple[Image, int]]:
+        # enough neighbours from the index that k remain after dropping every hidden one
+        k = min(num_neighbours, max_results)
+        extra = k + len(self._hidden)
+        pairs = [p for p in self._base.get_nearest_neighbour_pairs(query, extra, extra, max_distance, stats)
+                 if p[0].path not in self._hidden]
+        pairs += self._search_added(lambda s: self._added.get_nearest_neighbour_pairs(query, k, k, max_distance, s),
+                                    stats)
+        return heapq.nsmallest(k, pairs, key=itemgetter(1))
+
+    def get_nearest_neighbours(self, query: Image, num_neighbours: int, max_results: int = 16,
+                               max_distance: Optional[float] = None,
+                               stats: Optional[SearchStats] = None) -> List[Image]:
+        return [img for img, _ in self.get_nearest_neighbour_pairs(query, num_neighbours, max_results, max_distance,
+                                                                   stats)]
+
+
+def open_mapped(path: str) -> Union[MappedIndex, JournaledIndex]:
+    # the plain index when nothing is logged against it
+    records = read(path)
+    if len(records) == 0:
+        return MappedIndex(path)
+    return JournaledIndex(path, records)
@@ -0,0 +1,50 @@
+from typing import List, Optional, Tuple
+
+import numpy
+
+from image import image
+from image.image import Image
+from vptree.stats import SearchStats
+
+
+class LinearIndex:
+    # Exhaustive scan over a packed hash array with the same query interface as VPTree.
+    # Used for hash types that are stored in the DB but have no tree of their own.
+    images: List[Image]
+
+    def __init__(self, images: List[Image], hash_size: int):
+        self.images = images
+        self._kernel = image.HashKernel(hash_size)
+        self._packed = self._kernel.pack(images)
+
+    def _distances(self, query: Image, stats: Optional[SearchStats]) -> numpy.ndarray:
+        if stats is not None:
+            stats.queries += 1
+            stats.nodes_visited += 1
+            stats.distance_calls += len(self.images)
+        if len(self.images) == 0:
+            return numpy.zeros(0, dtype=numpy.int64)
+        return numpy.array(self._kernel.distances(query, self._packed))
+
+    def get_within_distance(self, query: Image, max_distance: float,
+                            stats: Optional[SearchStats] = None) -> List[Image]:
+        return [img for img, _ in self.get_within_distance_pairs(query, max_distance, stats)]
+
+    def get_within_distance_pairs(self, query: Image, max_distance: float,
+                                  stats: Optional[SearchStats] = None) -> List[Tuple[Image, int]]:
+        distances = self._distances(query, stats)
+        return [(self.images[i], int(distances[i])) for i in numpy.nonzero(distances <= max_distance)[0]]
+
+    def get_nearest_neighbours(self, query: Image, num_neighbours: int, max_results: int = 16,
+                               max_distance: Optional[float] = None,
+                               stats: Optional[SearchStats] = None) -> List[Image]:
+        return [img for img, _ in self.get_nearest_neighbour_pairs(query, num_neighbours, max_results, max_distance,
+                                                                   stats)]
+
+    def get_nearest_neighbour_pairs(self, query: Image, num_neighbours: int, max_results: int = 16,
+                                    max_distance: Optional[float] = None,
+                                    stats: Optional[SearchStats] = None) -> List[Tuple[Image, int]]:
+        distances = self._distances(query, stats)
+        order = numpy.argsort(distances, kind='stable')[:max(0, min(num_neighbours, max_results))]
+        return [(self.images[i], int(distances[i])) for i in order
+                if max_distance is None or distances[i] <= max_distance]
@@ -0,0 +1,7 @@
+# Choices shared by the database modules and the command line, kept apart so parsing arguments imports nothing
+# heavier than this module.
+
+# index engines: 'vptree' (metric tree) or 'mih' (multi-index hashing)
+ENGINES = ['vptree', 'mih']
+# how images are assigned to shards: by a hash of their path, or of their directory
+SHARD_STRATEGIES = ['hash', 'prefix']
@@ -0,0 +1,330 @@
+import atexit
+import heapq
+import json
+import os
+import zlib
+from collections import ChainMap
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Set, Tuple, Union
+
+from db import options
+from db.db import DB, decode, new_tree
+from db.index import MappedIndex, atomic_writer, encode_path
+from db.journal import JournaledIndex, open_mapped
+from image import image
+from image.image import Image
+from image.pipeline import Fingerprint
+from vptree.hooks import Hooks
+from vptree.stats import SearchStats
+
+if TYPE_CHECKING:
+    from multiprocessing.pool import Pool
+
+# A sharded database is a JSON manifest at the database path naming one database file per shard, stored next
+# to it. Every image belongs to the shard chosen by its strategy:
+#   hash:   CRC-32 of the path, spreading images evenly
+#   prefix: CRC-32 of the directory, keeping each directory in one shard
+MANIFEST_FORMAT = 'ris-shards'
+MANIFEST_VERSION = 1
+STRATEGIES = options.SHARD_STRATEGIES
+
+# (path, hash, distance)
+ShardMatch = Tuple[str, int, int]
+
+# shard indexes opened once per worker process
+_worker_indexes: List[Union[MappedIndex, JournaledIndex]] = []
+
+
+def is_manifest(path: str) -> bool:
+    prefix = '{{"format": "{}"'.format(MANIFEST_FORMAT).encode('utf-8')
+    with open(path, 'rb') as f:
+        return f.read(len(prefix)) == prefix
+
+
+def shard_of(path: str, strategy: str, num_shards: int) -> int:
+    key = path if strategy == 'hash' else os.path.dirname(path)
+    return zlib.crc32(encode_path(key)) % num_shards
+
+
+class Manifest:
+    path: str
+    strategy: str
+    # absolute paths of the shard databases
+    shards: List[str]
+
+    def __init__(self, path: str, strategy: str, shards: List[str]):
+        if strategy not in STRATEGIES:
+            raise ValueError('invalid shard strategy {}'.format(strategy))
+        self.path = path
+        self.strategy = strategy
+        self.shards = shards
+
+    @classmethod
+    def new(cls, path: str, strategy: str, num_shards: int) -> 'Manifest':
+        return cls(path, strategy, ['{}.{}'.format(os.path.abspath(path), i) for i in range(num_shards)])
+
+    @classmethod
+    def read(cls, path: str) -> 'Manifest':
+        with open(path) as f:
+            data = json.load(f)
+        if data['version'] > MANIFEST_VERSION:
+            raise ValueError('shard manifest version {} is newer than supported version {}'.format(
+                data['version'], MANIFEST_VERSION))
+        directory = os.path.dirname(os.path.abspath(path))
+        return cls(path, data['strategy'], [os.path.join(directory, name) for name in data['shards']])
+
+    def write(self, path: str):
+        # shard files are named relative to the manifest, so a database directory can be moved as a whole
+        directory = os.path.dirname(os.path.abspath(path))
+        with atomic_writer(path) as f:
+            f.write(json.dumps({
+                'format': MANIFEST_FORMAT,
+                'version': MANIFEST_VERSION,
+                'strategy': self.strategy,
+                'shards': [os.path.relpath(shard, directory) for shard in self.shards],
+            }).encode('utf-8'))
+
+    def shard_of(self, path: str) -> int:
+        return shard_of(path, self.strategy, len(self.shards))
+
+
+def shard_file(db_path: str, path: str) -> str:
+    # the database file holding path, db_path itself unless it is sharded
+    if not is_manifest(db_path):
+        return db_path
+    manifest = Manifest.read(db_path)
+    return manifest.shards[manifest.shard_of(path)]
+
+
+class ShardedDB:
+    # Writable view over every shard, with the parts of the DB interface that add, update, remove and migrate
+    # use. Each update goes to the shard owning the path and save only touches the shards that changed.
+    manifest: Manifest
+    shards: List[DB]
+    dirty: Set[int]
+
+    def __init__(self, manifest: Manifest, shards: List[DB]):
+        self.manifest = manifest
+        self.shards = shards
+        self.dirty = set()
+
+    @classmethod
+    def load(cls, path: str) -> 'ShardedDB':
+        manifest = Manifest.read(path)
+        return cls(manifest, [decode(shard) for shard in manifest.shards])
+
+    @classmethod
+    def create(cls, path: str, images: List[Image], hash_type: str, hash_size: int,
+               fingerprints: Dict[str, Fingerprint], extra_hashes: Dict[str, Dict[str, int]], engine: str,
+               num_shards: int, strategy: str) -> 'ShardedDB':
+        manifest = Manifest.new(path, strategy, num_shards)
+        parts: List[List[Image]] = [[] for _ in range(num_shards)]
+        for img in images:
+            parts[manifest.shard_of(img.path)].append(img)
+
+        shards = []
+        for part in parts:
+            tree = new_tree(hash_size, engine)
+            tree.add_list(part)
+            shard_extra = {key: {img.path: hashes[img.path] for img in part} for key, hashes in extra_hashes.items()}
+            shard_fingerprints = {img.path: fingerprints[img.path] for img in part if img.path in fingerprints}
+            shards.append(DB(tree, part, hash_type, hash_size, shard_fingerprints, shard_extra, engine))
+        db = cls(manifest, shards)
+        db.dirty = set(range(num_shards))
+        return db
+
+    @property
+    def hash_type(self) -> str:
+        return self.shards[0].hash_type
+
+    @property
+    def hash_size(self) -> int:
+        return self.shards[0].hash_size
+
+    @property
+    def engine(self) -> str:
+        return self.shards[0].engine
+
+    @property
+    def image_hashes(self) -> ChainMap:
+        return ChainMap(*[shard.image_hashes for shard in self.shards])
+
+    @property
+    def fingerprints(self) -> ChainMap:
+        return ChainMap(*[shard.fingerprints for shard in self.shards])
+
+    def hash_specs(self) -> List[Tuple[str, int]]:
+        return self.shards[0].hash_specs()
+
+    def set_hooks(self, hooks: Optional[Hooks]):
+        for shard in self.shards:
+            shard.set_hooks(hooks)
+
+    def add(self, images: List[Image], fingerprints: Dict[str, Fingerprint],
+            extra_hashes: Optional[Dict[str, Dict[str, int]]] = None):
+        parts: Dict[int, List[Image]] = {}
+        for img in images:
+            parts.setdefault(self.manifest.shard_of(img.path), []).append(img)
+        for i, part in parts.items():
+            self.shards[i].add(part, fingerprints, extra_hashes)
+            self.dirty.add(i)
+
+    def remove(self, path: str) -> bool:
+        i = self.manifest.shard_of(path)
+        if not self.shards[i].remove(path):
+            return False
+        self.dirty.add(i)
+        return True
+
+    def stored_hash(self, path: str, key: str, fingerprint: Fingerprint) -> Optional[int]:
+        return self.shards[self.manifest.shard_of(path)].stored_hash(path, key, fingerprint)
+
+    def merged(self) -> DB:
+        # a single database holding every shard, for whole-collection jobs such as clusters
+        images = [img for shard in self.shards for img in shard.images]
+        tree = new_tree(self.hash_size, self.engine)
+        tree.add_list(images)
+        fingerprints = dict(self.fingerprints)
+        extra_hashes = {key: {} for key in self.shards[0].extra_hashes}
+        for shard in self.shards:
+            for key, hashes in shard.extra_hashes.items():
+                extra_hashes[key].update(hashes)
+        return DB(tree, images, self.hash_type, self.hash_size, fingerprints, extra_hashes, self.engine)
+
+    def save(self, path: str):
+        if os.path.abspath(path) != os.path.abspath(self.manifest.path):
+            self.encode(path)
+            return
+        for i in sorted(self.dirty):
+            self.shards[i].save(self.manifest.shards[i])
+        self.dirty = set()
+
+    def encode(self, path: str):
+        if os.path.abspath(path) != os.path.abspath(self.manifest.path):
+            self.manifest = Manifest.new(path, self.manifest.strategy, len(self.shards))
+        for i, shard in enumerate(self.shards):
+            shard.encode(self.manifest.shards[i])
+        self.dirty = set()
+        self.manifest.write(path)
+
+
+def _open_worker_indexes(paths: List[str]):
+    global _worker_indexes
+    _worker_indexes = [open_mapped(path) for path in paths]
+
+
+def _query_worker(shard: int, key: str, kind: str, query_hash: int,
+                  params: Tuple[Any, ...]) -> Tuple[List[ShardMatch], int, int]:
+    return _query(_worker_indexes[shard], key, kind, query_hash, params)
+
+
+def _query(index: Union[MappedIndex, JournaledIndex], key: str, kind: str, query_hash: int,
+           params: Tuple[Any, ...]) -> Tuple[List[ShardMatch], int, int]:
+    stats = SearchStats()
+    tree = index.tree_for(key)
+    query = Image.from_hash('', query_hash)
+    if kind == 'within':
+        pairs = tree.get_within_distance_pairs(query, *params, stats=stats)
+    else:
+        pairs = tree.get_nearest_neighbour_pairs(query, *params, stats=stats)
+    return [(img.path, img.hash, int(d)) for img, d in pairs], stats.nodes_visited, stats.distance_calls
+
+
+class ShardedIndex:
+    # Read-only counterpart of MappedIndex: queries run on every shard, in a process pool when workers > 1,
+    # and their results are merged.
+    manifest: Manifest
+    indexes: List[Union[MappedIndex, JournaledIndex]]
+    hash_type: str
+    hash_size: int
+    engine: str
+    extra_hash_keys: List[str]
+
+    def __init__(self, path: str, workers: int = 1):
+        self.manifest = Manifest.read(path)
+        self.indexes = [open_mapped(shard) for shard in self.manifest.shards]
+        self.hash_type = self.indexes[0].hash_type
+        self.hash_size = self.indexes[0].hash_size
+        self.engine = self.indexes[0].engine
+        self.extra_hash_keys = self.indexes[0].extra_hash_keys
+        self.workers = min(workers, len(self.indexes))
+        self._pool: Optional['Pool'] = None
+        self.tree = ShardedTree(self, image.hash_key(self.hash_type, self.hash_size))
+
+    def _close_pool(self):
+        if self._pool is not None:
+            atexit.unregister(self._close_pool)
+            self._pool.terminate()
+            self._pool = None
+
+    def close(self):
+        self._close_pool()
+        for index in self.indexes:
+            index.close()
+
+    def __enter__(self) -> 'ShardedIndex':
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def tree_for(self, key: str) -> 'ShardedTree':
+        if key == self.tree.key:
+            return self.tree
+        if key not in self.extra_hash_keys:
+            raise ValueError('hash {} is not stored in the database'.format(key))
+        return ShardedTree(self, key)
+
+    def stored_hash(self, path: str, key: str, fingerprint: Fingerprint) -> Optional[int]:
+        return self.indexes[self.manifest.shard_of(path)].stored_hash(path, key, fingerprint)
+
+    def fan_out(self, key: str, kind: str, query_hash: int, params: Tuple[Any, ...]
+                ) -> List[Tuple[List[ShardMatch], int, int]]:
+        tasks = [(i, key, kind, query_hash, params) for i in range(len(self.indexes))]
+        if self.workers <= 1:
+            return [_query(self.indexes[i], *task[1:]) for i, task in enumerate(tasks)]
+        if self._pool is None:
+            from multiprocessing import Pool
+            self._pool = Pool(self.workers, initializer=_open_worker_indexes, initargs=(self.manifest.shards,))
+            # commands do not close their index, the pool has to be gone before interpreter shutdown
+            atexit.register(self._close_pool)
+        return self._pool.starmap(_query_worker, tasks)
+
+
+class ShardedTree:
+    # query interface of VPTree over every shard of a ShardedIndex, for one stored hash type
+    key: str
+
+    def __init__(self, index: ShardedIndex, key: str):
+        self._index = index
+        self.key = key
+
+    def _matches(self, kind: str, query: Image, params: Tuple[Any, ...],
+                 stats: Optional[SearchStats]) -> List[ShardMatch]:
+        results = self._index.fan_out(self.key, kind, query.hash, params)
+        if stats is not None:
+            stats.queries += 1
+            stats.nodes_visited += sum(nodes for _, nodes, _ in results)
+            stats.distance_calls += sum(distances for _, _, distances in results)
+        return [match for matches, _, _ in results for match in matches]
+
+    def get_within_distance_pairs(self, query: Image, max_distance: float,
+                                  stats: Optional[SearchStats] = None) -> List[Tuple[Image, int]]:
+        return [(Image.from_hash(path, h), d) for path, h, d in self._matches('within', query, (max_distance,), stats)]
+
+    def get_within_distance(self, query: Image, max_distance: float,
+                            stats: Optional[SearchStats] = None) -> List[Image]:
+        return [img for img, _ in self.get_within_distance_pairs(query, max_distance, stats)]
+
+    def get_nearest_neighbour_pairs(self, query: Image, num_neighbours: int, max_results: int = 16,
+                                    max_distance: Optional[float] = None,
+                                    stats: Optional[SearchStats] = None) -> List[Tuple[Image, int]]:
+        # every shard returns its own top k, the global top k is among them
+        matches = self._matches('nearest', query, (num_neighbours, max_results, max_distance), stats)
+        nearest = heapq.nsmallest(min(num_neighbours, max_results), matches, key=lambda m: m[2])
+        return [(Image.from_hash(path, h), d) for path, h, d in nearest]
+
+    def get_nearest_neighbours(self, query: Image, num_neighbours: int, max_results: int = 16,
+                               max_distance: Optional[float] = None,
+                               stats: Optional[SearchStats] = None) -> List[Image]:
+        return [img for img, _ in self.get_nearest_neighbour_pairs(query, num_neighbours, max_results, max_distance,
+                                                                   stats)]
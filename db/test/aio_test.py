@@ -0,0 +1,110 @@
+import asyncio
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from db.aio import AsyncIndex
+from db.test.index_test import create_test_db
+from image.image import Image
+
+
+class SlowTree:
+    # counts the queries that reach the tree and how many ran at once
+    def __init__(self, tree, delay: float = 0.05):
+        self.tree = tree
+        self.delay = delay
+        self.calls = 0
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def get_within_distance_pairs(self, query, max_distance, stats=None):
+        with self.lock:
+            self.calls += 1
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(self.delay)
+        with self.lock:
+            self.running -= 1
+        return self.tree.get_within_distance_pairs(query, max_distance, stats)
+
+
+class CountingHasher:
+    def __init__(self):
+        self.calls = []
+
+    def hash(self, path, spec):
+        self.calls.append((path, spec))
+        time.sleep(0.01)
+        return 42
+
+
+class TestAsyncIndex(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.db = create_test_db(500)
+        self.hashes = sorted(self.db.image_hashes.values())
+
+    async def test_queries(self):
+        index = AsyncIndex(self.db)
+        for h in self.hashes[:10]:
+            result = await index.search(h, 10)
+            query = await index.query_image(h)
+            self.assertEqual(sorted((img.path, d) for img, d in self.db.tree.get_within_distance_pairs(query, 10)),
+                             sorted((img.path, d) for img, d in result))
+            nearest = await index.nearest(h, 5)
+            self.assertEqual([d for _, d in self.db.tree.get_nearest_neighbour_pairs(query, 5)],
+                             [d for _, d in nearest])
+        self.assertEqual({}, index.in_flight)
+
+    async def test_coalescing(self):
+        self.db.tree = SlowTree(self.db.tree)
+        hasher = CountingHasher()
+        index = AsyncIndex(self.db, hasher)
+        results = await asyncio.gather(*[index.search('/queries/a.jpg', 5) for _ in range(10)])
+        self.assertEqual(1, len(hasher.calls))
+        self.assertEqual(1, self.db.tree.calls)
+        self.assertTrue(all(r == results[0] for r in results))
+
+        # a caller giving up leaves the shared query running for the others
+        first = asyncio.ensure_future(index.search(self.hashes[0], 5))
+        second = asyncio.ensure_future(index.search(self.hashes[0], 5))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        self.assertEqual(await index.search(self.hashes[1], 5), await index.search(self.hashes[1], 5))
+        await second
+        self.assertTrue(first.cancelled())
+        self.assertEqual(4, self.db.tree.calls)
+        self.assertEqual({}, index.in_flight)
+
+    async def test_max_concurrency(self):
+        self.db.tree = SlowTree(self.db.tree, 0.02)
+        index = AsyncIndex(self.db, max_concurrency=2)
+        await asyncio.gather(*[index.search(h, 3) for h in self.hashes[:10]])
+        self.assertEqual(10, self.db.tree.calls)
+        self.assertEqual(2, self.db.tree.max_running)
+
+
+class TestOpen(unittest.TestCase):
+    def test_open_outside_loop(self):
+        # opened before the event loop exists, then queried from it with more queries than slots
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'db')
+            db = create_test_db(300)
+            db.encode(path)
+            hashes = sorted(db.image_hashes.values())[:12]
+            index = AsyncIndex.open(path, max_concurrency=3)
+
+            async def run():
+                return await asyncio.gather(*[index.search(h, 4) for h in hashes])
+
+            results = asyncio.run(run())
+            index.db.close()
+        for h, result in zip(hashes, results):
+            expected = db.tree.get_within_distance_pairs(Image.from_hash('', h), 4)
+            self.assertEqual(sorted((img.path, d) for img, d in expected), sorted((img.path, d) for img, d in result))
+
+
+if __name__ == '__main__':
+    unittest.main()
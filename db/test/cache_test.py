@@ -0,0 +1,75 @@
+import os
+import tempfile
+import unittest
+
+import numpy
+from PIL import Image as PILImage
+
+from db.cache import HashCache, QueryHasher, ResultCache
+from db.db import DB, new_tree
+from db.index import MappedIndex
+from image import image, pipeline
+from image.image import Image
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.image_path = os.path.join(self.tmp.name, 'query.png')
+        x = numpy.linspace(0, 255, 64)[None, :] + numpy.zeros((48, 1))
+        PILImage.fromarray(x.astype('uint8')).save(self.image_path)
+        self.hash = image.get_hash(self.image_path, 'dhash')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_hash_cache(self):
+        path = os.path.join(self.tmp.name, 'cache')
+        cache = HashCache(path)
+        cache.put((1, 2, 3), 'dhash_8', 1 << 63)
+        cache.close()
+
+        cache = HashCache(path)
+        self.assertEqual(1 << 63, cache.get((1, 2, 3), 'dhash_8'))
+        self.assertIsNone(cache.get((1, 2, 4), 'dhash_8'))
+        self.assertIsNone(cache.get((1, 2, 3), 'phash_8'))
+        cache.close()
+
+    def test_result_cache(self):
+        results = ResultCache(2)
+        results.put('a', [1])
+        results.put('b', [2])
+        self.assertEqual([1], results.get('a'))
+        results.put('c', [3])
+        self.assertIsNone(results.get('b'))
+        self.assertEqual([1], results.get('a'))
+        results.clear()
+        self.assertIsNone(results.get('a'))
+
+    def test_query_hasher(self):
+        fingerprint = pipeline.fingerprint(self.image_path)
+        # a stored hash that differs from the real one shows where the hash came from
+        stored = self.hash ^ 1
+        tree = new_tree(8)
+        tree.add_list([Image.from_hash(self.image_path, stored)])
+        db = DB(tree, list(tree.iter_points()), 'dhash', 8, {self.image_path: fingerprint})
+        self.assertEqual(stored, QueryHasher(db, None).hash(self.image_path, ('dhash', 8)))
+
+        index_path = os.path.join(self.tmp.name, 'index')
+        db.encode(index_path)
+        with MappedIndex(index_path) as index:
+            self.assertEqual(stored, QueryHasher(index, None).hash(self.image_path, ('dhash', 8)))
+            self.assertIsNone(index.stored_hash('/missing.png', 'dhash_8', fingerprint))
+
+        # a changed file is hashed again, and later served from the hash cache
+        db.fingerprints = {self.image_path: (0, 0, 0)}
+        cache = HashCache(os.path.join(self.tmp.name, 'cache'))
+        self.assertEqual(self.hash, QueryHasher(db, cache).hash(self.image_path, ('dhash', 8)))
+        self.assertEqual(self.hash, cache.get(fingerprint, 'dhash_8'))
+        cache.put(fingerprint, 'dhash_8', 42)
+        self.assertEqual(42, QueryHasher(db, cache).hash(self.image_path, ('dhash', 8)))
+        cache.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
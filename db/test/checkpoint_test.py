@@ -0,0 +1,65 @@
+import os
+import tempfile
+import unittest
+
+from db.checkpoint import Checkpoint
+
+SPECS = [('dhash', 8), ('phash', 8)]
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.dir.name, 'db')
+        self.images = []
+        for i in range(5):
+            path = os.path.join(self.dir.name, 'img{}.jpg'.format(i))
+            with open(path, 'wb') as f:
+                f.write(b'x' * i)
+            self.images.append(path)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, checkpoint: Checkpoint, paths, dhash: int = 0):
+        for i, path in enumerate(paths):
+            st = os.stat(path)
+            checkpoint.add(path, {'dhash_8': dhash + i, 'phash_8': 100 + i}, (st.st_size, st.st_mtime_ns, st.st_ino))
+
+    def test_resume(self):
+        with Checkpoint(self.db_path, SPECS, False) as checkpoint:
+            self.write(checkpoint, self.images[:3])
+        with open(checkpoint.path, 'ab') as f:
+            f.write(b'{"op": "add", "pa')
+
+        checkpoint = Checkpoint(self.db_path, SPECS, False)
+        self.assertEqual(set(self.images[:3]), set(checkpoint.hashed))
+        self.assertEqual([True] * 3 + [False] * 2, [checkpoint.is_hashed(path) for path in self.images])
+        with open(self.images[0], 'ab') as f:
+            f.write(b'changed')
+        self.assertFalse(checkpoint.is_hashed(self.images[0]))
+
+        self.write(checkpoint, self.images[3:], 3)
+        self.write(checkpoint, self.images[:1], 10)
+        imgs, fingerprints, extra_hashes = checkpoint.load(set(self.images[:4]))
+        checkpoint.close()
+        self.assertEqual({self.images[0]: 10, self.images[1]: 1, self.images[2]: 2, self.images[3]: 3},
+                         {img.path: img.hash for img in imgs})
+        self.assertEqual(set(self.images[:4]), set(fingerprints))
+        self.assertEqual({self.images[0]: 100, self.images[1]: 101, self.images[2]: 102, self.images[3]: 100},
+                         extra_hashes['phash_8'])
+
+    def test_other_settings(self):
+        with Checkpoint(self.db_path, SPECS, False) as checkpoint:
+            self.write(checkpoint, self.images)
+        with Checkpoint(self.db_path, SPECS[:1], False) as checkpoint:
+            self.assertEqual({}, checkpoint.hashed)
+        with Checkpoint(self.db_path, SPECS[:1], False, restart=True) as checkpoint:
+            self.assertEqual({}, checkpoint.hashed)
+            self.assertEqual([], checkpoint.load(set(self.images))[0])
+        checkpoint.remove()
+        self.assertFalse(os.path.exists(checkpoint.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
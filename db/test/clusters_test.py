@@ -0,0 +1,39 @@
+import os
+import tempfile
+import unittest
+
+from db.clusters import UnionFind, find_groups
+from db.db import DB, new_tree
+from image.image import Image
+
+
+class TestClusters(unittest.TestCase):
+    def test_union_find(self):
+        uf = UnionFind(6)
+        uf.union(0, 1)
+        uf.union(1, 2)
+        uf.union(4, 5)
+        self.assertEqual(uf.find(0), uf.find(2))
+        self.assertNotEqual(uf.find(0), uf.find(3))
+        self.assertEqual([[0, 1, 2], [4, 5]], sorted(uf.groups()))
+
+    def test_find_groups(self):
+        # 0b0000, 0b0001 and 0b0011 form a chain, 0b11110000 is alone, the last two are duplicates
+        hashes = [0b0000, 0b0001, 0b0011, 0b11110000, 0b111 << 40, 0b111 << 40]
+        images = [Image.from_hash(str(i), h) for i, h in enumerate(hashes)]
+        tree = new_tree(8)
+        tree.add_list(images)
+
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            DB(tree, images, 'dhash', 8).encode(path)
+            for workers in [1, 2]:
+                groups = sorted(find_groups(path, 1, workers))
+                self.assertEqual([['0', '1', '2'], ['4', '5']], groups)
+        finally:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+import os
+import random
+import tempfile
+import unittest
+
+from db.db import DB, decode, new_tree, open_index
+from db.index import MappedIndex, is_index
+from image.image import Image
+
+
+def create_test_db(num_images: int, hash_size: int = 8, engine: str = 'vptree') -> DB:
+    rnd = random.Random(0)
+    images = [Image.from_hash('/images/{}.jpg'.format(i), rnd.getrandbits(hash_size * hash_size))
+              for i in range(num_images)]
+    tree = new_tree(hash_size, engine)
+    tree.add_list(images)
+    return DB(tree, images, 'dhash', hash_size, engine=engine)
+
+
+class TestIndex(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_roundtrip(self):
+        for hash_size in [8, 16]:
+            db = create_test_db(500, hash_size)
+            db.encode(self.path)
+            self.assertTrue(is_index(self.path))
+
+            decoded = decode(self.path)
+            self.assertEqual(db.image_hashes, decoded.image_hashes)
+            self.assertEqual(db.hash_type, decoded.hash_type)
+            self.assertEqual(db.hash_size, decoded.hash_size)
+            self.assertEqual(len(db.images), decoded.tree.root.size())
+
+    def test_fingerprints(self):
+        db = create_test_db(100)
+        paths = sorted(db.image_hashes)
+        db.fingerprints = {path: (i, i * 1000, i + 7) for i, path in enumerate(paths[:50])}
+        db.encode(self.path)
+
+        decoded = decode(self.path)
+        self.assertEqual(db.fingerprints, decoded.fingerprints)
+
+        self.assertTrue(decoded.remove(paths[0]))
+        self.assertFalse(decoded.remove(paths[0]))
+        self.assertNotIn(paths[0], decoded.fingerprints)
+        self.assertFalse(decoded.tree.contains(Image.from_hash(paths[0], db.image_hashes[paths[0]])))
+
+    def test_find_path(self):
+        db = create_test_db(100)
+        db.encode(self.path)
+        with MappedIndex(self.path) as index:
+            for scan in [False, True]:
+                if scan:
+                    # as in files written before the path order was stored
+                    del index._sections['path_order']
+                for idx, path in enumerate(index.paths()):
+                    self.assertEqual(idx, index.find_path(path))
+                for path in ['/images/1', '1.jpg', '/images/100.jpg', '', '/', '/images/99.jpgx', '~']:
+                    self.assertIsNone(index.find_path(path))
+
+    def test_undecodable_paths(self):
+        # a POSIX file name that is not valid UTF-8, as the scanner returns it
+        name = os.fsdecode(b'/images/caf\xe9.png')
+        db = create_test_db(50)
+        db.add([Image.from_hash(name, 12345)], {name: (1, 2, 3)})
+        db.encode(self.path)
+        with open(self.path, 'rb') as f:
+            self.assertIn(b'/images/caf\xe9.png', f.read())
+
+        self.assertEqual(db.image_hashes, decode(self.path).image_hashes)
+        with MappedIndex(self.path) as index:
+            idx = index.find_path(name)
+            self.assertEqual(name, index.path(idx))
+            self.assertEqual(12345, index.stored_hash(name, 'dhash_8', (1, 2, 3)))
+
+    def test_extra_hashes(self):
+        db = create_test_db(200)
+        rnd = random.Random(1)
+        db.extra_hashes = {
+            'phash_8': {path: rnd.getrandbits(64) for path in db.image_hashes},
+            'whash_16': {path: rnd.getrandbits(256) for path in db.image_hashes},
+        }
+        db.encode(self.path)
+
+        decoded = decode(self.path)
+        self.assertEqual(db.extra_hashes, decoded.extra_hashes)
+        self.assertEqual([('dhash', 8), ('phash', 8), ('whash', 16)], decoded.hash_specs())
+
+        path, h = next(iter(db.extra_hashes['whash_16'].items()))
+        with MappedIndex(self.path) as index:
+            self.assertIn(path, [img.path for img in index.tree_for('whash_16').get_within_distance(
+                Image.from_hash('', h), 0)])
+            self.assertRaises(ValueError, index.tree_for, 'ahash_8')
+
+        self.assertTrue(decoded.reindex('whash', 16))
+        self.assertEqual(('whash', 16), (decoded.hash_type, decoded.hash_size))
+        self.assertEqual(db.image_hashes, decoded.extra_hashes['dhash_8'])
+        self.assertTrue(decoded.tree.contains(Image.from_hash(path, h)))
+        self.assertFalse(decoded.reindex('ahash', 8))
+
+    def test_mapped_queries(self):
+        db = create_test_db(500)
+        db.encode(self.path)
+        with MappedIndex(self.path) as index:
+            for query in list(db.images)[:20]:
+                for max_distance in [0, 10, 20]:
+                    self.assertEqual(sorted(db.tree.get_within_distance(query, max_distance)),
+                                     sorted(index.tree.get_within_distance(query, max_distance)))
+                nearest = index.tree.get_nearest_neighbours(query, 3, 3)
+                self.assertEqual(query, nearest[0])
+
+    def test_mih_engine(self):
+        db = create_test_db(500, engine='mih')
+        db.encode(self.path)
+
+        decoded = decode(self.path)
+        self.assertEqual('mih', decoded.engine)
+        self.assertEqual(db.image_hashes, decoded.image_hashes)
+        self.assertEqual(len(db.images), decoded.tree.size())
+
+        vptree = create_test_db(500)
+        with MappedIndex(self.path) as index:
+            for query in list(db.images)[:20]:
+                for max_distance in [0, 10, 20]:
+                    expected = sorted(vptree.tree.get_within_distance(query, max_distance))
+                    self.assertEqual(expected, sorted(decoded.tree.get_within_distance(query, max_distance)))
+                    self.assertEqual(expected, sorted(index.tree.get_within_distance(query, max_distance)))
+                self.assertEqual(query, index.tree.get_nearest_neighbours(query, 3, 3)[0])
+
+        decoded.set_engine('vptree')
+        decoded.encode(self.path)
+        with MappedIndex(self.path) as index:
+            self.assertEqual('vptree', index.engine)
+            self.assertEqual(db.image_hashes, dict(zip(index.paths(), index.hashes('hashes', 1))))
+
+    def test_empty(self):
+        create_test_db(0).encode(self.path)
+        with MappedIndex(self.path) as index:
+            self.assertEqual([], index.tree.get_within_distance(Image.from_hash('', 0), 64))
+        self.assertEqual({}, decode(self.path).image_hashes)
+
+    def test_open_index(self):
+        create_test_db(10).encode(self.path)
+        index = open_index(self.path)
+        self.assertIsInstance(index, MappedIndex)
+        index.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
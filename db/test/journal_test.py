@@ -0,0 +1,95 @@
+import os
+import random
+import tempfile
+import unittest
+
+from db import journal
+from db.db import decode, log_changes, open_index
+from db.journal import JournaledIndex
+from db.test.index_test import create_test_db
+from image.image import Image
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'db')
+        self.db = create_test_db(200)
+        self.db.encode(self.path)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_replay(self):
+        removed = sorted(self.db.image_hashes)[:3]
+        added = Image.from_hash('/images/new.jpg', 5)
+        log_changes(self.path, [journal.remove_record(path) for path in removed] +
+                    [journal.add_record(added, {'dhash_8': added.hash}, (1, 2, 3))])
+        self.assertTrue(os.path.exists(journal.journal_path(self.path)))
+
+        decoded = decode(self.path)
+        for path in removed:
+            self.assertNotIn(path, decoded.image_hashes)
+        self.assertEqual(5, decoded.image_hashes[added.path])
+        self.assertEqual((1, 2, 3), decoded.fingerprints[added.path])
+        self.assertEqual(len(self.db.images) - 2, len(decoded.images))
+        self.assertEqual(len(decoded.images), decoded.tree.root.size())
+
+        decoded.encode(self.path)
+        self.assertFalse(os.path.exists(journal.journal_path(self.path)))
+        self.assertEqual(decoded.image_hashes, decode(self.path).image_hashes)
+
+    def test_save(self):
+        db = decode(self.path)
+        db.remove(next(iter(db.image_hashes)))
+        db.add([Image.from_hash('/images/new.jpg', 5)], {})
+        index_stat = os.stat(self.path)
+        db.save(self.path)
+        self.assertEqual(index_stat.st_ino, os.stat(self.path).st_ino)
+        self.assertEqual(2, len(journal.read(self.path)))
+        self.assertEqual(db.image_hashes, decode(self.path).image_hashes)
+
+    def test_compacts_long_logs(self):
+        records = [journal.add_record(Image.from_hash('/images/new/{}.jpg'.format(i), i), {'dhash_8': i}, None)
+                   for i in range(20000)]
+        log_changes(self.path, records)
+        self.assertFalse(os.path.exists(journal.journal_path(self.path)))
+        self.assertEqual(len(self.db.images) + len(records), len(decode(self.path).images))
+
+    def test_torn_and_stale_logs(self):
+        log_changes(self.path, [journal.remove_record(sorted(self.db.image_hashes)[0])])
+        with open(journal.journal_path(self.path), 'ab') as f:
+            f.write(b'{"op": "remove", "pa')
+        self.assertEqual(1, len(journal.read(self.path)))
+
+        log_changes(self.path, [journal.remove_record(sorted(self.db.image_hashes)[1])])
+        self.assertEqual(2, len(journal.read(self.path)))
+
+        # a log written against an index that has since been replaced is ignored
+        self.db.encode(self.path + '.new')
+        os.replace(self.path + '.new', self.path)
+        self.assertEqual([], journal.read(self.path))
+        self.assertEqual(self.db.image_hashes, decode(self.path).image_hashes)
+
+    def test_queries(self):
+        rnd = random.Random(1)
+        removed = rnd.sample(sorted(self.db.image_hashes), 20)
+        added = [Image.from_hash('/images/new/{}.jpg'.format(i), rnd.getrandbits(64)) for i in range(20)]
+        log_changes(self.path, [journal.remove_record(path) for path in removed] +
+                    [journal.add_record(img, {'dhash_8': img.hash}, None) for img in added])
+        expected = decode(self.path)
+
+        with open_index(self.path) as index:
+            self.assertIsInstance(index, JournaledIndex)
+            self.assertTrue(index.contains(added[0].path))
+            self.assertFalse(index.contains(removed[0]))
+            for i in range(20):
+                query = Image.from_hash('', rnd.getrandbits(64))
+                self.assertEqual(sorted(d for _, d in expected.tree.get_within_distance_pairs(query, 24)),
+                                 sorted(d for _, d in index.tree.get_within_distance_pairs(query, 24)))
+                self.assertEqual([d for _, d in expected.tree.get_nearest_neighbour_pairs(query, 5)],
+                                 [d for _, d in index.tree.get_nearest_neighbour_pairs(query, 5)])
+
+
+if __name__ == '__main__':
+    unittest.main()
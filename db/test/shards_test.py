@@ -0,0 +1,94 @@
+import os
+import random
+import tempfile
+import unittest
+
+from db.db import decode, open_index
+from db.shards import Manifest, ShardedDB, ShardedIndex, is_manifest
+from image.image import Image
+
+
+def create_sharded_db(path: str, num_images: int, num_shards: int, strategy: str = 'hash') -> ShardedDB:
+    rnd = random.Random(0)
+    images = [Image.from_hash('/images/{}/{}.jpg'.format(i % 10, i), rnd.getrandbits(64)) for i in range(num_images)]
+    return ShardedDB.create(path, images, 'dhash', 8, {}, {}, 'vptree', num_shards, strategy)
+
+
+class TestShards(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'db')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_roundtrip(self):
+        db = create_sharded_db(self.path, 300, 4)
+        db.encode(self.path)
+        self.assertTrue(is_manifest(self.path))
+        self.assertFalse(is_manifest(db.manifest.shards[0]))
+
+        decoded = decode(self.path)
+        self.assertEqual(dict(db.image_hashes), dict(decoded.image_hashes))
+        for i, shard in enumerate(decoded.shards):
+            self.assertGreater(len(shard.images), 0)
+            for path in shard.image_hashes:
+                self.assertEqual(i, decoded.manifest.shard_of(path))
+
+    def test_prefix(self):
+        db = create_sharded_db(self.path, 300, 3, 'prefix')
+        for shard in db.shards:
+            directories = {os.path.dirname(path) for path in shard.image_hashes}
+            for other in db.shards:
+                if other is not shard:
+                    self.assertTrue(directories.isdisjoint(os.path.dirname(path) for path in other.image_hashes))
+
+    def test_queries(self):
+        db = create_sharded_db(self.path, 500, 4)
+        db.encode(self.path)
+        merged = db.merged()
+        queries = [Image.from_hash('', random.Random(i).getrandbits(64)) for i in range(20)]
+
+        for workers in [1, 2]:
+            with open_index(self.path, workers) as index:
+                self.assertIsInstance(index, ShardedIndex)
+                for query in queries:
+                    expected = sorted(d for _, d in merged.tree.get_within_distance_pairs(query, 24))
+                    found = sorted(d for _, d in index.tree.get_within_distance_pairs(query, 24))
+                    self.assertEqual(expected, found)
+
+                    expected = [d for _, d in merged.tree.get_nearest_neighbour_pairs(query, 5)]
+                    found = [d for _, d in index.tree.get_nearest_neighbour_pairs(query, 5)]
+                    self.assertEqual(expected, found)
+
+    def test_updates_touch_one_shard(self):
+        db = create_sharded_db(self.path, 200, 4)
+        db.encode(self.path)
+        mtimes = [os.stat(shard).st_mtime_ns for shard in db.manifest.shards]
+
+        path = next(iter(db.image_hashes))
+        shard = db.manifest.shard_of(path)
+        self.assertTrue(db.remove(path))
+        self.assertFalse(db.remove(path))
+        self.assertEqual({shard}, db.dirty)
+        db.add([Image.from_hash('/images/new.jpg', 1)], {})
+        db.save(self.path)
+
+        decoded = decode(self.path)
+        self.assertNotIn(path, decoded.image_hashes)
+        self.assertEqual(1, decoded.image_hashes['/images/new.jpg'])
+        changed = {shard, db.manifest.shard_of('/images/new.jpg')}
+        for i, shard_path in enumerate(db.manifest.shards):
+            if i not in changed:
+                self.assertEqual(mtimes[i], os.stat(shard_path).st_mtime_ns)
+
+    def test_moved_manifest(self):
+        db = create_sharded_db(self.path, 50, 2)
+        out = os.path.join(self.dir.name, 'out')
+        db.encode(out)
+        self.assertEqual([out + '.0', out + '.1'], Manifest.read(out).shards)
+        self.assertEqual(dict(db.image_hashes), dict(decode(out).image_hashes))
+
+
+if __name__ == '__main__':
+    unittest.main()
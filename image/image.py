@@ -1,31 +1,208 @@
-import imagehash
-from PIL import Image as PILImage
-from imagehash import ImageHash
+import functools
+import io
+import math
+import struct
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
 
+import numpy
 
-def _get_hash(image_path: str, hash_type: str, hash_size: int = 8) -> imagehash.ImageHash:
-    hash_strs = {
-        'phash': imagehash.phash,
-        'dhash': imagehash.dhash,
-        'ahash': imagehash.average_hash,
-        'whash': imagehash.whash
-    }
-    if hash_type not in hash_strs:
-        raise ValueError('invalid hash type {}'.format(hash_type))
-    img = PILImage.open(image_path)
-    return hash_strs[hash_type](img, hash_size)
+from vptree.node import LeafKernel
+
+if TYPE_CHECKING:
+    from PIL import Image as PILImage
+    from imagehash import ImageHash
+
+WORD_BITS = 64
+WORD_MASK = (1 << WORD_BITS) - 1
+_POPCOUNT_TABLE = numpy.array([bin(i).count('1') for i in range(256)], dtype=numpy.uint8)
+
+
+# hash type -> imagehash function; imagehash, PIL and scipy are only imported once an image is hashed, so
+# queries answered from stored hashes never load them
+HASH_FUNCS = {
+    'phash': 'phash',
+    'dhash': 'dhash',
+    'ahash': 'average_hash',
+    'whash': 'whash'
+}
+# smallest resolution a JPEG is decoded at: decoding at 1/8 scale straight down to the hash resolution
+# changes the antialiased resize enough to flip bits, a few hundred pixels keeps hashes in agreement
+DRAFT_MIN_SIZE = 512
+# reject EXIF thumbnails whose aspect ratio differs more than this from the image (cropped or letterboxed)
+THUMBNAIL_ASPECT_TOLERANCE = 0.02
+
+
+def _whash_scale(image_size: Tuple[int, int], hash_size: int) -> int:
+    # the scale imagehash.whash derives from the full-resolution image
+    return max(2 ** int(math.log2(min(image_size))), hash_size)
+
+
+def _hash_input_size(hash_type: str, hash_size: int, image_size: Tuple[int, int]) -> Tuple[int, int]:
+    # resolution each hash function resizes the image to before hashing
+    if hash_type == 'dhash':
+        return hash_size + 1, hash_size
+    if hash_type == 'phash':
+        return hash_size * 4, hash_size * 4
+    if hash_type == 'whash':
+        scale = _whash_scale(image_size, hash_size)
+        return scale, scale
+    return hash_size, hash_size
+
+
+def _hash_func(hash_type: str) -> Callable[..., 'ImageHash']:
+    import imagehash
+    return getattr(imagehash, HASH_FUNCS[hash_type])
+
+
+def _exif_thumbnail(img: 'PILImage.Image') -> Optional['PILImage.Image']:
+    from PIL import Image as PILImage
+
+    # the JPEG thumbnail referenced from IFD1 of the EXIF block, if any
+    exif = img.info.get('exif')
+    if not exif:
+        return None
+    if exif.startswith(b'Exif\x00\x00'):
+        exif = exif[6:]
+    if exif[:2] == b'II':
+        order = '<'
+    elif exif[:2] == b'MM':
+        order = '>'
+    else:
+        return None
+
+    try:
+        ifd0 = struct.unpack_from(order + 'I', exif, 4)[0]
+        entries = struct.unpack_from(order + 'H', exif, ifd0)[0]
+        ifd1 = struct.unpack_from(order + 'I', exif, ifd0 + 2 + entries * 12)[0]
+        if ifd1 == 0:
+            return None
+        offset = length = None
+        for i in range(struct.unpack_from(order + 'H', exif, ifd1)[0]):
+            tag, _, _, value = struct.unpack_from(order + 'HHII', exif, ifd1 + 2 + i * 12)
+            if tag == 0x0201:
+                offset = value
+            elif tag == 0x0202:
+                length = value
+        if offset is None or length is None or offset + length > len(exif):
+            return None
+        thumbnail = PILImage.open(io.BytesIO(exif[offset:offset + length]))
+        thumbnail.load()
+        return thumbnail
+    except (struct.error, OSError):
+        return None
+
+
+def _thumbnail_usable(thumbnail: 'PILImage.Image', image_size: Tuple[int, int], needed: Tuple[int, int]) -> bool:
+    if thumbnail.size[0] < needed[0] or thumbnail.size[1] < needed[1]:
+        return False
+    image_aspect = image_size[0] / image_size[1]
+    thumbnail_aspect = thumbnail.size[0] / thumbnail.size[1]
+    return abs(thumbnail_aspect - image_aspect) <= THUMBNAIL_ASPECT_TOLERANCE * image_aspect
+
+
+def hash_key(hash_type: str, hash_size: int) -> str:
+    return '{}_{}'.format(hash_type, hash_size)
+
+
+def parse_hash_key(key: str) -> Tuple[str, int]:
+    hash_type, _, hash_size = key.rpartition('_')
+    if hash_type not in HASH_FUNCS or not hash_size.isdigit():
+        raise ValueError('invalid hash {}, expected <hash type>_<hash size> like dhash_8'.format(key))
+    return hash_type, int(hash_size)
+
+
+def _get_hashes(image_path: str, specs: List[Tuple[str, int]], reduced: bool = True,
+                exif_thumbnails: bool = False) -> Dict[str, 'ImageHash']:
+    from PIL import Image as PILImage
+
+    # every requested hash is computed from a single decode of the image
+    for hash_type, _ in specs:
+        if hash_type not in HASH_FUNCS:
+            raise ValueError('invalid hash type {}'.format(hash_type))
+
+    result = {}
+    with PILImage.open(image_path) as img:
+        image_size = img.size
+        needed = {spec: _hash_input_size(spec[0], spec[1], image_size) for spec in specs}
+        hash_funcs = {spec: _hash_func(spec[0]) for spec in specs}
+        for spec in specs:
+            if spec[0] == 'whash':
+                # pin the wavelet scale to the full-resolution one, or a smaller decode would change it
+                hash_funcs[spec] = functools.partial(hash_funcs[spec], image_scale=needed[spec][0])
+
+        if reduced and exif_thumbnails:
+            # only JPEG thumbnails with the image's aspect ratio and enough resolution are trusted;
+            # whash needs far more pixels than a thumbnail has
+            thumbnail = _exif_thumbnail(img)
+            for spec in specs:
+                if thumbnail is not None and spec[0] != 'whash' and \
+                        _thumbnail_usable(thumbnail, image_size, needed[spec]):
+                    result[hash_key(*spec)] = hash_funcs[spec](thumbnail, spec[1])
+
+        remaining = [spec for spec in specs if hash_key(*spec) not in result]
+        if len(remaining) == 0:
+            return result
+
+        if reduced:
+            # JPEG only: let the decoder scale down by 1/2, 1/4 or 1/8 while decoding
+            width = max([needed[spec][0] for spec in remaining] + [DRAFT_MIN_SIZE])
+            height = max([needed[spec][1] for spec in remaining] + [DRAFT_MIN_SIZE])
+            img.draft(img.mode, (width, height))
+        # the hash functions all start with convert('L'), converting once here leaves them a cheap copy
+        gray = img.convert('L') if len(remaining) > 1 else img
+        for spec in remaining:
+            result[hash_key(*spec)] = hash_funcs[spec](gray, spec[1])
+    return result
+
+
+def _get_hash(image_path: str, hash_type: str, hash_size: int = 8, reduced: bool = True,
+              exif_thumbnails: bool = False) -> 'ImageHash':
+    return _get_hashes(image_path, [(hash_type, hash_size)], reduced, exif_thumbnails)[hash_key(hash_type, hash_size)]
+
+
+def pack_hash(image_hash: 'ImageHash') -> int:
+    # str(ImageHash) is the hex encoding of the flattened bit array, most significant bit first
+    return int(str(image_hash), 16)
+
+
+def get_hash(image_path: str, hash_type: str, hash_size: int = 8, exif_thumbnails: bool = False) -> int:
+    return pack_hash(_get_hash(image_path, hash_type, hash_size, exif_thumbnails=exif_thumbnails))
+
+
+def get_hashes(image_path: str, specs: List[Tuple[str, int]], exif_thumbnails: bool = False) -> Dict[str, int]:
+    hashes = _get_hashes(image_path, specs, exif_thumbnails=exif_thumbnails)
+    return {key: pack_hash(h) for key, h in hashes.items()}
+
+
+if hasattr(int, 'bit_count'):
+    def popcount(x: int) -> int:
+        return x.bit_count()
+else:
+    def popcount(x: int) -> int:
+        return bin(x).count('1')
+
+
+def hash_words(image_hash: int, num_words: int) -> List[int]:
+    return [(image_hash >> (WORD_BITS * i)) & WORD_MASK for i in range(num_words)]
 
 
 class Image:
-    hash: ImageHash
+    hash: int
     path: str
 
     def __init__(self, path: str, hash_type: str, hash_size: int = 8):
         self.path = path
-        self.hash = _get_hash(path, hash_type, hash_size)
+        self.hash = get_hash(path, hash_type, hash_size)
+
+    @classmethod
+    def from_hash(cls, path: str, image_hash: int) -> 'Image':
+        img = cls.__new__(cls)
+        img.path = path
+        img.hash = image_hash
+        return img
 
-    def distance(self, other: 'Image') -> float:
-        return self.hash - other.hash
+    def distance(self, other: 'Image') -> int:
+        return popcount(self.hash ^ other.hash)
 
     def __lt__(self, other: 'Image') -> bool:
         return self.path < other.path
@@ -37,5 +214,19 @@ class Image:
         return hash((self.path, self.hash))
 
 
-def distance_fn(im1: Image, im2: Image) -> float:
-    return im1.distance(im2)
+def distance_fn(im1: Image, im2: Image) -> int:
+    return popcount(im1.hash ^ im2.hash)
+
+
+class HashKernel(LeafKernel):
+    num_words: int
+
+    def __init__(self, hash_size: int = 8):
+        self.num_words = max(1, (hash_size * hash_size + WORD_BITS - 1) // WORD_BITS)
+
+    def pack(self, points: List[Image]) -> numpy.ndarray:
+        return numpy.array([hash_words(p.hash, self.num_words) for p in points], dtype=numpy.uint64)
+
+    def distances(self, query: Image, packed: numpy.ndarray) -> List[int]:
+        xor = packed ^ numpy.array(hash_words(query.hash, self.num_words), dtype=numpy.uint64)
+        return _POPCOUNT_TABLE[xor.view(numpy.uint8)].sum(axis=1).tolist()
@@ -0,0 +1,50 @@
+import functools
+import os
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from image.image import get_hashes
+
+CHUNK_SIZE = 16
+# recycle worker processes now and then so memory fragmented by large decodes is returned
+MAX_TASKS_PER_CHILD = 1000
+
+# size, modification time in nanoseconds and inode of a file
+Fingerprint = Tuple[int, int, int]
+# path, hashes by hash key, fingerprint, error
+HashResult = Tuple[str, Optional[Dict[str, int]], Optional[Fingerprint], Optional[str]]
+
+
+def fingerprint(path: str) -> Fingerprint:
+    st = os.stat(path)
+    return st.st_size, st.st_mtime_ns, st.st_ino
+
+
+def same_file(old: Optional[Fingerprint], new: Fingerprint, check_inode: bool = False) -> bool:
+    if old is None:
+        return False
+    if check_inode:
+        return old == new
+    return old[:2] == new[:2]
+
+
+def hash_file(specs: List[Tuple[str, int]], exif_thumbnails: bool, path: str) -> HashResult:
+    try:
+        # stat before decoding, so a file modified while being hashed looks changed on the next update
+        fp = fingerprint(path)
+        return path, get_hashes(path, specs, exif_thumbnails), fp, None
+    except Exception as e:
+        # any failure is this file's error, it must not abort the whole run, e.g. PIL's DecompressionBombError
+        return path, None, None, str(e)
+
+
+def hash_paths(paths: Iterable[str], specs: List[Tuple[str, int]], workers: int = 1,
+               exif_thumbnails: bool = False) -> Iterator[HashResult]:
+    func = functools.partial(hash_file, specs, exif_thumbnails)
+    if workers <= 1:
+        yield from map(func, paths)
+        return
+
+    # imported here, single-process hashing and queries from stored hashes never need it
+    from multiprocessing import Pool
+    with Pool(workers, maxtasksperchild=MAX_TASKS_PER_CHILD) as pool:
+        yield from pool.imap_unordered(func, paths, CHUNK_SIZE)
@@ -0,0 +1,96 @@
+import io
+import os
+import random
+import struct
+import tempfile
+import unittest
+
+import numpy
+from PIL import Image as PILImage
+from imagehash import ImageHash
+
+from image import image
+
+
+def random_image_hash(rnd: numpy.random.RandomState, hash_size: int) -> ImageHash:
+    return ImageHash(rnd.randint(0, 2, (hash_size, hash_size)).astype(bool))
+
+
+def gradient(width: int, height: int, flip: bool = False) -> PILImage.Image:
+    x = numpy.linspace(0, 255, width)[None, :] + numpy.zeros((height, 1))
+    if flip:
+        x = x[:, ::-1]
+    return PILImage.fromarray(x.astype('uint8')).convert('RGB')
+
+
+def exif_with_thumbnail(thumbnail: PILImage.Image) -> bytes:
+    buf = io.BytesIO()
+    thumbnail.save(buf, 'JPEG')
+    data = buf.getvalue()
+    # TIFF header, an empty IFD0 pointing to IFD1, IFD1 with the thumbnail offset and length
+    tiff = b'II*\x00' + struct.pack('<I', 8)
+    tiff += struct.pack('<HI', 0, 14)
+    tiff += struct.pack('<H', 2)
+    tiff += struct.pack('<HHII', 0x0201, 4, 1, 44) + struct.pack('<HHII', 0x0202, 4, 1, len(data))
+    tiff += struct.pack('<I', 0)
+    return b'Exif\x00\x00' + tiff + data
+
+
+class TestImage(unittest.TestCase):
+    def test_pack_hash(self):
+        rnd = numpy.random.RandomState(0)
+        for hash_size in [4, 5, 8, 16]:
+            for _ in range(20):
+                h1 = random_image_hash(rnd, hash_size)
+                h2 = random_image_hash(rnd, hash_size)
+                im1 = image.Image.from_hash('a', image.pack_hash(h1))
+                im2 = image.Image.from_hash('b', image.pack_hash(h2))
+                self.assertEqual(h1 - h2, im1.distance(im2))
+                self.assertEqual(h1 - h2, image.distance_fn(im1, im2))
+
+    def test_hash_kernel(self):
+        rnd = random.Random(0)
+        for hash_size in [8, 11, 16]:
+            bits = hash_size * hash_size
+            kernel = image.HashKernel(hash_size)
+            points = [image.Image.from_hash(str(i), rnd.getrandbits(bits)) for i in range(50)]
+            query = image.Image.from_hash('q', rnd.getrandbits(bits))
+            packed = kernel.pack(points)
+            self.assertEqual([query.distance(p) for p in points], kernel.distances(query, packed))
+
+    def test_reduced_decoding(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'image.jpg')
+            gradient(2000, 1500).save(path)
+            for hash_type in image.HASH_FUNCS:
+                full = image._get_hash(path, hash_type, reduced=False)
+                reduced = image._get_hash(path, hash_type)
+                self.assertLessEqual(full - reduced, 2)
+
+    def test_get_hashes(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'image.jpg')
+            gradient(1200, 900).save(path)
+            specs = [(hash_type, hash_size) for hash_type in image.HASH_FUNCS for hash_size in [8, 16]]
+            hashes = image.get_hashes(path, specs)
+            for hash_type, hash_size in specs:
+                self.assertEqual(image.get_hash(path, hash_type, hash_size),
+                                 hashes[image.hash_key(hash_type, hash_size)])
+
+    def test_exif_thumbnail(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            # the thumbnail is mirrored, so a hash computed from it is easy to tell apart
+            path = os.path.join(tmp, 'image.jpg')
+            gradient(1600, 1200).save(path, exif=exif_with_thumbnail(gradient(160, 120, flip=True)))
+            mismatched = os.path.join(tmp, 'mismatched.jpg')
+            gradient(1600, 1200).save(mismatched, exif=exif_with_thumbnail(gradient(160, 160, flip=True)))
+
+            full = image.get_hash(path, 'dhash')
+            self.assertNotEqual(full, image.get_hash(path, 'dhash', exif_thumbnails=True))
+            self.assertEqual(full, image.get_hash(mismatched, 'dhash', exif_thumbnails=True))
+            # whash never uses thumbnails
+            self.assertEqual(image.get_hash(path, 'whash'), image.get_hash(path, 'whash', exif_thumbnails=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
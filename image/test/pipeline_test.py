@@ -0,0 +1,58 @@
+import os
+import struct
+import tempfile
+import unittest
+import zlib
+
+import numpy
+from PIL import Image as PILImage
+
+from image import pipeline
+
+SPECS = [('dhash', 8), ('phash', 8)]
+
+
+def png_header(width: int, height: int) -> bytes:
+    # a PNG that claims the given size, without any pixel data
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
+
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) + \
+        chunk(b'IEND', b'')
+
+
+class TestPipeline(unittest.TestCase):
+    def test_pooled_hashing(self):
+        rnd = numpy.random.RandomState(0)
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = []
+            for i in range(40):
+                path = os.path.join(tmp, '{}.png'.format(i))
+                PILImage.fromarray(rnd.randint(0, 256, (32, 32, 3)).astype('uint8')).save(path)
+                paths.append(path)
+            # undecodable, missing, a directory and a decompression bomb, spread among the images
+            broken = os.path.join(tmp, 'broken.jpg')
+            with open(broken, 'wb') as f:
+                f.write(b'\xff\xd8\xff not really')
+            # PIL refuses to open it with a DecompressionBombError, which is not an OSError
+            bomb = os.path.join(tmp, 'bomb.png')
+            with open(bomb, 'wb') as f:
+                f.write(png_header(20000, 20000))
+            failing = [broken, os.path.join(tmp, 'missing.png'), tmp, bomb]
+            for i, path in enumerate(failing):
+                paths.insert(i * 12, path)
+
+            serial = {r[0]: r for r in pipeline.hash_paths(paths, SPECS, 1)}
+            pooled = list(pipeline.hash_paths(paths, SPECS, 3))
+
+        self.assertEqual(len(paths), len(pooled))
+        self.assertEqual(serial, {r[0]: r for r in pooled})
+        self.assertEqual(sorted(failing), sorted(path for path, _, _, error in pooled if error is not None))
+        for path, hashes, fingerprint, error in pooled:
+            if error is None:
+                self.assertEqual({'dhash_8', 'phash_8'}, set(hashes))
+                self.assertIsNotNone(fingerprint)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,49 @@
 import argparse
-import multiprocessing
+import importlib
 import os
+from typing import Callable
+
+import cli.scanner
+import db.options
+
+CPU_COUNT = os.cpu_count() or 1
+QUERY_HELP = 'query image, or with --batch a directory, a file listing one path per line or - for stdin'
+BATCH_HELP = 'run every query in one process and print JSON lines with path, match and distance'
+EXTRA_HASHES_HELP = 'comma-separated additional hashes to store, computed from the same decode, e.g. phash_8,whash_16'
+QUERY_HASH_TYPE_HELP = 'query by another stored hash type, defaults to the indexed one'
+QUERY_HASH_SIZE_HELP = 'query by another stored hash size, defaults to the indexed one'
+SEARCH_WORKERS_HELP = 'number of hashing processes in batch mode, and of query processes on a sharded database'
+INDEX_HELP = 'index engine: vptree (metric tree) or mih (multi-index hashing, fastest for small distances)'
+
+
+def lazy(module: str, name: str) -> Callable:
+    # commands import their implementation only when run, so --help and commands answered from stored hashes
+    # skip the imaging libraries
+    def run(args):
+        return getattr(importlib.import_module(module), name)(args)
+    return run
+
+
+def add_scan_arguments(subparser: argparse.ArgumentParser):
+    subparser.add_argument('--filter', default='extension', choices=cli.scanner.FILTERS,
+                           help='select images by file extension, by magic bytes, or try every file')
+    subparser.add_argument('--follow_symlinks', action='store_true', help='descend into symlinked directories')
+    subparser.add_argument('--scan_threads', default=4, type=int, help='number of directory scanning threads')
+
+
+def add_hash_arguments(subparser: argparse.ArgumentParser):
+    subparser.add_argument('--workers', default=CPU_COUNT, type=int,
+                           help='number of hashing processes')
+    subparser.add_argument('--exif_thumbnails', action='store_true',
+                           help='hash embedded EXIF thumbnails when they match the image aspect ratio; '
+                                'faster, but a thumbnail not updated after editing gives a stale hash')
 
-import cli.commands
 
 parser = argparse.ArgumentParser(description='reverse image search')
 parser.add_argument('--db', help='path to database file', default='db.db')
+parser.add_argument('--stats', '--profile', dest='stats', action='store_true',
+                    help='report time per phase, files per second, failures, distance calls and peak memory '
+                         'on stderr when the command finishes')
 
 subparsers = parser.add_subparsers()
 parser_init = subparsers.add_parser('init', help='initialize database')
@@ -13,45 +51,96 @@ parser_init.add_argument('--dir', default=os.curdir, help='directory to scan for
 parser_init.add_argument('--recursive', '-r', default=True, help='build recursively')
 parser_init.add_argument('--hash_type', default='dhash', type=str, help='hash type')
 parser_init.add_argument('--hash_size', default=8, type=int, help='hash size')
-parser_init.set_defaults(func=cli.commands.init)
+parser_init.add_argument('--extra_hashes', default='', type=str, help=EXTRA_HASHES_HELP)
+parser_init.add_argument('--index', default='vptree', choices=db.options.ENGINES, help=INDEX_HELP)
+parser_init.add_argument('--shards', default=1, type=int,
+                         help='split the database into this many files, queried in parallel')
+parser_init.add_argument('--shard_by', default='hash', choices=db.options.SHARD_STRATEGIES,
+                         help='assign images to shards by a hash of their path, or of their directory')
+parser_init.add_argument('--restart', action='store_true',
+                         help='hash every image again instead of resuming from the checkpoint of an interrupted run')
+add_hash_arguments(parser_init)
+add_scan_arguments(parser_init)
+parser_init.set_defaults(func=lazy('cli.commands', 'init'))
 
 parser_add = subparsers.add_parser('add', help='add new image to database')
 parser_add.add_argument('image', metavar='image', help='path to image')
-parser_add.set_defaults(func=cli.commands.add)
+parser_add.set_defaults(func=lazy('cli.commands', 'add'))
 
-parser_update = subparsers.add_parser('update', help='scan directory and add new images')
+parser_update = subparsers.add_parser('update', help='rehash new and changed images, drop deleted ones')
 parser_update.add_argument('--dir', default=os.curdir, help='directory to scan for images')
 parser_update.add_argument('--recursive', '-r', default=True, help='update recursively')
-parser_update.set_defaults(func=cli.commands.update)
+parser_update.add_argument('--check_inode', action='store_true',
+                           help='also treat a file as changed when its inode changes')
+add_hash_arguments(parser_update)
+add_scan_arguments(parser_update)
+parser_update.set_defaults(func=lazy('cli.commands', 'update'))
 
 parser_search = subparsers.add_parser('search', help='search for similar images')
-parser_search.add_argument('query', metavar='query', help='query image')
+parser_search.add_argument('query', metavar='query', help=QUERY_HELP)
 parser_search.add_argument('--max_distance', default=3, type=int)
-parser_search.set_defaults(func=cli.commands.search_by_distance)
+parser_search.add_argument('--hash_type', default='', type=str, help=QUERY_HASH_TYPE_HELP)
+parser_search.add_argument('--hash_size', default=0, type=int, help=QUERY_HASH_SIZE_HELP)
+parser_search.add_argument('--batch', action='store_true', help=BATCH_HELP)
+parser_search.add_argument('--workers', default=CPU_COUNT, type=int, help=SEARCH_WORKERS_HELP)
+parser_search.set_defaults(func=lazy('cli.commands', 'search_by_distance'))
 
 parser_nearest = subparsers.add_parser('nearest', help='get nearest images')
-parser_nearest.add_argument('query', metavar='query', help='query image')
-parser_nearest.add_argument('--max_results', default=16, type=int)
-parser_nearest.add_argument('--num_neighbours', default=3, type=int)
-parser_nearest.set_defaults(func=cli.commands.search_nearest)
+parser_nearest.add_argument('query', metavar='query', help=QUERY_HELP)
+parser_nearest.add_argument('--max_results', default=16, type=int, help='upper bound on --num_neighbours')
+parser_nearest.add_argument('--num_neighbours', default=3, type=int, help='number of nearest images to return')
+parser_nearest.add_argument('--max_distance', default=None, type=int, help='ignore images farther than this')
+parser_nearest.add_argument('--hash_type', default='', type=str, help=QUERY_HASH_TYPE_HELP)
+parser_nearest.add_argument('--hash_size', default=0, type=int, help=QUERY_HASH_SIZE_HELP)
+parser_nearest.add_argument('--batch', action='store_true', help=BATCH_HELP)
+parser_nearest.add_argument('--workers', default=CPU_COUNT, type=int, help=SEARCH_WORKERS_HELP)
+parser_nearest.set_defaults(func=lazy('cli.commands', 'search_nearest'))
 
 parser_remove = subparsers.add_parser('remove', help='remove image from database')
 parser_remove.add_argument('image', metavar='image', help='path to image')
-parser_remove.set_defaults(func=cli.commands.remove)
+parser_remove.set_defaults(func=lazy('cli.commands', 'remove'))
 
 parser_rebuild = subparsers.add_parser('rebuild', help='rebuild database')
 parser_rebuild.add_argument('--hash_type', default='', type=str, help='hash type')
 parser_rebuild.add_argument('--hash_size', default=0, type=int, help='hash size')
-parser_rebuild.set_defaults(func=cli.commands.rebuild)
+parser_rebuild.add_argument('--extra_hashes', default='', type=str, help=EXTRA_HASHES_HELP)
+parser_rebuild.add_argument('--index', default='', choices=[''] + db.options.ENGINES,
+                            help=INDEX_HELP + ', defaults to the current one')
+parser_rebuild.add_argument('--shard', default=-1, type=int,
+                            help='rebuild only this shard of a sharded database, leaving the others untouched')
+add_hash_arguments(parser_rebuild)
+parser_rebuild.set_defaults(func=lazy('cli.commands', 'rebuild'))
+
+parser_migrate = subparsers.add_parser('migrate', help='convert a pickled database to the index format')
+parser_migrate.add_argument('--out', default='', type=str, help='output path, defaults to --db')
+parser_migrate.set_defaults(func=lazy('cli.commands', 'migrate'))
+
+parser_compact = subparsers.add_parser('compact', help='fold the log of added and removed images into the database')
+parser_compact.set_defaults(func=lazy('cli.commands', 'compact'))
+
+parser_serve = subparsers.add_parser('serve', help='serve search queries over HTTP')
+parser_serve.add_argument('--host', default='127.0.0.1', type=str)
+parser_serve.add_argument('--port', default=8000, type=int)
+parser_serve.add_argument('--socket', default='', type=str, help='listen on a Unix socket instead of host:port')
+parser_serve.set_defaults(func=lazy('cli.server', 'serve'))
 
-parser_clusters = subparsers.add_parser('clusters', help='show image clusters')
-parser_clusters.add_argument('--num_neighbours', default=3)
-parser_clusters.add_argument('--min_distance', default=2)
-parser_clusters.add_argument('--num_threads', default=multiprocessing.cpu_count(), type=int)
-parser_clusters.set_defaults(func=cli.commands.clusters)
+parser_clusters = subparsers.add_parser('clusters', help='show groups of near-duplicate images')
+parser_clusters.add_argument('--num_neighbours', default=3, help='unused, kept for compatibility')
+parser_clusters.add_argument('--min_distance', default=2, type=int,
+                             help='images within this distance of each other are grouped together')
+parser_clusters.add_argument('--num_threads', default=CPU_COUNT, type=int)
+parser_clusters.set_defaults(func=lazy('cli.commands', 'clusters'))
 
 args = parser.parse_args()
 if 'func' in args:
+    if args.stats:
+        from cli.profile import Profile
+        args.hooks = Profile()
+    else:
+        from vptree.hooks import NO_HOOKS
+        args.hooks = NO_HOOKS
     args.func(args)
+    if args.stats:
+        args.hooks.report()
 else:
     parser.print_usage()
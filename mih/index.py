@@ -0,0 +1,151 @@
+import itertools
+import math
+from math import comb
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from vptree.stats import SearchStats
+
+SUBSTRING_BITS = 16
+
+
+if hasattr(int, 'bit_count'):
+    def popcount(x: int) -> int:
+        return x.bit_count()
+else:
+    def popcount(x: int) -> int:
+        return bin(x).count('1')
+
+
+class MultiIndexHash:
+    # Multi-index hashing (Norouzi et al.): every hash is split into num_substrings disjoint bit
+    # substrings, each indexed in its own exact-match table. By the pigeonhole principle a point within
+    # Hamming distance r of the query is within r // num_substrings of it on at least one substring, so
+    # probing every table with all substrings up to that radius finds every match.
+    num_bits: int
+    num_substrings: int
+    key_fn: Callable[[Any], int]
+    tables: List[Dict[int, List[Any]]]
+
+    def __init__(self, num_bits: int, num_substrings: Optional[int] = None,
+                 key_fn: Callable[[Any], int] = lambda p: p):
+        self.num_bits = num_bits
+        self.num_substrings = num_substrings if num_substrings is not None else max(1, num_bits // SUBSTRING_BITS)
+        self.key_fn = key_fn
+        self.tables = [{} for _ in range(self.num_substrings)]
+        self._size = 0
+
+        # substring i covers bits [bounds[i], bounds[i + 1])
+        self._bounds = [self.num_bits * i // self.num_substrings for i in range(self.num_substrings + 1)]
+        self._widths = [self._bounds[i + 1] - self._bounds[i] for i in range(self.num_substrings)]
+
+    def _substrings(self, key: int) -> Iterator[Tuple[int, int, int]]:
+        for i, width in enumerate(self._widths):
+            yield i, width, (key >> self._bounds[i]) & ((1 << width) - 1)
+
+    def add_list(self, points: List[Any]):
+        for point in points:
+            self.add(point)
+
+    def add(self, point: Any):
+        for i, _, sub in self._substrings(self.key_fn(point)):
+            self.tables[i].setdefault(sub, []).append(point)
+        self._size += 1
+
+    def remove(self, point: Any) -> bool:
+        if not self.contains(point):
+            return False
+        for i, _, sub in self._substrings(self.key_fn(point)):
+            bucket = self.tables[i][sub]
+            bucket.remove(point)
+            if len(bucket) == 0:
+                del self.tables[i][sub]
+        self._size -= 1
+        return True
+
+    def contains(self, point: Any) -> bool:
+        _, _, sub = next(self._substrings(self.key_fn(point)))
+        return point in self.tables[0].get(sub, [])
+
+    def size(self) -> int:
+        return self._size
+
+    def iter_points(self) -> Iterator[Any]:
+        for bucket in self.tables[0].values():
+            yield from bucket
+
+    def _candidates_at(self, key: int, radius: int, stats: Optional[SearchStats]) -> Iterator[Any]:
+        # points whose substring differs from the query's in exactly radius bits, on some substring
+        for i, width, sub in self._substrings(key):
+            if radius > width:
+                continue
+            table = self.tables[i]
+            for bits in itertools.combinations(range(width), radius):
+                probe = sub
+                for b in bits:
+                    probe ^= 1 << b
+                if stats is not None:
+                    stats.nodes_visited += 1
+                yield from table.get(probe, ())
+
+    def _probe_cost(self, radius: int) -> int:
+        return sum(comb(width, radius) for width in self._widths)
+
+    def _search(self, key: int, done: Callable[[Dict[Any, int], int], bool],
+                stats: Optional[SearchStats]) -> Dict[Any, int]:
+        # Probes substring radius 0, 1, ... and stops when done(found, guaranteed_radius) is true, where every
+        # point within guaranteed_radius of the query is in found. Falls back to a full scan once probing would
+        # cost more than looking at every point.
+        found: Dict[Any, int] = {}
+        if stats is not None:
+            stats.queries += 1
+        for radius in range(max(self._widths) + 1):
+            if self._probe_cost(radius) > self._size:
+                for point in self.iter_points():
+                    found[point] = popcount(key ^ self.key_fn(point))
+                if stats is not None:
+                    stats.distance_calls += self._size
+                break
+            for point in self._candidates_at(key, radius, stats):
+                if point not in found:
+                    found[point] = popcount(key ^ self.key_fn(point))
+                    if stats is not None:
+                        stats.distance_calls += 1
+            if done(found, self.num_substrings * (radius + 1) - 1):
+                break
+        return found
+
+    def within_distance_of_key(self, key: int, max_distance: float,
+                               stats: Optional[SearchStats] = None) -> List[Tuple[Any, int]]:
+        found = self._search(key, lambda _, guaranteed: guaranteed >= max_distance, stats)
+        return [(p, d) for p, d in found.items() if d <= max_distance]
+
+    def nearest_to_key(self, key: int, num_neighbours: int, max_distance: Optional[float] = None,
+                       stats: Optional[SearchStats] = None) -> List[Tuple[Any, int]]:
+        if num_neighbours <= 0:
+            return []
+        if max_distance is None:
+            max_distance = math.inf
+
+        def done(found: Dict[Any, int], guaranteed: int) -> bool:
+            if guaranteed >= max_distance:
+                return True
+            return sum(1 for d in found.values() if d <= guaranteed) >= num_neighbours
+
+        nearest = sorted(self._search(key, done, stats).items(), key=lambda pd: pd[1])
+        return [(p, d) for p, d in nearest if d <= max_distance][:num_neighbours]
+
+    def get_within_distance(self, query: Any, max_distance: float, stats: Optional[SearchStats] = None) -> List[Any]:
+        return [p for p, _ in self.get_within_distance_pairs(query, max_distance, stats)]
+
+    def get_within_distance_pairs(self, query: Any, max_distance: float,
+                                  stats: Optional[SearchStats] = None) -> List[Tuple[Any, int]]:
+        return self.within_distance_of_key(self.key_fn(query), max_distance, stats)
+
+    def get_nearest_neighbours(self, query: Any, num_neighbours: int, max_results: int = 16,
+                               max_distance: Optional[float] = None, stats: Optional[SearchStats] = None) -> List[Any]:
+        return [p for p, _ in self.get_nearest_neighbour_pairs(query, num_neighbours, max_results, max_distance, stats)]
+
+    def get_nearest_neighbour_pairs(self, query: Any, num_neighbours: int, max_results: int = 16,
+                                    max_distance: Optional[float] = None,
+                                    stats: Optional[SearchStats] = None) -> List[Tuple[Any, int]]:
+        return self.nearest_to_key(self.key_fn(query), min(num_neighbours, max_results), max_distance, stats)
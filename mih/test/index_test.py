@@ -0,0 +1,66 @@
+import random
+import unittest
+
+from mih.index import MultiIndexHash, popcount
+
+
+def brute_force(points, query, max_distance):
+    return sorted(p for p in points if popcount(p ^ query) <= max_distance)
+
+
+def create_points(num_points: int, num_bits: int):
+    rnd = random.Random(num_points)
+    centres = [rnd.getrandbits(num_bits) for _ in range(10)]
+    # clustered points, so small radii have matches
+    points = set()
+    while len(points) < num_points:
+        p = rnd.choice(centres)
+        for _ in range(rnd.randint(0, 12)):
+            p ^= 1 << rnd.randrange(num_bits)
+        points.add(p)
+    return list(points)
+
+
+class TestMultiIndexHash(unittest.TestCase):
+    def test_within_distance(self):
+        for num_bits, num_substrings in [(64, None), (64, 3), (256, None)]:
+            points = create_points(2000, num_bits)
+            index = MultiIndexHash(num_bits, num_substrings)
+            index.add_list(points)
+            self.assertEqual(len(points), index.size())
+            for query in points[:20]:
+                for max_distance in [0, 3, 7, 12, 40]:
+                    self.assertEqual(brute_force(points, query, max_distance),
+                                     sorted(index.get_within_distance(query, max_distance)))
+
+    def test_nearest_neighbours(self):
+        points = create_points(2000, 64)
+        index = MultiIndexHash(64)
+        index.add_list(points)
+        rnd = random.Random(1)
+        for query in points[:10] + [rnd.getrandbits(64) for _ in range(10)]:
+            for max_results in [1, 5, 50]:
+                nearest = index.get_nearest_neighbours(query, max_results, max_results)
+                expected = sorted(popcount(p ^ query) for p in points)[:max_results]
+                self.assertEqual(expected, [popcount(p ^ query) for p in nearest])
+
+    def test_remove(self):
+        points = create_points(200, 64)
+        index = MultiIndexHash(64)
+        index.add_list(points)
+        for p in points[:100]:
+            self.assertTrue(index.remove(p))
+            self.assertFalse(index.contains(p))
+            self.assertFalse(index.remove(p))
+        self.assertEqual(sorted(points[100:]), sorted(index.iter_points()))
+        self.assertEqual([], index.get_within_distance(points[0], 0))
+
+    def test_key_fn(self):
+        points = [('a', 0b1011), ('b', 0b1000), ('c', 0b0111)]
+        index = MultiIndexHash(4, 2, key_fn=lambda p: p[1])
+        index.add_list(points)
+        self.assertEqual([('a', 0b1011), ('b', 0b1000)], sorted(index.get_within_distance(('q', 0b1010), 1)))
+
+
+if __name__ == '__main__':
+    unittest.main()
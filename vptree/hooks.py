@@ -0,0 +1,46 @@
+import time
+from contextlib import contextmanager
+from typing import Iterable, Iterator, TypeVar
+
+from vptree.stats import SearchStats
+
+T = TypeVar('T')
+
+
+class Hooks:
+    # Receives timings and counters from VPTree, DB and the commands. This implementation drops them; subclass
+    # it and override timing and count to export them.
+    def timing(self, name: str, seconds: float):
+        pass
+
+    def count(self, name: str, value: int = 1):
+        pass
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timing(name, time.perf_counter() - start)
+
+    def timed_iter(self, name: str, items: Iterable[T]) -> Iterator[T]:
+        # times only the work of producing each item, not what the consumer does with it
+        it = iter(items)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                self.timing(name, time.perf_counter() - start)
+                return
+            self.timing(name, time.perf_counter() - start)
+            yield item
+
+    def searched(self, stats: SearchStats):
+        self.count('search.queries', stats.queries)
+        self.count('search.nodes_visited', stats.nodes_visited)
+        self.count('search.distance_calls', stats.distance_calls)
+
+
+NO_HOOKS = Hooks()
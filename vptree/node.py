@@ -1,77 +1,227 @@
-import copy
+import math
 import random
-from typing import Optional, Any, List, Callable
+from typing import Optional, Any, List, Callable, Iterator, Sequence, Tuple
 
 from vptree.priority_queue import PriorityQueue
+from vptree.stats import SearchStats
+
+
+class LeafKernel:
+    # Optional batch distance computation for leaves: pack() turns a leaf's points into a
+    # contiguous representation once, distances() scores a query against all of them at once.
+    def pack(self, points: List[Any]) -> Any:
+        raise NotImplementedError
+
+    def distances(self, query: Any, packed: Any) -> Sequence[float]:
+        raise NotImplementedError
+
+
+# number of sampled distances whose median becomes a node's threshold
+THRESHOLD_SAMPLE = 32
+# A subtree is rebuilt once at least REBUILD_CHANGES times its size in points were added to or removed from it
+# since it was built, and either child holds more than MAX_CHILD_SHARE of its points or it has grown deeper
+# than MAX_DEPTH_FACTOR * log2(size / capacity) + 2 levels. Rebuilding a subtree of m points takes at least
+# m / 2 updates below it, so the cost per update stays logarithmic.
+REBUILD_CHANGES = 0.5
+MAX_CHILD_SHARE = 0.75
+MAX_DEPTH_FACTOR = 2
 
 
 class VPTreeNode:
     capacity: int
     distance_fn: Callable[[Any, Any], float]
+    leaf_kernel: Optional[LeafKernel]
+    packed: Any
     vantage_point: Any
     threshold: float
     closer: Optional['VPTreeNode']
     farther: Optional['VPTreeNode']
     points: Optional[List[Any]]
+    # number of points in the subtree, and points added or removed below this node since it was built
+    count: int
+    changes: int
 
-    def __init__(self, points: List[Any], distance_fn: Callable[[Any, Any], float], capacity: int = 32):
+    def __init__(self, points: List[Any], distance_fn: Callable[[Any, Any], float], capacity: int = 32,
+                 leaf_kernel: Optional[LeafKernel] = None, stats: Optional[SearchStats] = None):
+        self._reset(distance_fn, capacity, leaf_kernel)
+        shared = list(points)
+        self._build(shared, 0, len(shared), stats)
+
+    def _reset(self, distance_fn: Callable[[Any, Any], float], capacity: int, leaf_kernel: Optional[LeafKernel]):
         self.capacity = capacity
         self.distance_fn = distance_fn
-        self.points = copy.deepcopy(points)
-        self.vantage_point = random.choice(self.points)
+        self.leaf_kernel = leaf_kernel
+        self.packed = None
+        self.vantage_point = None
         self.closer = None
         self.farther = None
         self.threshold = 0.0
-        self.partition()
-
-    def partition(self):
-        if self.points is None:
-            if self.closer.size() == 0 or self.farther.size() == 0:
-                self.points = copy.deepcopy(self.closer.points)
-                self.points += self.farther.points
-
-                self.closer = None
-                self.farther = None
-
-                self.partition()
+        self.points = None
+        self.count = 0
+        self.changes = 0
+
+    def _build(self, shared: List[Any], start: int, end: int, stats: Optional[SearchStats] = None):
+        # Builds the subtree over shared[start:end], reordering that range in place so that every child
+        # owns a contiguous part of it. Points are never copied, only references to them, and only leaves
+        # keep a list of their own.
+        stack = [(self, start, end)]
+        while len(stack) != 0:
+            node, start, end = stack.pop()
+            node.vantage_point = shared[random.randrange(start, end)]
+            node.packed = None
+            node.count = end - start
+            node.changes = 0
+            if end - start <= node.capacity:
+                node._make_leaf(shared[start:end])
+                continue
+
+            distances = [node.distance_fn(node.vantage_point, shared[i]) for i in range(start, end)]
+            if stats is not None:
+                stats.distance_calls += end - start
+            node.threshold = node._select_threshold(distances)
+            closer = [shared[start + i] for i, d in enumerate(distances) if d <= node.threshold]
+            if len(closer) == len(distances):
+                # every point is within the threshold, e.g. duplicates: keep an oversized leaf
+                node._make_leaf(shared[start:end])
+                continue
+            farther = [shared[start + i] for i, d in enumerate(distances) if d > node.threshold]
+            middle = start + len(closer)
+            shared[start:middle] = closer
+            shared[middle:end] = farther
+
+            node.points = None
+            node.closer = node._child()
+            node.farther = node._child()
+            stack.append((node.farther, middle, end))
+            stack.append((node.closer, start, middle))
+
+    def _make_leaf(self, points: List[Any]):
+        self.points = points
+        self.closer = None
+        self.farther = None
+        self.packed = None
+
+    def _child(self) -> 'VPTreeNode':
+        node = VPTreeNode.__new__(VPTreeNode)
+        node._reset(self.distance_fn, self.capacity, self.leaf_kernel)
+        return node
+
+    def _select_threshold(self, distances: List[float]) -> float:
+        if len(distances) > THRESHOLD_SAMPLE:
+            distances = random.sample(distances, THRESHOLD_SAMPLE)
+        return sorted(distances)[len(distances) // 2]
+
+    def _rebuild(self, stats: Optional[SearchStats] = None):
+        points = list(self.iter_points())
+        if len(points) == 0:
+            self._make_leaf([])
+            self.count = 0
+            self.changes = 0
+            return
+        self._build(points, 0, len(points), stats)
+
+    def _absorb(self, child: 'VPTreeNode'):
+        # takes the place of its only non-empty child
+        self.vantage_point = child.vantage_point
+        self.threshold = child.threshold
+        self.closer = child.closer
+        self.farther = child.farther
+        self.points = child.points
+        self.packed = child.packed
+        self.count = child.count
+        self.changes = child.changes
+
+    def partition(self, stats: Optional[SearchStats] = None):
+        # merges nodes with an empty child and splits oversized leaves anywhere in the tree; add and remove
+        # already do this along the path they touch
+        stack = [self]
+        while len(stack) != 0:
+            node = stack.pop()
+            if node.points is None:
+                if node.closer.count == 0 or node.farther.count == 0:
+                    node._absorb(node.farther if node.closer.count == 0 else node.closer)
+                    stack.append(node)
+                    continue
+                stack.append(node.farther)
+                stack.append(node.closer)
+            elif len(node.points) > node.capacity:
+                node._rebuild(stats)
+
+    def iter_points(self) -> Iterator[Any]:
+        stack = [self]
+        while len(stack) != 0:
+            node = stack.pop()
+            if node.points is None:
+                stack.append(node.farther)
+                stack.append(node.closer)
             else:
-                self.closer.partition()
-                self.farther.partition()
-        elif len(self.points) > self.capacity:
-            self._partition_points()
+                yield from node.points
 
     def size(self) -> int:
-        if self.points is None:
-            return self.closer.size() + self.farther.size()
-        return len(self.points)
-
-    def _partition_points(self):
-        self.threshold = self._select_threshold()
-
-        partition_idx = self._get_partition_idx()
-        if partition_idx is None:
-            self.closer = None
-            self.farther = None
-        else:
-            self.closer = VPTreeNode(self.points[:partition_idx], self.distance_fn, self.capacity)
-            self.farther = VPTreeNode(self.points[partition_idx:], self.distance_fn, self.capacity)
-            self.points = None
-
-    def add(self, point: Any):
-        if self.points is None:
-            self._get_child_for_point(point).add(point)
-        else:
-            self.points.append(point)
-
-    def remove(self, point: Any):
-        if self.points is None:
-            return self._get_child_for_point(point).remove(point)
-        else:
-            try:
-                self.points.remove(point)
-                return True
-            except ValueError:
-                return False
+        return self.count
+
+    def depth(self) -> int:
+        deepest = 0
+        stack = [(self, 1)]
+        while len(stack) != 0:
+            node, depth = stack.pop()
+            deepest = max(deepest, depth)
+            if node.points is None:
+                stack.append((node.closer, depth + 1))
+                stack.append((node.farther, depth + 1))
+        return deepest
+
+    def _path_to(self, point: Any, stats: Optional[SearchStats] = None) -> List['VPTreeNode']:
+        path = [self]
+        while path[-1].points is None:
+            path.append(path[-1]._get_child_for_point(point))
+        if stats is not None:
+            stats.distance_calls += len(path) - 1
+        return path
+
+    def add(self, point: Any, stats: Optional[SearchStats] = None):
+        # stats, when given, receives the distance calls made to place the point and rebuild subtrees
+        path = self._path_to(point, stats)
+        leaf = path[-1]
+        leaf.points.append(point)
+        leaf.packed = None
+        for node in path:
+            node.count += 1
+            node.changes += 1
+        if len(leaf.points) > leaf.capacity:
+            leaf._rebuild(stats)
+        self._rebalance(path, stats)
+
+    def remove(self, point: Any, stats: Optional[SearchStats] = None) -> bool:
+        path = self._path_to(point, stats)
+        leaf = path[-1]
+        try:
+            leaf.points.remove(point)
+        except ValueError:
+            return False
+        leaf.packed = None
+        for node in path:
+            node.count -= 1
+            node.changes += 1
+        if leaf.count == 0 and len(path) > 1:
+            parent = path[-2]
+            parent._absorb(parent.farther if leaf is parent.closer else parent.closer)
+            path = path[:-1]
+        self._rebalance(path, stats)
+        return True
+
+    def _rebalance(self, path: List['VPTreeNode'], stats: Optional[SearchStats] = None):
+        # rebuilds the highest subtree on the path that has drifted out of shape, see REBUILD_CHANGES
+        for depth, node in enumerate(path):
+            if node.points is not None:
+                return
+            if node.changes < REBUILD_CHANGES * node.count:
+                continue
+            max_depth = MAX_DEPTH_FACTOR * math.log2(max(1.0, node.count / node.capacity)) + 2
+            if max(node.closer.count, node.farther.count) > MAX_CHILD_SHARE * node.count or \
+                    len(path) - depth > max_depth:
+                node._rebuild(stats)
+                return
 
     def _get_child_for_point(self, point: Any) -> 'VPTreeNode':
         if self.distance_fn(self.vantage_point, point) > self.threshold:
@@ -79,106 +229,99 @@ class VPTreeNode:
         return self.closer
 
     def contains(self, point: Any):
-        if self.points is None:
-            return self._get_child_for_point(point).contains(point)
-        return point in self.points
-
-    def _select_threshold(self):
-        if len(self.points) > 32:
-            sampled_points = random.sample(self.points, 32)
-        else:
-            sampled_points = copy.deepcopy(self.points)
-        left = 0
-        right = len(sampled_points) - 1
-        median_idx = len(sampled_points) // 2
-        while left != right:
-            pivot_idx = left + random.randint(0, right - left)
-            pivot_distance = self.distance_fn(self.vantage_point, sampled_points[pivot_idx])
-
-            sampled_points[pivot_idx], sampled_points[right] = sampled_points[right], sampled_points[pivot_idx]
-
-            store_idx = left
-
-            for i in range(left, right):
-                if self.distance_fn(self.vantage_point, sampled_points[i]) < pivot_distance:
-                    sampled_points[store_idx], sampled_points[i] = sampled_points[i], sampled_points[store_idx]
-                    store_idx += 1
-
-            sampled_points[pivot_idx], sampled_points[right] = sampled_points[right], sampled_points[pivot_idx]
-
-            if store_idx == median_idx:
-                break
-            elif store_idx < median_idx:
-                left = store_idx + 1
-            else:
-                right = store_idx - 1
-
-        return self.distance_fn(self.vantage_point, sampled_points[median_idx])
-
-    def _get_partition_idx(self) -> Optional[int]:
-        left = 0
-        right = len(self.points) - 1
-        while left <= right:
-            if self.distance_fn(self.vantage_point, self.points[left]) > self.threshold:
-                while right >= left:
-                    if self.distance_fn(self.vantage_point, self.points[right]) <= self.threshold:
-                        self.points[left], self.points[right] = self.points[right], self.points[left]
-                        right -= 1
-                        break
-                    right -= 1
-            left += 1
-
-        if self.distance_fn(self.vantage_point, self.points[left - 1]) > self.threshold:
-            first_index_past_threshold = left - 1
-        else:
-            first_index_past_threshold = left
-
-        if self.distance_fn(self.vantage_point, self.points[0]) <= self.threshold < self.distance_fn(
-                self.vantage_point, self.points[-1]):
-            return first_index_past_threshold
-
-        return None
-
-    def get_nearest_neighbours(self, point: Any, num_neighbours: int, max_results: int) -> List[Any]:
-        heap = PriorityQueue(point, self.distance_fn, max_results)
-        self._get_nearest_neighbours(heap, point, num_neighbours, max_results)
-
-        return heap.list()
-
-    def _get_nearest_neighbours(self, heap: PriorityQueue, point: Any, num_neighbours: int, max_results: int):
-        if self.points is None:
-            first_node = self._get_child_for_point(point)
-            first_node._get_nearest_neighbours(heap, point, num_neighbours, max_results)
-
-            distance_from_vantage_point_to_query_point = self.distance_fn(self.vantage_point, point)
-            distance_from_query_point_to_farthest_point = self.distance_fn(point, heap.peek())
-            if first_node is self.closer:
-                distance_from_query_point_to_threshold = self.threshold - distance_from_vantage_point_to_query_point
-                if distance_from_query_point_to_farthest_point > distance_from_query_point_to_threshold:
-                    self.farther._get_nearest_neighbours(heap, point, num_neighbours, max_results)
+        return point in self._path_to(point)[-1].points
+
+    def get_nearest_neighbours(self, point: Any, num_neighbours: int, max_results: int,
+                               max_distance: Optional[float] = None, stats: Optional[SearchStats] = None) -> List[Any]:
+        return [p for p, _ in self.get_nearest_neighbour_pairs(point, num_neighbours, max_results, max_distance, stats)]
+
+    def get_nearest_neighbour_pairs(self, point: Any, num_neighbours: int, max_results: int,
+                                    max_distance: Optional[float] = None,
+                                    stats: Optional[SearchStats] = None) -> List[Tuple[Any, float]]:
+        # (point, distance) of the num_neighbours nearest points, at most max_results of them and none farther
+        # than max_distance, nearest first
+        heap = PriorityQueue(point, self.distance_fn, min(num_neighbours, max_results))
+        if stats is not None:
+            stats.queries += 1
+        if heap.max_entries == 0:
+            return []
+        if max_distance is None:
+            max_distance = math.inf
+
+        # Each entry holds a lower bound on the distance from the query to any point below the node. It is
+        # checked when the entry is popped, so the child on the query's side of the threshold is searched
+        # first and the other one only if the heap can still take a point at that bound.
+        stack = [(self, 0.0)]
+        while len(stack) != 0:
+            node, bound = stack.pop()
+            if bound > max_distance or not heap.accepts(bound):
+                continue
+            if stats is not None:
+                stats.nodes_visited += 1
+            if node.points is not None:
+                if stats is not None:
+                    stats.distance_calls += len(node.points)
+                for p, distance in zip(node.points, node._leaf_distances(point)):
+                    if distance <= max_distance:
+                        heap.push_distance(p, distance)
+                continue
+
+            distance_from_vantage_point_to_query_point = node.distance_fn(node.vantage_point, point)
+            if stats is not None:
+                stats.distance_calls += 1
+            # by the triangle inequality no point of the other child is closer to the query than its distance
+            # to the threshold
+            distance_from_query_point_to_threshold = abs(distance_from_vantage_point_to_query_point - node.threshold)
+            if distance_from_vantage_point_to_query_point <= node.threshold:
+                stack.append((node.farther, max(bound, distance_from_query_point_to_threshold)))
+                stack.append((node.closer, bound))
             else:
-                distance_from_query_point_to_threshold = distance_from_vantage_point_to_query_point - self.threshold
-                if distance_from_query_point_to_threshold <= distance_from_query_point_to_farthest_point:
-                    self.closer._get_nearest_neighbours(heap, point, num_neighbours, max_results)
-        else:
-            for p in self.points:
-                heap.push(p)
-
-    def get_within_distance(self, point: Any, max_distance: float) -> List[Any]:
-        result = []
-        self._get_within_distance(result, point, max_distance)
-        return result
+                stack.append((node.closer, max(bound, distance_from_query_point_to_threshold)))
+                stack.append((node.farther, bound))
 
-    def _get_within_distance(self, result: List[Any], point: Any, max_distance: float):
-        if self.points is None:
-            distance_from_vantage_point_to_query_point = self.distance_fn(self.vantage_point, point)
+        return heap.pairs()
 
-            if distance_from_vantage_point_to_query_point <= self.threshold + max_distance:
-                self.closer._get_within_distance(result, point, max_distance)
+    def get_within_distance(self, point: Any, max_distance: float, stats: Optional[SearchStats] = None) -> List[Any]:
+        return [p for p, _ in self.get_within_distance_pairs(point, max_distance, stats)]
+
+    def get_within_distance_pairs(self, point: Any, max_distance: float,
+                                  stats: Optional[SearchStats] = None) -> List[Tuple[Any, float]]:
+        result = []
+        if stats is not None:
+            stats.queries += 1
+
+        stack = [self]
+        while len(stack) != 0:
+            node = stack.pop()
+            if stats is not None:
+                stats.nodes_visited += 1
+            if node.points is not None:
+                if stats is not None:
+                    stats.distance_calls += len(node.points)
+                for p, distance in zip(node.points, node._leaf_distances(point)):
+                    if distance <= max_distance:
+                        result.append((p, distance))
+                continue
+
+            distance_from_vantage_point_to_query_point = node.distance_fn(node.vantage_point, point)
+            if stats is not None:
+                stats.distance_calls += 1
+            if distance_from_vantage_point_to_query_point + max_distance > node.threshold:
+                stack.append(node.farther)
+            if distance_from_vantage_point_to_query_point <= node.threshold + max_distance:
+                stack.append(node.closer)
+
+        return result
 
-            if distance_from_vantage_point_to_query_point + max_distance > self.threshold:
-                self.farther._get_within_distance(result, point, max_distance)
-        else:
-            for p in self.points:
-                if self.distance_fn(point, p) <= max_distance:
-                    result.append(p)
+    def _leaf_distances(self, point: Any) -> Sequence[float]:
+        if self.leaf_kernel is None:
+            return [self.distance_fn(point, p) for p in self.points]
+        if self.packed is None:
+            self.packed = self.leaf_kernel.pack(self.points)
+        return self.leaf_kernel.distances(point, self.packed)
+
+    def __getstate__(self):
+        # packed leaves are a cache and are rebuilt on first use
+        state = self.__dict__.copy()
+        state['packed'] = None
+        return state
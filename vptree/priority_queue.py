@@ -1,57 +1,52 @@
 import heapq
-from functools import cmp_to_key
-from typing import Any, Callable, List
+from typing import Any, Callable, List, Optional, Tuple
 
 
 class PriorityQueue:
-    heap: List[Any]
+    # Bounded max-heap of the max_entries nearest points seen so far. Entries are
+    # (-distance, sequence number, point): each distance is computed once and kept with its point, and the
+    # sequence number breaks ties so points never have to be comparable.
+    heap: List[Tuple[float, int, Any]]
     max_distance: float
     max_entries: int
-    distance_fn: Callable[[Any, Any], float]
+    distance_fn: Optional[Callable[[Any, Any], float]]
     query: Any
 
-    def __init__(self, query: Any, distance_fn: Callable[[Any, Any], float], max_entries: int):
+    def __init__(self, query: Any, distance_fn: Optional[Callable[[Any, Any], float]], max_entries: int):
         self.query = query
         self.distance_fn = distance_fn
         self.max_entries = max_entries
         self.max_distance = 0.0
         self.heap = []
+        self._pushed = 0
 
     def push(self, point: Any):
-        added = False
+        self.push_distance(point, self.distance_fn(self.query, point))
+
+    def push_distance(self, point: Any, distance_to_new_point: float):
         if len(self.heap) < self.max_entries:
-            heapq.heappush(self.heap, (-self.distance_fn(self.query, point), point))
-            added = True
+            heapq.heappush(self.heap, (-distance_to_new_point, self._pushed, point))
+        elif distance_to_new_point < self.max_distance:
+            heapq.heapreplace(self.heap, (-distance_to_new_point, self._pushed, point))
         else:
-            distance_to_new_point = self.distance_fn(self.query, point)
-            if distance_to_new_point < self.max_distance:
-                heapq.heappop(self.heap)
-                heapq.heappush(self.heap, (-distance_to_new_point, point))
-                added = True
-        if added:
-            self.max_distance = self.distance_fn(self.query, self.heap[0][1])
+            return
+        self._pushed += 1
+        self.max_distance = -self.heap[0][0]
+
+    def accepts(self, distance: float) -> bool:
+        # whether a point at this distance would be kept
+        return len(self.heap) < self.max_entries or distance < self.max_distance
 
     def peek(self):
-        return self.heap[0][1]
+        return self.heap[0][2]
 
-    def list(self):
-        result = []
-        for v in self.heap:
-            result.append(v[1])
+    def pairs(self) -> List[Tuple[Any, float]]:
+        # (point, distance) from nearest to farthest, ties in insertion order
+        return [(point, -negated) for negated, _, point in sorted(self.heap, key=lambda e: (-e[0], e[1]))]
 
-        return sorted(result, key=cmp_to_key(compare_dist(lambda p: self.distance_fn(self.query, p))))
+    def list(self) -> List[Any]:
+        return [point for point, _ in self.pairs()]
 
     def __getitem__(self, item):
-        return self.heap[item]
-
-
-def compare_dist(dist_fn: Callable[[Any], float]):
-    def compare(x: Any, y: Any):
-        if dist_fn(x) < dist_fn(y):
-            return -1
-        elif dist_fn(y) < dist_fn(x):
-            return 1
-        else:
-            return 0
-
-    return compare
+        negated, _, point = self.heap[item]
+        return negated, point
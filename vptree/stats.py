@@ -0,0 +1,23 @@
+from typing import Tuple
+
+
+class SearchStats:
+    # work done by queries, accumulated over every query it is passed to
+    nodes_visited: int
+    distance_calls: int
+    queries: int
+
+    def __init__(self):
+        self.nodes_visited = 0
+        self.distance_calls = 0
+        self.queries = 0
+
+    def per_query(self) -> Tuple[float, float]:
+        if self.queries == 0:
+            return 0.0, 0.0
+        return self.nodes_visited / self.queries, self.distance_calls / self.queries
+
+    def add(self, other: 'SearchStats'):
+        self.nodes_visited += other.nodes_visited
+        self.distance_calls += other.distance_calls
+        self.queries += other.queries
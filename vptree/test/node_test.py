@@ -1,7 +1,9 @@
+import random
 import unittest
 from typing import List
 
-from vptree.node import VPTreeNode
+from vptree.node import VPTreeNode, LeafKernel
+from vptree.stats import SearchStats
 
 NODE_CAPACITY = 32
 
@@ -10,6 +12,14 @@ def dist_fn(x, y):
     return abs(x - y)
 
 
+class ListKernel(LeafKernel):
+    def pack(self, points):
+        return list(points)
+
+    def distances(self, query, packed):
+        return [abs(query - p) for p in packed]
+
+
 def create_test_nodes() -> List[VPTreeNode]:
     points = [i for i in range(NODE_CAPACITY)]
 
@@ -71,6 +81,35 @@ class TestVPTreeNode(unittest.TestCase):
             for v in [query - 1, query, query + 1]:
                 self.assertIn(v, res)
 
+    def test_nearest_neighbours_exact(self):
+        rnd = random.Random(0)
+        points = [rnd.randrange(100000) for _ in range(2000)]
+        node = VPTreeNode(points, dist_fn, 8)
+        stats = SearchStats()
+        for query in [rnd.randrange(100000) for _ in range(50)]:
+            expected = sorted(dist_fn(query, p) for p in points)
+            for num_neighbours in [1, 5, 20]:
+                res = node.get_nearest_neighbours(query, num_neighbours, 16, stats=stats)
+                self.assertEqual(expected[:min(num_neighbours, 16)], [dist_fn(query, p) for p in res])
+            res = node.get_nearest_neighbours(query, 10, 10, max_distance=expected[3])
+            self.assertEqual([d for d in expected[:10] if d <= expected[3]], [dist_fn(query, p) for p in res])
+
+        # pruning keeps every query far from a full scan
+        nodes_visited, distance_calls = stats.per_query()
+        self.assertEqual(150, stats.queries)
+        self.assertLess(distance_calls, len(points) / 4)
+        self.assertGreater(nodes_visited, 0)
+
+    def test_shares_points(self):
+        # the tree holds the caller's objects, not copies of them
+        points = [[i] for i in range(500)]
+        node = VPTreeNode(points, lambda x, y: abs(x[0] - y[0]), 8)
+        self.assertEqual({id(p) for p in points}, {id(p) for p in node.iter_points()})
+        self.assertEqual(len(points), node.size())
+        node.add([1000])
+        node.partition()
+        self.assertEqual(len(points) + 1, node.size())
+
     def test_get_within_distance(self):
         nodes = create_test_nodes()
         query = NODE_CAPACITY // 2
@@ -81,6 +120,22 @@ class TestVPTreeNode(unittest.TestCase):
             for i in range(query - max_distance, query + max_distance + 1):
                 self.assertIn(i, res)
 
+    def test_leaf_kernel(self):
+        points = [(i * 7) % 101 for i in range(101)]
+        for capacity in [4, 32, 128]:
+            # same seed, same tree: the kernel must not change which points are found
+            random.seed(capacity)
+            plain = VPTreeNode(points, dist_fn, capacity)
+            random.seed(capacity)
+            kernel = VPTreeNode(points, dist_fn, capacity, ListKernel())
+            for query in [0, 13, 50, 100]:
+                self.assertEqual(sorted(plain.get_within_distance(query, 5)),
+                                 sorted(kernel.get_within_distance(query, 5)))
+                self.assertEqual([dist_fn(query, p) for p in plain.get_nearest_neighbours(query, 5, 5)],
+                                 [dist_fn(query, p) for p in kernel.get_nearest_neighbours(query, 5, 5)])
+            kernel.add(1000)
+            self.assertIn(1000, kernel.get_within_distance(1000, 0))
+
 
 if __name__ == '__main__':
     unittest.main()
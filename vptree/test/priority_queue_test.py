@@ -0,0 +1,37 @@
+import random
+import unittest
+
+from vptree.priority_queue import PriorityQueue
+
+
+class TestPriorityQueue(unittest.TestCase):
+    def test_pairs(self):
+        calls = []
+
+        def dist_fn(x, y):
+            calls.append((x, y))
+            return abs(x - y)
+
+        rnd = random.Random(0)
+        points = [rnd.randrange(1000) for _ in range(200)]
+        heap = PriorityQueue(500, dist_fn, 10)
+        for p in points:
+            heap.push(p)
+
+        expected = sorted(abs(500 - p) for p in points)[:10]
+        self.assertEqual(expected, [d for _, d in heap.pairs()])
+        self.assertEqual([abs(500 - p) for p in heap.list()], expected)
+        self.assertEqual(len(points), len(calls))
+        self.assertEqual(expected[-1], heap.max_distance)
+        self.assertFalse(heap.accepts(expected[-1]))
+        self.assertTrue(heap.accepts(expected[-1] - 1))
+
+    def test_unorderable_points(self):
+        heap = PriorityQueue(None, None, 2)
+        for i, distance in enumerate([3, 1, 1, 2]):
+            heap.push_distance({'id': i}, distance)
+        self.assertEqual([({'id': 1}, 1), ({'id': 2}, 1)], heap.pairs())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import math
+import random
+import unittest
+
+from vptree.hooks import Hooks
+from vptree.stats import SearchStats
+from vptree.vptree import REBUILD_RATIO, VPTree
+
+
+def dist_fn(x, y):
+    return abs(x - y)
+
+
+class RecordingHooks(Hooks):
+    def __init__(self):
+        self.timings = {}
+        self.counters = {}
+
+    def timing(self, name, seconds):
+        self.timings[name] = self.timings.get(name, 0) + 1
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+
+def check_counts(node) -> int:
+    # every node's count matches the points below it, vantage points stay in one of the children
+    if node.points is not None:
+        count = len(node.points)
+    else:
+        count = check_counts(node.closer) + check_counts(node.farther)
+    assert node.count == count, (node.count, count)
+    return count
+
+
+class TestVPTree(unittest.TestCase):
+    def test_hooks(self):
+        hooks = RecordingHooks()
+        tree = VPTree(dist_fn, capacity=8, hooks=hooks)
+        tree.add_list(list(range(1000)))
+        # the root alone compares its vantage point with every point
+        built_calls = hooks.counters['tree.distance_calls']
+        self.assertGreaterEqual(built_calls, 1000)
+        tree.add(5000)
+        # one call per level on the way down to the leaf, and a few more if the leaf was split
+        inserted_calls = hooks.counters['tree.distance_calls'] - built_calls
+        self.assertGreaterEqual(inserted_calls, len(tree.root._path_to(5000)) - 1)
+        self.assertLess(inserted_calls, 100)
+        self.assertTrue(tree.remove(5000))
+        self.assertFalse(tree.remove(5000))
+        self.assertGreater(hooks.counters['tree.distance_calls'], built_calls + inserted_calls)
+
+        stats = SearchStats()
+        self.assertEqual([10, 11], sorted(tree.get_within_distance(10.5, 1, stats)))
+        tree.get_nearest_neighbours(10, 3)
+        self.assertEqual({'tree.build': 1, 'tree.insert': 1, 'tree.search': 2}, hooks.timings)
+        self.assertEqual(1000, hooks.counters['tree.built'])
+        self.assertEqual(1, hooks.counters['tree.inserted'])
+        self.assertEqual(1, hooks.counters['tree.removed'])
+        self.assertEqual(2, hooks.counters['search.queries'])
+        self.assertEqual(1, stats.queries)
+        self.assertGreater(hooks.counters['search.distance_calls'], stats.distance_calls)
+
+    def test_sequential_adds_stay_balanced(self):
+        random.seed(0)
+        tree = VPTree(dist_fn, capacity=8)
+        tree.build(list(range(16)))
+        # increasing points all land in the rightmost leaf without rebalancing
+        for p in range(16, 5000):
+            tree.add(p)
+
+        self.assertEqual(5000, tree.root.size())
+        self.assertLessEqual(tree.root.depth(), 3 * math.log2(5000 / 8) + 4)
+        for query in [0, 1234, 4999]:
+            self.assertEqual(list(range(max(0, query - 3), min(5000, query + 4))),
+                             sorted(tree.get_within_distance(query, 3)))
+
+    def test_removes_keep_counts(self):
+        random.seed(1)
+        points = list(range(3000))
+        tree = VPTree(dist_fn, capacity=8)
+        tree.add_list(points)
+        random.Random(2).shuffle(points)
+        for p in points[:2500]:
+            self.assertTrue(tree.remove(p))
+            self.assertFalse(tree.contains(p))
+        self.assertFalse(tree.remove(points[0]))
+
+        remaining = sorted(points[2500:])
+        self.assertEqual(len(remaining), tree.root.size())
+        self.assertEqual(remaining, sorted(tree.root.iter_points()))
+        self.assertEqual(remaining[:5], sorted(tree.get_nearest_neighbours(-1, 5, 5)))
+
+    def test_add_list_around_rebuild_ratio(self):
+        rnd = random.Random(3)
+        initial = [rnd.uniform(0, 10000) for _ in range(1000)]
+        threshold = math.ceil(len(initial) * REBUILD_RATIO)
+        # just below the ratio the batch is inserted, from it on the tree is rebuilt with the batch
+        for batch_size, rebuilt in [(threshold - 1, False), (threshold, True), (threshold + 1, True)]:
+            hooks = RecordingHooks()
+            tree = VPTree(dist_fn, capacity=8, hooks=hooks)
+            tree.add_list(initial)
+            batch = [rnd.uniform(0, 10000) for _ in range(batch_size)]
+            tree.add_list(batch)
+            self.assertEqual(2 if rebuilt else 1, hooks.timings['tree.build'])
+            self.assertEqual(0 if rebuilt else 1, hooks.timings.get('tree.insert', 0))
+
+            points = initial + batch
+            self.assertEqual(len(points), tree.root.size())
+            self.assertEqual(len(points), check_counts(tree.root))
+            self.assertEqual(sorted(points), sorted(tree.iter_points()))
+            for query in [rnd.uniform(-100, 10100) for _ in range(50)]:
+                self.assertEqual(sorted(p for p in points if abs(p - query) <= 20),
+                                 sorted(tree.get_within_distance(query, 20)))
+                self.assertEqual(sorted(abs(p - query) for p in points)[:5],
+                                 [d for _, d in tree.get_nearest_neighbour_pairs(query, 5)])
+
+
+if __name__ == '__main__':
+    unittest.main()
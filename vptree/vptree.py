@@ -1,25 +1,61 @@
-from typing import Optional, Callable, Any, List
+import time
+from typing import Optional, Callable, Any, List, Tuple
 
-from vptree.node import VPTreeNode
+from vptree.hooks import Hooks
+from vptree.node import VPTreeNode, LeafKernel
+from vptree.stats import SearchStats
+
+# add_list rebuilds the whole tree in one pass instead of inserting point by point
+# when the batch is at least this fraction of the current tree size
+REBUILD_RATIO = 0.5
 
 
 class VPTree:
     capacity: int
     distance_fn: Callable[[Any, Any], float]
+    leaf_kernel: Optional[LeafKernel]
     root: Optional[VPTreeNode]
+    # receives build and insert timings and the work done by every query, when set; the class default
+    # covers trees pickled before hooks existed
+    hooks: Optional[Hooks] = None
 
-    def __init__(self, distance_fn: Callable[[Any, Any], float], capacity: int = 32):
+    def __init__(self, distance_fn: Callable[[Any, Any], float], capacity: int = 32,
+                 leaf_kernel: Optional[LeafKernel] = None, hooks: Optional[Hooks] = None):
         self.root = None
         self.distance_fn = distance_fn
         self.capacity = capacity
+        self.leaf_kernel = leaf_kernel
+        self.hooks = hooks
 
     def add_list(self, points: List[Any]):
+        if len(points) == 0:
+            return
         if self.root is None:
-            self.root = VPTreeNode(points, self.distance_fn, self.capacity)
+            self.build(points)
             return
+        if len(points) >= self.root.size() * REBUILD_RATIO:
+            self.build(list(self.root.iter_points()) + list(points))
+            return
+        start = time.perf_counter()
+        stats = SearchStats() if self.hooks is not None else None
         for point in points:
-            self.root.add(point)
-        self.root.partition()
+            self.root.add(point, stats)
+        if self.hooks is not None:
+            self.hooks.timing('tree.insert', time.perf_counter() - start)
+            self.hooks.count('tree.inserted', len(points))
+            self.hooks.count('tree.distance_calls', stats.distance_calls)
+
+    def build(self, points: List[Any]):
+        if len(points) == 0:
+            self.root = None
+            return
+        start = time.perf_counter()
+        stats = SearchStats() if self.hooks is not None else None
+        self.root = VPTreeNode(points, self.distance_fn, self.capacity, self.leaf_kernel, stats)
+        if self.hooks is not None:
+            self.hooks.timing('tree.build', time.perf_counter() - start)
+            self.hooks.count('tree.built', len(points))
+            self.hooks.count('tree.distance_calls', stats.distance_calls)
 
     def add(self, point: Any):
         self.add_list([point])
@@ -27,22 +63,58 @@ class VPTree:
     def remove(self, point: Any):
         if self.root is None:
             return False
-        removed = self.root.remove(point)
-        if removed:
-            self.root.partition()
+        stats = SearchStats() if self.hooks is not None else None
+        removed = self.root.remove(point, stats)
+        if self.hooks is not None:
+            # finding the leaf costs distance calls even when the point is not there
+            self.hooks.count('tree.distance_calls', stats.distance_calls)
+            if removed:
+                self.hooks.count('tree.removed')
         return removed
 
+    def _search(self, search: Callable[[Optional[SearchStats]], List[Any]], stats: Optional[SearchStats]) -> List[Any]:
+        if self.hooks is None:
+            return search(stats)
+        own = SearchStats()
+        with self.hooks.phase('tree.search'):
+            result = search(own)
+        self.hooks.searched(own)
+        if stats is not None:
+            stats.add(own)
+        return result
+
     def contains(self, point: Any):
         if self.root is None:
             return False
         return self.root.contains(point)
 
-    def get_within_distance(self, query: Any, max_distance: float):
+    def iter_points(self):
+        if self.root is None:
+            return iter(())
+        return self.root.iter_points()
+
+    def get_within_distance(self, query: Any, max_distance: float, stats: Optional[SearchStats] = None):
+        if self.root is None:
+            return []
+        return self._search(lambda s: self.root.get_within_distance(query, max_distance, s), stats)
+
+    def get_within_distance_pairs(self, query: Any, max_distance: float,
+                                  stats: Optional[SearchStats] = None) -> List[Tuple[Any, float]]:
+        if self.root is None:
+            return []
+        return self._search(lambda s: self.root.get_within_distance_pairs(query, max_distance, s), stats)
+
+    def get_nearest_neighbours(self, query: Any, num_neighbours: int, max_results: int = 16,
+                               max_distance: Optional[float] = None, stats: Optional[SearchStats] = None):
         if self.root is None:
             return []
-        return self.root.get_within_distance(query, max_distance)
+        return self._search(
+            lambda s: self.root.get_nearest_neighbours(query, num_neighbours, max_results, max_distance, s), stats)
 
-    def get_nearest_neighbours(self, query: Any, num_neighbours: int, max_results: int = 16):
+    def get_nearest_neighbour_pairs(self, query: Any, num_neighbours: int, max_results: int = 16,
+                                    max_distance: Optional[float] = None,
+                                    stats: Optional[SearchStats] = None) -> List[Tuple[Any, float]]:
         if self.root is None:
             return []
-        return self.root.get_nearest_neighbours(query, num_neighbours, max_results)
+        return self._search(
+            lambda s: self.root.get_nearest_neighbour_pairs(query, num_neighbours, max_results, max_distance, s), stats)